@@ -5,6 +5,7 @@ from sqlalchemy import pool
 
 from alembic import context
 from models.allmodels import *
+from services.partitions import is_partition
 from sqlmodel import SQLModel
 
 target_metadata = SQLModel.metadata
@@ -24,6 +25,15 @@ if config.config_file_name is not None:
 # target_metadata = mymodel.Base.metadata
 
 
+# Помесячные секции и "<таблица>_legacy" создаются миграциями и задачей
+# create_message_partitions, в моделях их нет: без фильтра autogenerate
+# предлагает их удалить
+def include_name(name, type_, parent_names):
+    if type_ == "table":
+        return not is_partition(name)
+    return True
+
+
 # other values from the config, defined by the needs of env.py,
 # can be acquired:
 # my_important_option = config.get_main_option("my_important_option")
@@ -46,6 +56,7 @@ def run_migrations_offline() -> None:
     context.configure(
         url=url,
         target_metadata=target_metadata,
+        include_name=include_name,
         literal_binds=True,
         dialect_opts={"paramstyle": "named"},
     )
@@ -68,7 +79,11 @@ def run_migrations_online() -> None:
     )
 
     with connectable.connect() as connection:
-        context.configure(connection=connection, target_metadata=target_metadata)
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            include_name=include_name,
+        )
 
         with context.begin_transaction():
             context.run_migrations()
@@ -0,0 +1,148 @@
+"""добавлен chat_id в Messages и индекс для истории
+
+Revision ID: 14dc6a6536ea
+Revises: 23003d276f32
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "14dc6a6536ea"
+down_revision: Union[str, Sequence[str], None] = "23003d276f32"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# сколько сообщений обновлять за одну транзакцию
+BATCH_SIZE = 5000
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column("Messages", sa.Column("chat_id", sa.UUID(), nullable=True))
+
+    # сообщения можно было отправлять без созданного чата - создаем чаты для
+    # всех пар, у которых его нет (users хранится отсортированным)
+    op.execute(
+        'INSERT INTO "Chats" (id, users) '
+        "SELECT gen_random_uuid(), ARRAY[p.a, p.b] FROM ("
+        "SELECT DISTINCT least(sender, user2) AS a, greatest(sender, user2) AS b "
+        'FROM "Messages") AS p '
+        'WHERE NOT EXISTS (SELECT 1 FROM "Chats" AS c '
+        "WHERE c.users = ARRAY[p.a, p.b] OR c.users = ARRAY[p.b, p.a])"
+    )
+
+    # заполняем chat_id пачками, каждая в своей транзакции, чтобы не держать
+    # блокировку на всей таблице сообщений. Таблица проходится по первичному
+    # ключу диапазонами (last, upper]: каждая пачка читает только свой
+    # диапазон, а строки без чата не останавливают проход
+    with op.get_context().autocommit_block():
+        op.execute(
+            "CREATE TEMPORARY TABLE chat_pairs AS "
+            "SELECT least(users[1], users[2]) AS a, greatest(users[1], users[2]) AS b, "
+            "(array_agg(id ORDER BY id))[1] AS chat_id "
+            'FROM "Chats" WHERE array_length(users, 1) = 2 GROUP BY 1, 2'
+        )
+        op.execute("CREATE INDEX ON chat_pairs (a, b)")
+        connection = op.get_bind()
+        last = None
+        while True:
+            upper = connection.execute(
+                sa.text(
+                    'SELECT id FROM (SELECT id FROM "Messages" '
+                    "WHERE CAST(:last AS uuid) IS NULL OR id > :last "
+                    "ORDER BY id LIMIT :batch) AS b ORDER BY id DESC LIMIT 1"
+                ),
+                {"last": last, "batch": BATCH_SIZE},
+            ).scalar()
+            if upper is None:
+                break
+            connection.execute(
+                sa.text(
+                    'UPDATE "Messages" AS m SET chat_id = p.chat_id FROM chat_pairs AS p '
+                    "WHERE (CAST(:last AS uuid) IS NULL OR m.id > :last) "
+                    "AND m.id <= :upper AND m.chat_id IS NULL "
+                    "AND p.a = least(m.sender, m.user2) AND p.b = greatest(m.sender, m.user2)"
+                ),
+                {"last": last, "upper": upper},
+            )
+            last = upper
+        op.execute("DROP TABLE chat_pairs")
+        # пока шел проход, работающие писатели могли добавить сообщения без
+        # chat_id в уже пройденные диапазоны. Частичный индекс по таким
+        # строкам позволяет дозаполнить их под блокировкой, не сканируя таблицу
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_Messages_chat_id_null" '
+            'ON "Messages" (id) WHERE chat_id IS NULL'
+        )
+
+    # последний проход идет в одной транзакции с SHARE ROW EXCLUSIVE: чтение
+    # не блокируется, запись ждет только дозаполнения строк из частичного
+    # индекса. В той же транзакции появляются ограничения NOT VALID - они
+    # действуют для новых строк сразу, поэтому к этому шагу писатели старой
+    # версии, не заполняющие chat_id, должны быть остановлены.
+    op.execute('LOCK TABLE "Messages" IN SHARE ROW EXCLUSIVE MODE')
+    op.execute(
+        'INSERT INTO "Chats" (id, users) '
+        "SELECT gen_random_uuid(), ARRAY[p.a, p.b] FROM ("
+        "SELECT DISTINCT least(sender, user2) AS a, greatest(sender, user2) AS b "
+        'FROM "Messages" WHERE chat_id IS NULL) AS p '
+        'WHERE NOT EXISTS (SELECT 1 FROM "Chats" AS c '
+        "WHERE c.users = ARRAY[p.a, p.b] OR c.users = ARRAY[p.b, p.a])"
+    )
+    op.execute(
+        'UPDATE "Messages" AS m SET chat_id = ('
+        'SELECT c.id FROM "Chats" AS c WHERE array_length(c.users, 1) = 2 '
+        "AND least(c.users[1], c.users[2]) = least(m.sender, m.user2) "
+        "AND greatest(c.users[1], c.users[2]) = greatest(m.sender, m.user2) "
+        "ORDER BY c.id LIMIT 1) "
+        "WHERE m.chat_id IS NULL"
+    )
+    op.execute(
+        'ALTER TABLE "Messages" ADD CONSTRAINT "Messages_chat_id_fkey" '
+        'FOREIGN KEY (chat_id) REFERENCES "Chats" (id) ON DELETE CASCADE '
+        "NOT VALID"
+    )
+    op.execute(
+        'ALTER TABLE "Messages" ADD CONSTRAINT "Messages_chat_id_not_null" '
+        "CHECK (chat_id IS NOT NULL) NOT VALID"
+    )
+
+    # ограничения проверяются отдельно - проверка запись не блокирует. SET NOT
+    # NULL при проверенном CHECK таблицу не сканирует. Каждая команда - своя
+    # транзакция (вход в блок фиксирует транзакцию последнего прохода).
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS "ix_Messages_chat_id_null"')
+        op.execute('ALTER TABLE "Messages" VALIDATE CONSTRAINT "Messages_chat_id_fkey"')
+        op.execute(
+            'ALTER TABLE "Messages" VALIDATE CONSTRAINT "Messages_chat_id_not_null"'
+        )
+        op.execute('ALTER TABLE "Messages" ALTER COLUMN chat_id SET NOT NULL')
+        op.execute('ALTER TABLE "Messages" DROP CONSTRAINT "Messages_chat_id_not_null"')
+        # как в 3f1a3a3c92d1: прерванная сборка оставляет невалидный индекс
+        connection = op.get_bind()
+        invalid = connection.execute(
+            sa.text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = 'ix_Messages_chat_id_send_time_id' "
+                "AND NOT i.indisvalid"
+            )
+        ).first()
+        if invalid:
+            op.execute('DROP INDEX CONCURRENTLY "ix_Messages_chat_id_send_time_id"')
+        op.execute(
+            'CREATE INDEX CONCURRENTLY IF NOT EXISTS "ix_Messages_chat_id_send_time_id" '
+            'ON "Messages" (chat_id, send_time, id)'
+        )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_Messages_chat_id_send_time_id", table_name="Messages")
+    op.drop_constraint("Messages_chat_id_fkey", "Messages", type_="foreignkey")
+    op.drop_column("Messages", "chat_id")
@@ -0,0 +1,66 @@
+"""водяные знаки участников групп вместо GroupMessages.recipients
+
+Revision ID: 23003d276f32
+Revises: 4c5081439d81
+Create Date: 2026-10-18 12:30:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "23003d276f32"
+down_revision: Union[str, Sequence[str], None] = "4c5081439d81"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.add_column(
+        "GroupChatMembers", sa.Column("joined_at", sa.DateTime(), nullable=True)
+    )
+    op.add_column(
+        "GroupChatMembers",
+        sa.Column("last_delivered_at", sa.DateTime(), nullable=True),
+    )
+    op.add_column(
+        "GroupChatMembers", sa.Column("last_read_at", sa.DateTime(), nullable=True)
+    )
+    # текущие участники видят всю историю группы, как и раньше
+    op.execute(
+        'UPDATE "GroupChatMembers" AS m SET joined_at = g.created_at '
+        'FROM "GroupChat" AS g WHERE g.id = m.group_id'
+    )
+    op.execute(
+        'UPDATE "GroupChatMembers" SET joined_at = now() WHERE joined_at IS NULL'
+    )
+    op.alter_column(
+        "GroupChatMembers",
+        "joined_at",
+        nullable=False,
+        server_default=sa.text("now()"),
+    )
+    op.drop_column("GroupMessages", "recipients")
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.add_column(
+        "GroupMessages",
+        sa.Column("recipients", postgresql.ARRAY(sa.UUID()), nullable=True),
+    )
+    # восстанавливаем получателей по составу групп на момент отправки
+    op.execute(
+        'UPDATE "GroupMessages" AS msg SET recipients = ('
+        'SELECT array_agg(m.user_id) FROM "GroupChatMembers" AS m '
+        "WHERE m.group_id = msg.group_id AND m.joined_at <= msg.send_time)"
+    )
+    op.drop_column("GroupChatMembers", "last_read_at")
+    op.drop_column("GroupChatMembers", "last_delivered_at")
+    op.drop_column("GroupChatMembers", "joined_at")
@@ -0,0 +1,68 @@
+"""счетчики непрочитанных сообщений
+
+Revision ID: 36f08d99b6f0
+Revises: 7827fcb327b0
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "36f08d99b6f0"
+down_revision: Union[str, Sequence[str], None] = "7827fcb327b0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "UnreadCounters",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("user_id", sa.UUID(), nullable=False),
+        sa.Column("chat_id", sa.UUID(), nullable=True),
+        sa.Column("group_id", sa.UUID(), nullable=True),
+        sa.Column("unread", sa.Integer(), nullable=False),
+        sa.Column("last_read_at", sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(["user_id"], ["Users.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["chat_id"], ["Chats.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["group_id"], ["GroupChat.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ux_UnreadCounters_user_id_chat_id",
+        "UnreadCounters",
+        ["user_id", "chat_id"],
+        unique=True,
+    )
+    op.create_index(
+        "ux_UnreadCounters_user_id_group_id",
+        "UnreadCounters",
+        ["user_id", "group_id"],
+        unique=True,
+    )
+    # в группах уже есть водяные знаки прочтения, по ним счетчики считаются
+    # сразу; в личных чатах прочтение раньше не отмечалось, их счетчики
+    # начинаются с нуля
+    op.execute(
+        'INSERT INTO "UnreadCounters" (id, user_id, group_id, unread, last_read_at) '
+        "SELECT gen_random_uuid(), m.user_id, m.group_id, count(g.id), "
+        'm.last_read_at FROM "GroupChatMembers" m '
+        'JOIN "GroupMessages" g ON g.group_id = m.group_id '
+        "AND g.sender IS DISTINCT FROM m.user_id AND g.send_time >= m.joined_at "
+        "AND (m.last_read_at IS NULL OR g.send_time > m.last_read_at) "
+        "WHERE m.user_id IS NOT NULL AND m.group_id IS NOT NULL "
+        "GROUP BY m.user_id, m.group_id, m.last_read_at"
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ux_UnreadCounters_user_id_group_id", table_name="UnreadCounters")
+    op.drop_index("ux_UnreadCounters_user_id_chat_id", table_name="UnreadCounters")
+    op.drop_table("UnreadCounters")
@@ -0,0 +1,69 @@
+"""индексы под частые запросы, создаются CONCURRENTLY
+
+Revision ID: 3f1a3a3c92d1
+Revises: 14dc6a6536ea
+Create Date: 2026-10-18 13:30:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "3f1a3a3c92d1"
+down_revision: Union[str, Sequence[str], None] = "14dc6a6536ea"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# имя индекса -> определение; проверка использования - app/check_indexes.py
+INDEXES = {
+    "ix_Chats_users": 'ON "Chats" USING gin (users)',
+    "ix_GroupMessages_group_id_send_time_id": (
+        'ON "GroupMessages" (group_id, send_time, id)'
+    ),
+    "ux_GroupChatMembers_group_id_user_id": (
+        'ON "GroupChatMembers" (group_id, user_id)'
+    ),
+    "ix_GroupChatMembers_user_id": 'ON "GroupChatMembers" (user_id)',
+    "ix_RefreshToken_user_id": 'ON "RefreshToken" (user_id)',
+}
+UNIQUE = {"ux_GroupChatMembers_group_id_user_id"}
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # повторное членство оставляем одно: самое раннее по joined_at
+    op.execute(
+        'DELETE FROM "GroupChatMembers" AS m USING "GroupChatMembers" AS d '
+        "WHERE m.group_id = d.group_id AND m.user_id = d.user_id "
+        "AND (m.joined_at, m.id) > (d.joined_at, d.id)"
+    )
+    # CREATE INDEX CONCURRENTLY не блокирует запись в таблицу, но не может
+    # выполняться внутри транзакции
+    with op.get_context().autocommit_block():
+        connection = op.get_bind()
+        for name, definition in INDEXES.items():
+            # прерванная сборка оставляет невалидный индекс - пересобираем его
+            invalid = connection.execute(
+                sa.text(
+                    "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE c.relname = :name AND NOT i.indisvalid"
+                ),
+                {"name": name},
+            ).first()
+            if invalid:
+                op.execute(f'DROP INDEX CONCURRENTLY "{name}"')
+            unique = "UNIQUE " if name in UNIQUE else ""
+            op.execute(
+                f'CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS "{name}" {definition}'
+            )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"')
@@ -0,0 +1,59 @@
+"""таблица отложенных сообщений
+
+Revision ID: 63ffe1df4fa5
+Revises: 3f1a3a3c92d1
+Create Date: 2026-10-18 14:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "63ffe1df4fa5"
+down_revision: Union[str, Sequence[str], None] = "3f1a3a3c92d1"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    op.create_table(
+        "ScheduledMessages",
+        sa.Column("id", sa.Uuid(), nullable=False),
+        sa.Column("sender", sa.UUID(), nullable=False),
+        sa.Column("chat_id", sa.UUID(), nullable=True),
+        sa.Column("recipient_id", sa.Uuid(), nullable=True),
+        sa.Column("group_id", sa.UUID(), nullable=True),
+        sa.Column("text", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.Column("due_at", sa.DateTime(), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("status", sqlmodel.sql.sqltypes.AutoString(), nullable=False),
+        sa.ForeignKeyConstraint(["sender"], ["Users.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["chat_id"], ["Chats.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["group_id"], ["GroupChat.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        "ix_ScheduledMessages_pending_due_at",
+        "ScheduledMessages",
+        ["due_at"],
+        unique=False,
+        postgresql_where=sa.text("status = 'pending'"),
+    )
+    op.create_index(
+        "ix_ScheduledMessages_sender_due_at",
+        "ScheduledMessages",
+        ["sender", "due_at"],
+        unique=False,
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index("ix_ScheduledMessages_sender_due_at", table_name="ScheduledMessages")
+    op.drop_index("ix_ScheduledMessages_pending_due_at", table_name="ScheduledMessages")
+    op.drop_table("ScheduledMessages")
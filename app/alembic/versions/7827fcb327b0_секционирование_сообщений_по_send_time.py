@@ -0,0 +1,163 @@
+"""секционирование Messages и GroupMessages по send_time
+
+Revision ID: 7827fcb327b0
+Revises: 63ffe1df4fa5
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+
+from datetime import datetime
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "7827fcb327b0"
+down_revision: Union[str, Sequence[str], None] = "63ffe1df4fa5"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+# Таблицы секционируются по месяцам send_time без переписывания данных:
+# старая таблица целиком подключается секцией "<таблица>_legacy" (все до
+# границы), новые сообщения идут в помесячные секции. Ограничение на
+# send_time и уникальный индекс (id, send_time) строятся заранее без
+# блокировки записи, поэтому ATTACH PARTITION не сканирует таблицу и не
+# пересобирает индексы. Следующие секции создает задача
+# create_message_partitions (services/partitions.py).
+TABLES = {
+    "Messages": {
+        "columns": (
+            "id uuid NOT NULL, sender uuid, send_time timestamp NOT NULL, "
+            "text varchar NOT NULL, user2 uuid NOT NULL, chat_id uuid NOT NULL"
+        ),
+        "foreign_keys": {
+            "Messages_chat_id_fkey": (
+                'FOREIGN KEY (chat_id) REFERENCES "Chats"(id) ON DELETE CASCADE'
+            ),
+            "Messages_sender_fkey": 'FOREIGN KEY (sender) REFERENCES "Users"(id)',
+        },
+        "indexes": {
+            "ix_Messages_id": "(id)",
+            "ix_Messages_chat_id_send_time_id": "(chat_id, send_time, id)",
+        },
+    },
+    "GroupMessages": {
+        "columns": (
+            "id uuid NOT NULL, sender uuid, send_time timestamp NOT NULL, "
+            "text varchar NOT NULL, group_id uuid"
+        ),
+        "foreign_keys": {
+            "GroupMessages_group_id_fkey": (
+                'FOREIGN KEY (group_id) REFERENCES "GroupChat"(id) ON DELETE CASCADE'
+            ),
+            "GroupMessages_sender_fkey": 'FOREIGN KEY (sender) REFERENCES "Users"(id)',
+        },
+        "indexes": {
+            "ix_GroupMessages_id": "(id)",
+            "ix_GroupMessages_group_id_send_time_id": "(group_id, send_time, id)",
+        },
+    },
+}
+# на сколько месяцев после границы сразу создаются секции
+MONTHS_AHEAD = 3
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def legacy_index(table: str, index: str) -> str:
+    # имя в том же виде, что Postgres дает индексам секций
+    return f"{table}_legacy_{index.removeprefix(f'ix_{table}_')}_idx"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    connection = op.get_bind()
+    # начало следующего месяца, но не ближе суток: сообщения, записанные,
+    # пока идет миграция, должны пройти проверку send_time < границы
+    boundary = connection.execute(
+        sa.text(
+            "SELECT date_trunc('month', (now() AT TIME ZONE 'UTC') "
+            "+ interval '1 day') + interval '1 month'"
+        )
+    ).scalar()
+    for table in TABLES:
+        op.execute(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{table}_legacy_bound" '
+            f"CHECK (send_time < '{boundary}') NOT VALID"
+        )
+
+    # проверка ограничения и CREATE INDEX CONCURRENTLY не блокируют запись,
+    # но не могут выполняться внутри транзакции
+    with op.get_context().autocommit_block():
+        for table in TABLES:
+            op.execute(
+                f'ALTER TABLE "{table}" VALIDATE CONSTRAINT "{table}_legacy_bound"'
+            )
+            op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{table}_legacy_pkey"')
+            op.execute(
+                f'CREATE UNIQUE INDEX CONCURRENTLY "{table}_legacy_pkey" '
+                f'ON "{table}" (id, send_time)'
+            )
+
+    # дальше только быстрые операции с каталогом
+    for table, spec in TABLES.items():
+        legacy = f"{table}_legacy"
+        op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{table}_pkey"')
+        op.execute(
+            f'ALTER TABLE "{table}" ADD CONSTRAINT "{legacy}_pkey" '
+            f'PRIMARY KEY USING INDEX "{legacy}_pkey"'
+        )
+        op.execute(f'ALTER TABLE "{table}" RENAME TO "{legacy}"')
+        for index in spec["indexes"]:
+            op.execute(
+                f'ALTER INDEX "{index}" RENAME TO "{legacy_index(table, index)}"'
+            )
+
+        constraints = ", ".join(
+            f'CONSTRAINT "{name}" {definition}'
+            for name, definition in spec["foreign_keys"].items()
+        )
+        op.execute(
+            f'CREATE TABLE "{table}" ({spec["columns"]}, '
+            f'CONSTRAINT "{table}_pkey" PRIMARY KEY (id, send_time), {constraints}) '
+            "PARTITION BY RANGE (send_time)"
+        )
+        for index, columns in spec["indexes"].items():
+            op.execute(f'CREATE INDEX "{index}" ON "{table}" {columns}')
+
+        # индексы и внешние ключи старой таблицы подключаются к общим
+        op.execute(
+            f'ALTER TABLE "{table}" ATTACH PARTITION "{legacy}" '
+            f"FOR VALUES FROM (MINVALUE) TO ('{boundary}')"
+        )
+        op.execute(f'ALTER TABLE "{legacy}" DROP CONSTRAINT "{table}_legacy_bound"')
+
+        start = boundary
+        for _ in range(MONTHS_AHEAD):
+            end = add_months(start, 1)
+            op.execute(
+                f'CREATE TABLE "{table}_{start:%Y_%m}" PARTITION OF "{table}" '
+                f"FOR VALUES FROM ('{start}') TO ('{end}')"
+            )
+            start = end
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table, spec in TABLES.items():
+        legacy = f"{table}_legacy"
+        op.execute(f'ALTER TABLE "{table}" DETACH PARTITION "{legacy}"')
+        op.execute(f'INSERT INTO "{legacy}" SELECT * FROM "{table}"')
+        op.execute(f'DROP TABLE "{table}"')
+        op.execute(f'ALTER TABLE "{legacy}" RENAME TO "{table}"')
+        for index in spec["indexes"]:
+            op.execute(
+                f'ALTER INDEX "{legacy_index(table, index)}" RENAME TO "{index}"'
+            )
+        op.execute(f'ALTER TABLE "{table}" DROP CONSTRAINT "{legacy}_pkey"')
+        op.execute(f'ALTER TABLE "{table}" ADD PRIMARY KEY (id)')
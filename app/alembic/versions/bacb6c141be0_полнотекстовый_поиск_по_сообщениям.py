@@ -0,0 +1,74 @@
+"""полнотекстовый поиск по сообщениям
+
+Revision ID: bacb6c141be0
+Revises: 36f08d99b6f0
+Create Date: 2026-10-18 17:00:00.000000
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+# revision identifiers, used by Alembic.
+revision: str = "bacb6c141be0"
+down_revision: Union[str, Sequence[str], None] = "36f08d99b6f0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+TABLES = ("Messages", "GroupMessages")
+SEARCH_VECTOR = "to_tsvector('russian', text) || to_tsvector('english', text)"
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # добавление вычисляемой колонки переписывает все секции под блокировкой
+    # таблицы; индексы потом строятся отдельно и запись не блокируют
+    for table in TABLES:
+        op.execute(
+            f'ALTER TABLE "{table}" ADD COLUMN search tsvector '
+            f"GENERATED ALWAYS AS ({SEARCH_VECTOR}) STORED"
+        )
+
+    # индекс секционированной таблицы нельзя построить CONCURRENTLY: он
+    # создается пустым только на родителе, индексы секций строятся по одному
+    # и подключаются к нему. Новые секции получат индекс сами.
+    connection = op.get_bind()
+    partitions = {
+        table: connection.execute(
+            sa.text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = CAST(:table AS regclass) ORDER BY c.relname"
+            ),
+            {"table": f'"{table}"'},
+        )
+        .scalars()
+        .all()
+        for table in TABLES
+    }
+    for table in TABLES:
+        op.execute(
+            f'CREATE INDEX "ix_{table}_search" ON ONLY "{table}" USING gin (search)'
+        )
+    with op.get_context().autocommit_block():
+        for table, names in partitions.items():
+            for name in names:
+                op.execute(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}_search_idx"')
+                op.execute(
+                    f'CREATE INDEX CONCURRENTLY "{name}_search_idx" '
+                    f'ON "{name}" USING gin (search)'
+                )
+                op.execute(
+                    f'ALTER INDEX "ix_{table}_search" '
+                    f'ATTACH PARTITION "{name}_search_idx"'
+                )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for table in TABLES:
+        op.execute(f'DROP INDEX "ix_{table}_search"')
+        op.execute(f'ALTER TABLE "{table}" DROP COLUMN search')
@@ -1,9 +1,24 @@
 # если я забыла че это такое, то это файлик с настройками celery
 
 from celery import Celery
+from config import settings
 
-celery_app = Celery(
-    "tasks", broker="redis://redis:6379/0", backend="redis://redis:6379/0"
-)
+celery_app = Celery("tasks", broker=settings.REDIS_URL, backend=settings.REDIS_URL)
+# отложенные сообщения, чье время пришло, записываются в базу пачками
+celery_app.conf.beat_schedule = {
+    "deliver-scheduled-messages": {
+        "task": "services.celery_service.deliver_scheduled_messages",
+        "schedule": settings.SCHEDULED_FLUSH_INTERVAL,
+    },
+    "flush-scheduled-messages": {
+        "task": "services.celery_service.flush_scheduled_messages",
+        "schedule": settings.SCHEDULED_FLUSH_INTERVAL,
+    },
+    # секции таблиц сообщений на месяцы вперед, раз в сутки
+    "create-message-partitions": {
+        "task": "services.celery_service.create_message_partitions",
+        "schedule": 24 * 60 * 60,
+    },
+}
 
 import services.celery_service
@@ -0,0 +1,146 @@
+# Проверка, что частые запросы обслуживаются своими индексами.
+# Запуск из каталога app: python check_indexes.py
+# Запросы строятся теми же функциями, что и в роутерах, и прогоняются через
+# EXPLAIN с выключенным seq scan: на маленькой базе планировщик и так выберет
+# полный просмотр, а здесь важно, что индекс вообще применим к запросу.
+# У секционированных таблиц в плане видны индексы секций, они считаются
+# за индекс таблицы.
+# Код выхода 1, если хотя бы один запрос не использует ожидаемый индекс (или
+# ни один из ожидаемых, если их несколько).
+
+import sys
+from datetime import datetime
+from uuid import uuid4
+
+from sqlalchemy import ClauseElement, Executable, and_, text
+from sqlalchemy.ext.compiler import compiles
+from sqlmodel import select
+
+from db import engine
+from models.allmodels import (
+    GroupChatMembers,
+    GroupMessage,
+    Message,
+    RefreshToken,
+    utcnow,
+)
+from services.chats import contacts_query, direct_chat_query
+from services.groupchats import membership_query
+from services.history import encode_cursor, history_query
+from services.search import search_query
+from services.unread import unread_query
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    return "EXPLAIN " + compiler.process(element.statement, **kw)
+
+
+def hot_queries():
+    user_id, other_id, chat_id, group_id = uuid4(), uuid4(), uuid4(), uuid4()
+    cursor = encode_cursor(utcnow(), uuid4())
+    return [
+        ("список собеседников", contacts_query(user_id), "ix_Chats_users"),
+        (
+            "личный чат по паре",
+            direct_chat_query(sorted([user_id, other_id])),
+            "ix_Chats_users",
+        ),
+        (
+            "история личного чата",
+            history_query(Message, Message.chat_id == chat_id, cursor, None).limit(50),
+            "ix_Messages_chat_id_send_time_id",
+        ),
+        (
+            "история группы",
+            history_query(
+                GroupMessage,
+                and_(
+                    GroupMessage.group_id == group_id,
+                    GroupMessage.send_time >= datetime(2000, 1, 1),
+                ),
+                cursor,
+                None,
+            ).limit(50),
+            "ix_GroupMessages_group_id_send_time_id",
+        ),
+        (
+            "состав группы",
+            membership_query(group_id),
+            "ux_GroupChatMembers_group_id_user_id",
+        ),
+        (
+            "группы пользователя",
+            select(GroupChatMembers).where(GroupChatMembers.user_id == user_id),
+            "ix_GroupChatMembers_user_id",
+        ),
+        (
+            "поиск по личным чатам",
+            search_query(user_id, "hello", None, 20),
+            "ix_Messages_search",
+        ),
+        (
+            "поиск по группам",
+            search_query(user_id, "hello", None, 20),
+            # по составу групп пользователя или по поисковому индексу, что
+            # выборочнее
+            ("ix_GroupMessages_search", "ix_GroupMessages_group_id_send_time_id"),
+        ),
+        (
+            "непрочитанные пользователя",
+            unread_query(user_id),
+            ("ux_UnreadCounters_user_id_chat_id", "ux_UnreadCounters_user_id_group_id"),
+        ),
+        (
+            "refresh-токены пользователя",
+            select(RefreshToken).where(RefreshToken.user_id == user_id),
+            "ix_RefreshToken_user_id",
+        ),
+    ]
+
+
+# сам индекс и индексы секций, если он создан на секционированной таблице
+def index_names(conn, index: str) -> list[str]:
+    return [index] + (
+        conn.execute(
+            text(
+                "SELECT c.relname FROM pg_partition_tree(CAST(:index AS regclass)) t "
+                "JOIN pg_class c ON c.oid = t.relid"
+            ),
+            {"index": f'"{index}"'},
+        )
+        .scalars()
+        .all()
+    )
+
+
+def main():
+    failed = False
+    with engine.connect() as conn:
+        conn.execute(text("SET enable_seqscan = off"))
+        for name, query, indexes in hot_queries():
+            # несколько индексов - подходит любой из них
+            if isinstance(indexes, str):
+                indexes = (indexes,)
+            plan = "\n".join(row[0] for row in conn.execute(Explain(query)))
+            ok = any(
+                f'"{used}"' in plan or f" {used} " in plan
+                for index in indexes
+                for used in index_names(conn, index)
+            )
+            failed = failed or not ok
+            print(f"{'OK  ' if ok else 'FAIL'} {name}: {' или '.join(indexes)}")
+            if not ok:
+                print(plan)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
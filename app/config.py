@@ -10,11 +10,106 @@ logger = logging.getLogger(__name__)
 load_dotenv(dotenv_path=".env")
 
 
+def to_async_url(url: str | None) -> str | None:
+    # postgresql://... -> postgresql+asyncpg://...
+    if url is None:
+        return None
+    scheme, _, rest = url.partition("://")
+    return f"{scheme.split('+')[0]}+asyncpg://{rest}"
+
+
 class Settings:
     POSTGRES_URL = os.getenv("POSTGRES_URL")
+    ASYNC_POSTGRES_URL = os.getenv("ASYNC_POSTGRES_URL") or to_async_url(POSTGRES_URL)
     SECRET_KEY = os.getenv("SECRET_KEY")
     ALGORITHM = os.getenv("ALGORITHM", "HS256")
     ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 60))
+    REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379/0")
+    # redis - доставка между воркерами через Redis pub/sub, memory - в пределах
+    # одного процесса (тесты, запуск в один воркер)
+    BUS_BACKEND = os.getenv("BUS_BACKEND", "redis")
+    # размер очереди исходящих сообщений одного WebSocket-подключения и что
+    # делать при ее переполнении: drop_oldest или disconnect
+    WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+    WS_OVERFLOW_POLICY = os.getenv("WS_OVERFLOW_POLICY", "drop_oldest")
+    # через сколько секунд без входящих кадров WebSocket считается мертвым
+    # (клиент шлет ping чаще, см. frontend/static/js)
+    WS_IDLE_TIMEOUT = int(os.getenv("WS_IDLE_TIMEOUT", 60))
+    # со скольких получателей уведомление публикуется одним кадром в общий
+    # канал, а не в канал каждого получателя (websocket.py)
+    WS_FANOUT_THRESHOLD = int(os.getenv("WS_FANOUT_THRESHOLD", 32))
+    # GET /metrics со счетчиками кэшей и очередей воркера (routers/metrics.py):
+    # внутренние данные, поэтому эндпоинт подключается только по явному флагу
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    # кэш пользователей по access-токену (services/users.py): размер и время
+    # жизни записи в секундах на воркер, плюс общий уровень в Redis
+    PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+    PRINCIPAL_CACHE_TTL = int(os.getenv("PRINCIPAL_CACHE_TTL", 60))
+    PRINCIPAL_CACHE_REDIS = os.getenv("PRINCIPAL_CACHE_REDIS", "false").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    # кэш id личных чатов по паре пользователей (services/chats.py)
+    DIRECT_CHAT_CACHE_SIZE = int(os.getenv("DIRECT_CHAT_CACHE_SIZE", 10000))
+    DIRECT_CHAT_CACHE_TTL = int(os.getenv("DIRECT_CHAT_CACHE_TTL", 3600))
+    # кэш состава групп (services/groupchats.py): записей и секунд жизни
+    GROUP_MEMBERS_CACHE_SIZE = int(os.getenv("GROUP_MEMBERS_CACHE_SIZE", 10000))
+    GROUP_MEMBERS_CACHE_TTL = int(os.getenv("GROUP_MEMBERS_CACHE_TTL", 300))
+    # последние записанные водяные знаки доставки (services/groupchats.py):
+    # записей и секунд жизни
+    DELIVERED_CACHE_SIZE = int(os.getenv("DELIVERED_CACHE_SIZE", 100000))
+    DELIVERED_CACHE_TTL = int(os.getenv("DELIVERED_CACHE_TTL", 300))
+    # стоимость bcrypt: при ее изменении хэши пересчитываются при входе
+    BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+    # пул потоков для bcrypt и сколько запросов может ждать в очереди к нему
+    PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 4))
+    PASSWORD_HASH_QUEUE_SIZE = int(os.getenv("PASSWORD_HASH_QUEUE_SIZE", 64))
+    # запись отложенных сообщений: размер пачки (строк на один INSERT), как
+    # часто celery beat запускает разбор очереди (секунды) и время жизни
+    # блокировки разбора
+    SCHEDULED_BATCH_SIZE = int(os.getenv("SCHEDULED_BATCH_SIZE", 1000))
+    SCHEDULED_FLUSH_INTERVAL = float(os.getenv("SCHEDULED_FLUSH_INTERVAL", 1.0))
+    SCHEDULED_FLUSH_LOCK_TIMEOUT = int(os.getenv("SCHEDULED_FLUSH_LOCK_TIMEOUT", 60))
+    # запись живых сообщений: direct - своей транзакцией на каждое, batched -
+    # через очередь процесса пачками (services/ingest.py). Для batched: размер
+    # пачки, сколько секунд ждать соседей, длина очереди, каталог для файлов
+    # на время недоступности базы и как часто проверять, не пора ли их
+    # переиграть
+    INGEST_MODE = os.getenv("INGEST_MODE", "direct")
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 500))
+    INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 0.002))
+    INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 10000))
+    INGEST_SPILL_DIR = os.getenv("INGEST_SPILL_DIR", "spill")
+    INGEST_REPLAY_INTERVAL = float(os.getenv("INGEST_REPLAY_INTERVAL", 5.0))
+    # на сколько месяцев вперед создаются секции Messages и GroupMessages
+    MESSAGE_PARTITIONS_AHEAD = int(os.getenv("MESSAGE_PARTITIONS_AHEAD", 3))
+    # кэш последних сообщений переписок (services/recent.py): сколько
+    # сообщений на переписку (0 - выключен), общий объем в байтах, общий
+    # уровень в Redis и время жизни его списков
+    RECENT_HISTORY_SIZE = int(os.getenv("RECENT_HISTORY_SIZE", 100))
+    RECENT_HISTORY_MAX_BYTES = int(os.getenv("RECENT_HISTORY_MAX_BYTES", 64 * 2**20))
+    RECENT_HISTORY_REDIS = os.getenv("RECENT_HISTORY_REDIS", "false").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    RECENT_HISTORY_REDIS_TTL = int(os.getenv("RECENT_HISTORY_REDIS_TTL", 3600))
+    # через сколько секунд буфер переписки в памяти воркера перечитывается:
+    # уведомления через шину могут теряться, и так устаревший буфер живет
+    # не дольше этого
+    RECENT_HISTORY_TTL = float(os.getenv("RECENT_HISTORY_TTL", 30))
+    # сколько сообщений можно отправить одним запросом POST /messages/bulk
+    MESSAGES_BULK_MAX_SIZE = int(os.getenv("MESSAGES_BULK_MAX_SIZE", 1000))
+    # поиск по сообщениям: результатов на страницу и длина строки запроса
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+    SEARCH_QUERY_MAX_LENGTH = int(os.getenv("SEARCH_QUERY_MAX_LENGTH", 200))
+    MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", 50))
+    MESSAGES_PAGE_MAX_SIZE = int(os.getenv("MESSAGES_PAGE_MAX_SIZE", 200))
 
 
 settings = Settings()
@@ -1,11 +1,21 @@
 from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from config import settings
 from typing import Annotated
 from fastapi import Depends
 
+# синхронный движок остается для celery и alembic
 engine = create_engine(settings.POSTGRES_URL)
 DBSession = Session
 
+# асинхронный движок (asyncpg) для обработчиков FastAPI, чтобы запросы
+# к базе не блокировали event loop
+async_engine = create_async_engine(settings.ASYNC_POSTGRES_URL)
+async_session_maker = async_sessionmaker(
+    async_engine, class_=AsyncSession, expire_on_commit=False
+)
+
 
 async def get_db():
     db = DBSession()
@@ -20,4 +30,9 @@ def get_session():
         yield session
 
 
-SessionDep = Annotated[Session, Depends(get_session)]
+async def get_async_session():
+    async with async_session_maker() as session:
+        yield session
+
+
+SessionDep = Annotated[AsyncSession, Depends(get_async_session)]
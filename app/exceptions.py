@@ -24,3 +24,12 @@ NoUserIdException = HTTPException(
 ForbiddenException = HTTPException(
     status_code=status.HTTP_403_FORBIDDEN, detail="Недостаточно прав!"
 )
+
+
+class PasswordQueueFullException(HTTPException):
+    def __init__(self):
+        super().__init__(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Сервер перегружен, попробуйте позже",
+            headers={"Retry-After": "1"},
+        )
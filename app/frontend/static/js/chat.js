@@ -1,6 +1,11 @@
 let selectedUserId = null;  // Хранит ID пользователя, с которым мы общаемся в чате
 let socket = null; 
+let pendingMessages = new Map();
+let heartbeatInterval = null;
 let messagePollingInterval = null;  // Таймер для периодической загрузки сообщений
+let lastMessageId = null;  // ID последнего показанного сообщения, от него запрашиваются новые
+let olderCursor = null;  // Курсор для подгрузки более старых сообщений
+let renderedIds = new Set();  // Уже показанные сообщения, чтобы не дублировать их
 const modal = document.getElementById("myModal"); // окошко для минут
 
 document.getElementById("lateButton").onclick = function() {
@@ -9,18 +14,52 @@ document.getElementById("lateButton").onclick = function() {
 
 function startMessagePolling(userId) {
     clearInterval(messagePollingInterval); 
-    messagePollingInterval = setInterval(async () => {
-        try {
-            const response = await apiFetch(`/messages/${userId}`);
-            const messages = await response.json();
-            const messagesContainer = document.getElementById('messages');
-            messagesContainer.innerHTML = messages.map(m => createMessageElement(m.text, m.sender_id)).join('');
-        } catch (error) {
-            console.error('Ошибка при опросе сообщений:', error);
-        }
+    // новые сообщения приходят по WebSocket, опрос нужен только пока его нет
+    messagePollingInterval = setInterval(() => {
+        if (!socket || socket.readyState !== WebSocket.OPEN) pollMessages(userId);
     }, 1000);
 }
 
+// Запрашиваем только сообщения новее последнего показанного
+async function pollMessages(userId) {
+    try {
+        const url = lastMessageId
+            ? `/messages/${userId}?after_id=${lastMessageId}`
+            : `/messages/${userId}`;
+        const response = await apiFetch(url);
+        if (response.status === 304 || !response.ok || userId !== selectedUserId) return;
+        const messages = await response.json();
+        messages.forEach(m => addMessage(m.text, m.sender_id, m.id));
+    } catch (error) {
+        console.error('Ошибка при опросе сообщений:', error);
+    }
+}
+
+// Подгружаем более старые сообщения, когда пользователь доскроллил до начала
+async function loadOlderMessages() {
+    if (!olderCursor || !selectedUserId) return;
+    const userId = selectedUserId;
+    const cursor = olderCursor;
+    olderCursor = null;
+    try {
+        const response = await apiFetch(`/messages/${userId}?before=${encodeURIComponent(cursor)}`);
+        if (userId !== selectedUserId) return;
+        const messages = (await response.json()).filter(m => !renderedIds.has(m.id));
+        messages.forEach(m => renderedIds.add(m.id));
+        olderCursor = response.headers.get('X-Next-Cursor');
+
+        const messagesContainer = document.getElementById('messages');
+        const previousHeight = messagesContainer.scrollHeight;
+        messagesContainer.insertAdjacentHTML('afterbegin', messages.map(m =>
+            createMessageElement(m.text, m.sender_id)
+        ).join(''));
+        messagesContainer.scrollTop = messagesContainer.scrollHeight - previousHeight;
+    } catch (error) {
+        olderCursor = cursor;
+        console.error('Ошибка загрузки сообщений:', error);
+    }
+}
+
 async function minutesentr() {
     const input = document.getElementById("minutes").value;
     if (isNaN(input) || input < 0) {
@@ -46,7 +85,6 @@ async function minutesentr() {
                 body: JSON.stringify(payload)
             });
 
-            socket.send(JSON.stringify(payload));  
             addMessage(message, ""); 
             messageInput.value = ''; 
         } catch (error) {
@@ -127,35 +165,62 @@ async function selectGroup(userId, userName, event) {
 }
 
 async function loadMessages(userId) {
+    lastMessageId = null;
+    olderCursor = null;
+    renderedIds = new Set();
     try {
         const response = await apiFetch(`/messages/${userId}`); 
         const messages = await response.json();  
+        olderCursor = response.headers.get('X-Next-Cursor');
 
         const messagesContainer = document.getElementById('messages');
-        messagesContainer.innerHTML = messages.map(message =>
-            createMessageElement(message.text, message.sender_id)
-        ).join(''); 
+        messagesContainer.innerHTML = '';
+        messages.forEach(m => addMessage(m.text, m.sender_id, m.id));
     } catch (error) {
         console.error('Ошибка загрузки сообщений:', error); 
     }
 }
 
+// Одно соединение на страницу: пользователь определяется сервером по cookie
 function connectWebSocket() {
-    if (socket) socket.close();  
+    if (socket && socket.readyState <= WebSocket.OPEN) return;
     const protocol = window.location.protocol === "https:" ? "wss" : "ws";
-    const host = window.location.hostname;
-    socket = new WebSocket(`${protocol}://localhost:8000/ws/${selectedUserId}`);  
-
-    socket.onopen = () => console.log('WebSocket соединение установлено');  
+    socket = new WebSocket(`${protocol}://${window.location.host}/ws`);  
+
+    socket.onopen = () => {
+        console.log('WebSocket соединение установлено');  
+        // сервер закрывает соединение, если клиент долго молчит
+        clearInterval(heartbeatInterval);
+        heartbeatInterval = setInterval(() => socket.send(JSON.stringify({type: 'ping'})), 25000);
+        // догоняем то, что пришло, пока соединения не было
+        if (selectedUserId) pollMessages(selectedUserId);
+    };
 
     socket.onmessage = (event) => {
         const incomingMessage = JSON.parse(event.data);  
+        if (incomingMessage.type === 'pong') return;
+        if (incomingMessage.type === 'ack') {
+            // подтверждение сервера: сообщение сохранено под этим id
+            const text = pendingMessages.get(incomingMessage.client_id);
+            pendingMessages.delete(incomingMessage.client_id);
+            if (text !== undefined) addMessage(text, "", incomingMessage.id);
+            return;
+        }
+        if (incomingMessage.type === 'error') {
+            pendingMessages.delete(incomingMessage.client_id);
+            console.error('Ошибка при отправке сообщения:', incomingMessage.detail);
+            return;
+        }
         if (incomingMessage.recipient_id === selectedUserId || incomingMessage.sender_id === selectedUserId) {
-            addMessage(incomingMessage.content, incomingMessage.sender_id);  
+            addMessage(incomingMessage.content, incomingMessage.sender_id, incomingMessage.id);  
         }
     };
 
-    socket.onclose = () => console.log('WebSocket соединение закрыто');  
+    socket.onclose = () => {
+        console.log('WebSocket соединение закрыто');  
+        clearInterval(heartbeatInterval);
+        setTimeout(connectWebSocket, 3000);
+    };
 }
 
 async function sendMessage() {
@@ -165,6 +230,15 @@ async function sendMessage() {
     if (message && selectedUserId) { 
         const payload = {recipient_id: selectedUserId, content: message}; 
 
+        // при открытом сокете отправляем сообщение по нему и ждем ack
+        if (socket && socket.readyState === WebSocket.OPEN) {
+            const clientId = crypto.randomUUID();
+            pendingMessages.set(clientId, message);
+            socket.send(JSON.stringify({type: 'message', client_id: clientId, ...payload}));
+            messageInput.value = ''; 
+            return;
+        }
+
         try {
             await fetch('/messages', {
                 method: 'POST',
@@ -172,16 +246,20 @@ async function sendMessage() {
                 body: JSON.stringify(payload)
             });
 
-            socket.send(JSON.stringify(payload));  
-            addMessage(message, ""); 
             messageInput.value = ''; 
+            await pollMessages(selectedUserId);
         } catch (error) {
             console.error('Ошибка при отправке сообщения:', error);  
         }
     }
 }
 
-function addMessage(text, sender_id) {
+function addMessage(text, sender_id, messageId) {
+    if (messageId) {
+        if (renderedIds.has(messageId)) return;
+        renderedIds.add(messageId);
+        lastMessageId = messageId;
+    }
     const messagesContainer = document.getElementById('messages');
     messagesContainer.insertAdjacentHTML('beforeend', createMessageElement(text, sender_id));  
     messagesContainer.scrollTop = messagesContainer.scrollHeight;  
@@ -192,12 +270,29 @@ function createMessageElement(text, sender_id) {
     return `<div class="message ${messageClass}">${text}</div>`;
 }
 
-document.querySelectorAll('.user-item').forEach(item => {
-    item.onclick = event => selectGroup(item.getAttribute('data-user-id'), item.textContent, event);  
-});
+// Список собеседников приходит JSON-ом, сама страница - статический файл
+async function loadContacts() {
+    const response = await apiFetch('/chats');
+    if (!response.ok) return;
+    const userList = document.getElementById('userList');
+    for (const contact of await response.json()) {
+        const item = document.createElement('div');
+        item.className = 'user-item';
+        item.dataset.userId = contact.id;
+        item.textContent = contact.username;
+        item.onclick = event => selectGroup(contact.id, contact.username, event);
+        userList.appendChild(item);
+    }
+}
+
+loadContacts();
 
 document.getElementById('sendButton').onclick = sendMessage;  
 
+document.getElementById('messages').onscroll = (e) => {
+    if (e.target.scrollTop === 0) loadOlderMessages();
+};
+
 document.getElementById('messageInput').onkeypress = async (e) => {
     if (e.key === 'Enter') {  
         await sendMessage();  
@@ -1,8 +1,13 @@
 let currentUsername;
 const userCache = {};
 let socket = null;
+let pendingMessages = new Map();
+let heartbeatInterval = null;
 let messagePollingInterval = null;
 let selectedGroupId = null;
+let lastMessageId = null;
+let olderCursor = null;
+let renderedIds = new Set();
 
 async function exitGroup(chatId) {
     const response = await fetch('/group_chats/exit', {
@@ -144,36 +149,98 @@ function createMessageElement(text, sender_id, messageId) {
     return `<div class="message ${messageClass}" id="msg-${messageId}">(${username}) ${text}</div>`;
 }
 
-function addMessage(text, sender_id) {
+function addMessage(text, sender_id, messageId) {
+    if (messageId) {
+        if (renderedIds.has(messageId)) return;
+        renderedIds.add(messageId);
+        lastMessageId = messageId;
+    }
     const messagesContainer = document.getElementById('messages');
-    messagesContainer.insertAdjacentHTML('beforeend', createMessageElement(text, sender_id, Date.now()));
+    messagesContainer.insertAdjacentHTML('beforeend', createMessageElement(text, sender_id, messageId || Date.now()));
     messagesContainer.scrollTop = messagesContainer.scrollHeight;
 }
 
 function startMessagePolling(groupId) {
     clearInterval(messagePollingInterval);
-    messagePollingInterval = setInterval(async () => {
-        try {
-            const res = await apiFetch(`/group_chats/messages/${groupId}`);
-            const messages = await res.json();
-            const messagesContainer = document.getElementById('messages');
-            messagesContainer.innerHTML = messages.map((m, i) => createMessageElement(m.text, m.sender_id, i)).join('');
-        } catch (err) {
-            console.error('Ошибка при опросе сообщений:', err);
-        }
+    // новые сообщения приходят по WebSocket, опрос нужен только пока его нет
+    messagePollingInterval = setInterval(() => {
+        if (!socket || socket.readyState !== WebSocket.OPEN) pollMessages(groupId);
     }, 1000);
 }
 
+// Запрашиваем только сообщения новее последнего показанного
+async function pollMessages(groupId) {
+    try {
+        const url = lastMessageId
+            ? `/group_chats/messages/${groupId}?after_id=${lastMessageId}`
+            : `/group_chats/messages/${groupId}`;
+        const res = await apiFetch(url);
+        if (res.status === 304 || !res.ok || groupId !== selectedGroupId) return;
+        const messages = await res.json();
+        messages.forEach(m => addMessage(m.text, m.sender_id, m.id));
+    } catch (err) {
+        console.error('Ошибка при опросе сообщений:', err);
+    }
+}
+
+// Подгружаем более старые сообщения, когда пользователь доскроллил до начала
+async function loadOlderMessages() {
+    if (!olderCursor || !selectedGroupId) return;
+    const groupId = selectedGroupId;
+    const cursor = olderCursor;
+    olderCursor = null;
+    try {
+        const res = await apiFetch(`/group_chats/messages/${groupId}?before=${encodeURIComponent(cursor)}`);
+        if (groupId !== selectedGroupId) return;
+        const messages = (await res.json()).filter(m => !renderedIds.has(m.id));
+        messages.forEach(m => renderedIds.add(m.id));
+        olderCursor = res.headers.get('X-Next-Cursor');
+
+        const container = document.getElementById('messages');
+        const previousHeight = container.scrollHeight;
+        container.insertAdjacentHTML('afterbegin', messages.map(m => createMessageElement(m.text, m.sender_id, m.id)).join(''));
+        container.scrollTop = container.scrollHeight - previousHeight;
+    } catch (err) {
+        olderCursor = cursor;
+        console.error('Ошибка загрузки сообщений:', err);
+    }
+}
+
 function connectWebSocket() {
-    if (socket) socket.close();
+    if (socket && socket.readyState <= WebSocket.OPEN) return;
     const protocol = window.location.protocol === "https:" ? "wss" : "ws";
-    socket = new WebSocket(`${protocol}://localhost:8000/ws/${selectedGroupId}`);
-    socket.onopen = () => console.log('WS соединение установлено');
+    socket = new WebSocket(`${protocol}://${window.location.host}/group_chats/ws`);
+    socket.onopen = () => {
+        console.log('WS соединение установлено');
+        clearInterval(heartbeatInterval);
+        heartbeatInterval = setInterval(() => socket.send(JSON.stringify({ type: 'ping' })), 25000);
+        // догоняем то, что пришло, пока соединения не было
+        if (selectedGroupId) pollMessages(selectedGroupId);
+    };
     socket.onmessage = e => {
         const msg = JSON.parse(e.data);
-        if (msg.chat_id === selectedGroupId) addMessage(msg.text, msg.sender_id);
+        if (msg.type === 'pong') return;
+        if (msg.type === 'ack') {
+            const text = pendingMessages.get(msg.client_id);
+            pendingMessages.delete(msg.client_id);
+            if (text !== undefined) addMessage(text, document.querySelector(".chat-container").dataset.userId, msg.id);
+            return;
+        }
+        if (msg.type === 'error') {
+            pendingMessages.delete(msg.client_id);
+            return console.error('Ошибка при отправке сообщения:', msg.detail);
+        }
+        // подтверждаем получение: GET истории водяной знак доставки не двигает
+        if (msg.chat_id && msg.sender_id !== document.querySelector(".chat-container").dataset.userId) {
+            socket.send(JSON.stringify({ type: 'delivered', chat_id: msg.chat_id, message_id: msg.id }));
+        }
+        if (msg.chat_id === selectedGroupId) addMessage(msg.text, msg.sender_id, msg.id);
+    };
+    socket.onclose = () => {
+        console.log('WS соединение закрыто');
+        clearInterval(heartbeatInterval);
+        setTimeout(connectWebSocket, 3000);
     };
-    socket.onclose = () => console.log('WS соединение закрыто');
 }
 
 async function sendMessage() {
@@ -182,14 +249,21 @@ async function sendMessage() {
     if (!message || !selectedGroupId) return;
 
     const payload = { chat_id: selectedGroupId, text: message };
+    // при открытом сокете отправляем по нему и ждем ack, иначе через POST
+    if (socket && socket.readyState === WebSocket.OPEN) {
+        const clientId = crypto.randomUUID();
+        pendingMessages.set(clientId, message);
+        socket.send(JSON.stringify({ type: 'message', client_id: clientId, ...payload }));
+        input.value = '';
+        return;
+    }
     await fetch('/group_chats/messages', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
     });
-    socket.send(JSON.stringify(payload));
-    addMessage(message, document.querySelector(".chat-container").dataset.userId);
     input.value = '';
+    await pollMessages(selectedGroupId);
 }
 
 async function minutesentr() {
@@ -206,17 +280,21 @@ async function minutesentr() {
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(payload)
     });
-    socket.send(JSON.stringify(payload));
     addMessage(message, document.querySelector(".chat-container").dataset.userId);
     messageInput.value = '';
     document.getElementById("myModal").style.display = "none";
 }
 
 async function loadMessages(chatId) {
+    lastMessageId = null;
+    olderCursor = null;
+    renderedIds = new Set();
     const res = await apiFetch(`/group_chats/messages/${chatId}`);
     const messages = await res.json();
+    olderCursor = res.headers.get('X-Next-Cursor');
     const container = document.getElementById('messages');
-    container.innerHTML = messages.map(m => createMessageElement(m.text, m.sender_id)).join('');
+    container.innerHTML = '';
+    messages.forEach(m => addMessage(m.text, m.sender_id, m.id));
 }
 
 async function selectGroup(chatId, chatTitle, event) {
@@ -282,6 +360,7 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     document.getElementById('sendButton').onclick = sendMessage;
+    document.getElementById('messages').onscroll = e => { if (e.target.scrollTop === 0) loadOlderMessages(); };
     document.getElementById('messageInput').onkeypress = async e => { if (e.key === 'Enter') await sendMessage(); };
     document.getElementById('ChatMembers').onclick = () => { if (!selectedGroupId) return alert("Сначала выберите чат!"); ShowMembers(); };
 });
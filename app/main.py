@@ -1,14 +1,41 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from routers.users import router as users
 from routers.chats import router as chats
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from config import settings
 from exceptions import TokenExpiredException, TokenNoFoundException
 from fastapi.exceptions import HTTPException
 from fastapi.responses import JSONResponse, RedirectResponse
 from routers.groupchats import router as group_chats
+from routers.metrics import router as metrics
+from routers.scheduled import router as scheduled
+from routers.search import router as search
+from services.groupchats import GROUP_MEMBERS_CHANNEL, on_membership_invalidated
+from services.ingest import ingestor
+from services.recent import RECENT_CHANNEL, on_recent_appended
+from services.users import PRINCIPAL_CHANNEL, on_principal_invalidated
+from websocket import bus, chat_manager, group_chat_manager
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await bus.start()
+    await bus.subscribe(PRINCIPAL_CHANNEL, on_principal_invalidated)
+    await bus.subscribe(GROUP_MEMBERS_CHANNEL, on_membership_invalidated)
+    await bus.subscribe(RECENT_CHANNEL, on_recent_appended)
+    await chat_manager.start()
+    await group_chat_manager.start()
+    if ingestor is not None:
+        await ingestor.start()
+    yield
+    if ingestor is not None:
+        await ingestor.stop()
+    await bus.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -16,11 +43,16 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(users, tags=["users"])
 app.include_router(chats, tags=["chats"])
 app.include_router(group_chats, tags=["group_chats"])
+app.include_router(scheduled, tags=["scheduled"])
+app.include_router(search, tags=["search"])
+if settings.METRICS_ENABLED:
+    app.include_router(metrics, tags=["metrics"])
 app.mount("/", StaticFiles(directory="frontend/static", html=True), name="static")
 app.mount("/styles", StaticFiles(directory="frontend/static/styles"), name="styles")
 
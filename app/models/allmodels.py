@@ -1,10 +1,25 @@
 from typing import Optional
 from sqlmodel import Enum, Relationship, SQLModel, Field
-from sqlalchemy import Column, String, ForeignKey
+from sqlalchemy import Column, Computed, DateTime, String, ForeignKey, Index, text
 from uuid import uuid4, UUID
 from datetime import datetime, timezone
 from sqlalchemy.dialects.postgresql import UUID as saUUID
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, TSVECTOR
+
+
+# Колонки времени - timestamp without time zone (sa_type=DateTime(), как в
+# миграциях), значения в них в UTC. asyncpg не принимает для таких колонок
+# время с часовым поясом, поэтому все время, которое пишется в базу, берется
+# отсюда
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# время, пришедшее извне (очередь, курсор), в том виде, в каком оно в базе
+def as_stored(value: datetime) -> datetime:
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
 
 class Role(str, Enum):
@@ -17,7 +32,8 @@ class User(SQLModel, table=True):
     __tablename__ = "Users"
 
     id: UUID = Field(
-        default_factory=uuid4, sa_column=Column(primary_key=True, index=True)
+        default_factory=uuid4,
+        sa_column=Column(saUUID(as_uuid=True), primary_key=True, index=True),
     )
     username: str = Field(sa_column=Column("username", String, unique=True, index=True))
     email: str = Field(sa_column=Column("email", String, unique=True, index=True))
@@ -30,6 +46,8 @@ class User(SQLModel, table=True):
 
 class Chat(SQLModel, table=True):
     __tablename__ = "Chats"
+    # обслуживает users @> ARRAY[...] и users = ARRAY[...], но не = ANY(users)
+    __table_args__ = (Index("ix_Chats_users", "users", postgresql_using="gin"),)
 
     id: UUID = Field(default_factory=uuid4, primary_key=True, index=True)
     users: list[UUID] = Field(sa_column=Column(ARRAY(saUUID(as_uuid=True))))
@@ -37,20 +55,37 @@ class Chat(SQLModel, table=True):
 
 class Message(SQLModel, table=True):
     __tablename__ = "Messages"
+    # история чата читается одним проходом по этому индексу; таблица
+    # секционирована по месяцам send_time (services/partitions.py), поэтому он
+    # входит в первичный ключ
+    __table_args__ = (
+        Index("ix_Messages_chat_id_send_time_id", "chat_id", "send_time", "id"),
+        {"postgresql_partition_by": "RANGE (send_time)"},
+    )
     id: UUID = Field(default_factory=uuid4, primary_key=True, index=True)
+    chat_id: UUID = Field(
+        sa_column=Column(
+            saUUID(as_uuid=True),
+            ForeignKey("Chats.id", ondelete="CASCADE"),
+            nullable=False,
+        )
+    )
     sender: UUID = Field(sa_column=Column(saUUID(as_uuid=True), ForeignKey("Users.id")))
-    send_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    send_time: datetime = Field(
+        default_factory=utcnow, primary_key=True, sa_type=DateTime()
+    )
     text: str
     user2: UUID
 
 
 class RefreshToken(SQLModel, table=True):
     __tablename__ = "RefreshToken"
+    __table_args__ = (Index("ix_RefreshToken_user_id", "user_id"),)
     id: Optional[UUID] = Field(default_factory=uuid4, primary_key=True)
     user_id: UUID = Field(foreign_key="Users.id")
     token: str
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
-    expires_at: datetime
+    created_at: datetime = Field(default_factory=utcnow, sa_type=DateTime())
+    expires_at: datetime = Field(sa_type=DateTime())
 
 
 class GroupChat(SQLModel, table=True):
@@ -60,11 +95,17 @@ class GroupChat(SQLModel, table=True):
     owner_id: UUID = Field(
         sa_column=Column(saUUID(as_uuid=True), ForeignKey("Users.id"))
     )
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    created_at: datetime = Field(default_factory=utcnow, sa_type=DateTime())
 
 
 class GroupChatMembers(SQLModel, table=True):
     __tablename__ = "GroupChatMembers"
+    __table_args__ = (
+        Index(
+            "ux_GroupChatMembers_group_id_user_id", "group_id", "user_id", unique=True
+        ),
+        Index("ix_GroupChatMembers_user_id", "user_id"),
+    )
     id: UUID = Field(default_factory=uuid4, primary_key=True)
     group_id: UUID = Field(
         sa_column=Column(
@@ -77,17 +118,123 @@ class GroupChatMembers(SQLModel, table=True):
         )
     )
     role: str = Field(default=Role.member)
+    # участник видит сообщения группы, отправленные после вступления
+    joined_at: datetime = Field(default_factory=utcnow, sa_type=DateTime())
+    # время последнего сообщения, полученного и прочитанного участником
+    last_delivered_at: Optional[datetime] = Field(default=None, sa_type=DateTime())
+    last_read_at: Optional[datetime] = Field(default=None, sa_type=DateTime())
 
 
 class GroupMessage(SQLModel, table=True):
     __tablename__ = "GroupMessages"
+    __table_args__ = (
+        Index("ix_GroupMessages_group_id_send_time_id", "group_id", "send_time", "id"),
+        {"postgresql_partition_by": "RANGE (send_time)"},
+    )
     id: UUID = Field(default_factory=uuid4, primary_key=True, index=True)
     sender: UUID = Field(sa_column=Column(saUUID(as_uuid=True), ForeignKey("Users.id")))
-    send_time: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    send_time: datetime = Field(
+        default_factory=utcnow, primary_key=True, sa_type=DateTime()
+    )
     text: str
     group_id: UUID = Field(
         sa_column=Column(
             saUUID(as_uuid=True), ForeignKey("GroupChat.id", ondelete="CASCADE")
         )
     )
-    recipients: list[UUID] = Field(sa_column=Column(ARRAY(saUUID(as_uuid=True))))
+
+
+# Поисковый вектор текста сообщения: русская и английская морфология сразу.
+# Колонка вычисляется базой и есть только в таблице, не в модели, поэтому
+# история ее не загружает; читает ее поиск (services/search.py).
+SEARCH_VECTOR = "to_tsvector('russian', text) || to_tsvector('english', text)"
+for _table in (Message.__table__, GroupMessage.__table__):
+    _table.append_column(
+        Column("search", TSVECTOR, Computed(SEARCH_VECTOR, persisted=True))
+    )
+    Index(f"ix_{_table.name}_search", _table.c.search, postgresql_using="gin")
+
+
+class ScheduledStatus:
+    pending = "pending"
+    sent = "sent"
+    cancelled = "cancelled"
+    failed = "failed"
+
+
+# Отложенное сообщение ждет своего времени здесь, а не в памяти воркера
+# Celery. Доставленное сообщение получает тот же id, что и отложенное.
+class ScheduledMessage(SQLModel, table=True):
+    __tablename__ = "ScheduledMessages"
+    __table_args__ = (
+        # планировщик выбирает только ожидающие сообщения по времени
+        Index(
+            "ix_ScheduledMessages_pending_due_at",
+            "due_at",
+            postgresql_where=text("status = 'pending'"),
+        ),
+        Index("ix_ScheduledMessages_sender_due_at", "sender", "due_at"),
+    )
+    id: UUID = Field(default_factory=uuid4, primary_key=True)
+    sender: UUID = Field(
+        sa_column=Column(
+            saUUID(as_uuid=True),
+            ForeignKey("Users.id", ondelete="CASCADE"),
+            nullable=False,
+        )
+    )
+    # заполнено либо chat_id с recipient_id (личный чат), либо group_id
+    chat_id: Optional[UUID] = Field(
+        default=None,
+        sa_column=Column(
+            saUUID(as_uuid=True), ForeignKey("Chats.id", ondelete="CASCADE")
+        ),
+    )
+    recipient_id: Optional[UUID] = None
+    group_id: Optional[UUID] = Field(
+        default=None,
+        sa_column=Column(
+            saUUID(as_uuid=True), ForeignKey("GroupChat.id", ondelete="CASCADE")
+        ),
+    )
+    text: str
+    due_at: datetime = Field(sa_type=DateTime())
+    created_at: datetime = Field(default_factory=utcnow, sa_type=DateTime())
+    status: str = Field(default=ScheduledStatus.pending)
+
+
+# Счетчик непрочитанных сообщений пользователя в переписке: заполнено либо
+# chat_id (личный чат), либо group_id. Увеличивается в той же транзакции, что
+# и запись сообщений (services/unread.py), и пересчитывается при прочтении.
+# Индексы не включают unread и last_read_at, чтобы обновления счетчика
+# оставались HOT и не трогали индексы.
+class UnreadCounter(SQLModel, table=True):
+    __tablename__ = "UnreadCounters"
+    __table_args__ = (
+        Index("ux_UnreadCounters_user_id_chat_id", "user_id", "chat_id", unique=True),
+        Index("ux_UnreadCounters_user_id_group_id", "user_id", "group_id", unique=True),
+    )
+    id: UUID = Field(default_factory=uuid4, primary_key=True)
+    user_id: UUID = Field(
+        sa_column=Column(
+            saUUID(as_uuid=True),
+            ForeignKey("Users.id", ondelete="CASCADE"),
+            nullable=False,
+        )
+    )
+    chat_id: Optional[UUID] = Field(
+        default=None,
+        sa_column=Column(
+            saUUID(as_uuid=True), ForeignKey("Chats.id", ondelete="CASCADE")
+        ),
+    )
+    group_id: Optional[UUID] = Field(
+        default=None,
+        sa_column=Column(
+            saUUID(as_uuid=True), ForeignKey("GroupChat.id", ondelete="CASCADE")
+        ),
+    )
+    unread: int = 0
+    # до какого сообщения прочитана переписка; в группах то же значение
+    # хранится водяным знаком участника GroupChatMembers.last_read_at
+    last_read_at: Optional[datetime] = Field(default=None, sa_type=DateTime())
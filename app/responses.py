@@ -0,0 +1,20 @@
+# Ответы со списками сообщений. Обработчики собирают словари прямо из
+# выбранных колонок и отдают готовый ответ: FastAPI не проверяет их второй
+# раз по response_model (он остается для документации), а orjson кодирует
+# UUID и datetime сам (UUID asyncpg - через default=str). Время в UTC
+# выводится с Z, как у pydantic, поэтому ответы не меняются.
+
+import orjson
+from fastapi import Response
+from fastapi.responses import ORJSONResponse
+
+
+class MessagesResponse(ORJSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str, option=orjson.OPT_UTC_Z)
+
+
+# заголовки (ETag, X-Next-Cursor), выставленные на response обработчика,
+# FastAPI в собственный ответ не переносит
+def messages_response(content: list, response: Response) -> MessagesResponse:
+    return MessagesResponse(content, headers=dict(response.headers))
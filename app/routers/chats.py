@@ -1,68 +1,163 @@
 import asyncio
-from datetime import datetime, timedelta
+import logging
+from datetime import timedelta
+from functools import partial
 from uuid import UUID
 from fastapi import (
     APIRouter,
     Body,
     Depends,
     HTTPException,
+    Query,
     Request,
+    Response,
     WebSocket,
-    WebSocketDisconnect,
     status,
 )
-from typing import Annotated, Dict, List
-from fastapi.responses import HTMLResponse
-from sqlmodel import Session, select
-from db import get_session
-from models.allmodels import User, Chat
+from typing import Annotated, List
+from pydantic import ValidationError
+from fastapi.responses import FileResponse, HTMLResponse
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from db import async_session_maker, get_async_session
+from models.allmodels import User, Chat, ScheduledMessage, utcnow
+from schemas.chats import ChatContact, UnreadCount
 from schemas.users import UserOut
-from schemas.messages import MessageCreate, Message
-from services.users import get_current_user, get_user_by_name
+from schemas.messages import (
+    MessageBulkCreate,
+    MessageBulkResult,
+    MessageCreate,
+    MessageSent,
+    Message,
+)
+from services.users import get_current_user, get_user_by_name, get_websocket_user
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import and_, any_, or_
 from models.allmodels import Message as ModelMessage
-from services.celery_service import send_message_later
+from services.chats import contacts_query, get_direct_chat_id, get_direct_chat_ids
+from services.history import get_history
+from services.bulk_writer import insert_messages, to_item
+from services.ingest import QUEUED, STORED, save_message, sent_status
+from services.recent import recent_history, remember_messages
+from services.unread import read_until_query, reset_unread, unread_query
+from config import settings
+from responses import MessagesResponse, messages_response
+from websocket import Connection, chat_manager as manager, serve
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
-# Активные WebSocket-подключения: {user_id: websocket}
-active_connections: Dict[int, WebSocket] = {}
+# WebSocket эндпоинт для соединений. Пользователь определяется один раз при
+# подключении по тому же JWT, что и в get_current_user
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    user = await get_websocket_user(websocket)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    # Принимаем WebSocket-соединение
+    await websocket.accept()
+    await serve(manager, websocket, user.id, partial(handle_frame, user.id))
 
 
-# Функция для отправки сообщения пользователю, если он подключен
-async def notify_user(user_id: UUID, message: dict):
-    user_id = str(user_id)
-    if user_id in active_connections:
-        websocket = active_connections[user_id]
-        await websocket.send_json(message)
+# Отправка сообщения прямо по сокету: {"type": "message", "client_id": ...,
+# "recipient_id": ..., "content": ...}. В ответ приходит ack с id и временем
+# сохраненного сообщения или error с тем же client_id.
+async def handle_frame(user_id: UUID, connection: Connection, frame: dict):
+    if frame.get("type") != "message":
+        return
+    client_id = frame.get("client_id")
+    try:
+        message = MessageCreate.model_validate(frame)
+        async with async_session_maker() as session:
+            db_message, saved = await deliver_message(
+                session, user_id, message.recipient_id, message.content
+            )
+    except ValidationError:
+        connection.send_json(
+            {
+                "type": "error",
+                "client_id": client_id,
+                "detail": "Некорректное сообщение",
+            }
+        )
+        return
+    except HTTPException as e:
+        connection.send_json(
+            {"type": "error", "client_id": client_id, "detail": e.detail}
+        )
+        return
+    # ошибка записи не должна закрывать сокет: клиент получает error и может
+    # повторить отправку
+    except Exception:
+        logger.exception("Не удалось отправить сообщение из сокета")
+        connection.send_json(
+            {
+                "type": "error",
+                "client_id": client_id,
+                "detail": "Не удалось отправить сообщение",
+            }
+        )
+        return
+    connection.send_json(
+        {
+            "type": "ack",
+            "client_id": client_id,
+            "id": db_message.id,
+            "send_time": db_message.send_time,
+            "status": sent_status(saved),
+        }
+    )
 
 
-# WebSocket эндпоинт для соединений
-@router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: UUID):
-    # Принимаем WebSocket-соединение
-    await websocket.accept()
-    # Сохраняем активное соединение для пользователя
-    active_connections[user_id] = websocket
-    try:
-        while True:
-            # Просто поддерживаем соединение активным (1 секунда паузы)
-            await asyncio.sleep(1)
-    except WebSocketDisconnect:
-        # Удаляем пользователя из активных соединений при отключении
-        active_connections.pop(user_id, None)
+# Получатель должен существовать: иначе запись счетчика непрочитанных
+# (UnreadCounters.user_id ссылается на Users) упадет на внешнем ключе
+async def require_recipient(session: AsyncSession, recipient_id: UUID):
+    stmt = select(User.id).where(User.id == recipient_id)
+    if (await session.exec(stmt)).first() is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Пользователь не найден"
+        )
+
+
+# Сохраняем сообщение и уведомляем получателя и отправителя через WebSocket.
+# Отложенное в файл очереди сообщение не рассылается: в базе его еще нет
+async def deliver_message(
+    session: AsyncSession, sender_id: UUID, recipient_id: UUID, content: str
+):
+    await require_recipient(session, recipient_id)
+    chat_id = await get_direct_chat_id(sender_id, recipient_id, session, create=True)
+    db_message = ModelMessage(
+        chat_id=chat_id, user2=recipient_id, text=content, sender=sender_id
+    )
+    saved = await save_message(session, db_message)
+    if saved != STORED:
+        return db_message, saved
+    await remember_messages([db_message])
+    await manager.notify_users([recipient_id, sender_id], message_payload(db_message))
+    return db_message, saved
+
+
+# то, что получают по WebSocket собеседники
+def message_payload(message: ModelMessage) -> dict:
+    return {
+        "id": message.id,
+        "chat_id": message.chat_id,
+        "sender_id": message.sender,
+        "recipient_id": message.user2,
+        "content": message.text,
+        "send_time": message.send_time,
+    }
 
 
 @router.post("/create_chat")
 async def create_chat(
     current_user: Annotated[UserOut, Depends(get_current_user)],
     user2_username: str = Body(..., embed=True),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    user1 = session.get(User, current_user.id)
-    user2 = get_user_by_name(username=user2_username, session=session)
+    user1 = current_user
+    user2 = await get_user_by_name(username=user2_username, session=session)
 
     if user2 is None:
         raise HTTPException(
@@ -71,7 +166,7 @@ async def create_chat(
     users_list = sorted([user1.id, user2.id])
 
     stmt = select(Chat).where(Chat.users == users_list)
-    existing_chat = session.exec(stmt).first()
+    existing_chat = (await session.exec(stmt)).first()
     if existing_chat:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -80,97 +175,222 @@ async def create_chat(
 
     chat_db = Chat(users=users_list)
     session.add(chat_db)
-    session.commit()
-    session.refresh(chat_db)
+    await session.commit()
+    await session.refresh(chat_db)
     return chat_db
 
 
 templates = Jinja2Templates(directory="frontend/templates")
 
 
-@router.get("/chat", response_class=HTMLResponse, summary="Chat Page")
-async def get_chat_page(
-    request: Request,
+# Собеседники пользователя одним запросом
+@router.get("/chats", response_model=List[ChatContact])
+async def get_chats(
     user_data: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    query = select(Chat).where(user_data.id == any_(Chat.users))
-    result = session.exec(query)
-    chats = result.all()
-
-    users_list = []
-    unique_users = {}
-    for chat in chats:
-        if chat.users == [user_data.id, user_data.id]:
-            unique_users[user_data.id] = user_data
-        for user_id in chat.users:
-            if user_id != user_data.id:
-                user = session.get(User, user_id)
-                if user:
-                    unique_users[user.id] = user
-
-    users_list = list(unique_users.values())
+    rows = (await session.exec(contacts_query(user_data.id))).all()
+    return [{"id": user_id, "username": username} for user_id, username in rows]
 
-    return templates.TemplateResponse(
-        "chat.html",
-        {"request": request, "user": user_data, "users_all": users_list},
+
+# Страница не зависит от пользователя, поэтому отдается как статический файл,
+# а список чатов подгружается из /chats
+@router.get("/chat", response_class=FileResponse, summary="Chat Page")
+async def get_chat_page(user_data: User = Depends(get_current_user)):
+    return FileResponse("frontend/static/chat.html")
+
+
+# Рассылка многим получателям одним запросом. Получатели проверяются одним
+# запросом, недостающие чаты создаются одной вставкой, все сообщения
+# записываются одним многострочным INSERT, а уведомления уходят параллельно.
+# Ошибка в одном сообщении не мешает остальным.
+@router.post("/messages/bulk", response_model=List[MessageBulkResult])
+async def send_messages_bulk(
+    bulk: MessageBulkCreate,
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    items = bulk.items()
+    existing = set(
+        (
+            await session.exec(
+                select(User.id).where(
+                    User.id.in_({item.recipient_id for item in items})
+                )
+            )
+        ).all()
     )
+    chat_ids = await get_direct_chat_ids(current_user.id, existing, session)
+    results, messages = [], []
+    for item in items:
+        if item.recipient_id not in existing:
+            results.append(
+                MessageBulkResult(
+                    recipient_id=item.recipient_id,
+                    status="error",
+                    detail="Пользователь не найден",
+                )
+            )
+            continue
+        message = ModelMessage(
+            chat_id=chat_ids[item.recipient_id],
+            user2=item.recipient_id,
+            text=item.content,
+            sender=current_user.id,
+        )
+        messages.append(message)
+        results.append(
+            MessageBulkResult(
+                recipient_id=item.recipient_id, status="ok", id=message.id
+            )
+        )
+    if messages:
+        connection = await session.connection()
+        await connection.run_sync(insert_messages, [to_item(m) for m in messages])
+        await session.commit()
+        await remember_messages(messages)
+        await asyncio.gather(
+            *(
+                manager.notify_users([m.user2, m.sender], message_payload(m))
+                for m in messages
+            )
+        )
+    return results
+
+
+# Непрочитанные во всех переписках пользователя одним запросом по индексу
+@router.get("/unread", response_model=List[UnreadCount])
+async def get_unread(
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    rows = (await session.exec(unread_query(current_user.id))).all()
+    return [
+        {
+            "chat_id": chat_id,
+            "user_id": (
+                None
+                if users is None
+                else users[1] if users[0] == current_user.id else users[0]
+            ),
+            "group_id": group_id,
+            "unread": unread,
+            "last_read_at": last_read_at,
+        }
+        for chat_id, group_id, unread, last_read_at, users in rows
+    ]
+
+
+# Отмечает личный чат с user_id прочитанным до message_id включительно (или
+# весь)
+@router.post("/messages/read")
+async def read_messages(
+    user_id: UUID = Body(..., embed=True),
+    message_id: UUID | None = Body(None, embed=True),
+    current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    chat_id = await get_direct_chat_id(current_user.id, user_id, session)
+    if chat_id is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Чат не найден"
+        )
+    condition = ModelMessage.chat_id == chat_id
+    read_until = (
+        await session.exec(read_until_query(ModelMessage, condition, message_id))
+    ).first()
+    if read_until is None:
+        if message_id is not None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail="Сообщение не найдено"
+            )
+        return {"status_code": "200 ok", "read_until": None}
+    await reset_unread(
+        session,
+        current_user.id,
+        "chat_id",
+        chat_id,
+        ModelMessage,
+        condition,
+        read_until,
+    )
+    return {"status_code": "200 ok", "read_until": read_until}
 
 
-@router.get("/messages/{user_id}", response_model=List[Message])
+@router.get(
+    "/messages/{user_id}",
+    response_model=List[Message],
+    response_class=MessagesResponse,
+)
 async def get_messages(
     user_id: UUID,
+    request: Request,
+    response: Response,
+    before: str | None = None,
+    after: str | None = None,
+    after_id: UUID | None = None,
+    limit: int = Query(
+        settings.MESSAGES_PAGE_SIZE, ge=1, le=settings.MESSAGES_PAGE_MAX_SIZE
+    ),
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    query = select(ModelMessage).where(
-        or_(
-            and_(user_id == ModelMessage.sender, current_user.id == ModelMessage.user2),
-            and_(user_id == ModelMessage.user2, current_user.id == ModelMessage.sender),
-        )
+    chat_id = await get_direct_chat_id(current_user.id, user_id, session)
+    if chat_id is None:
+        return []
+    condition = ModelMessage.chat_id == chat_id
+    messages = await get_history(
+        session,
+        ModelMessage,
+        condition,
+        request,
+        response,
+        before=before,
+        after=after,
+        after_id=after_id,
+        limit=limit,
+        recent=partial(
+            recent_history.page,
+            ("direct", chat_id),
+            session,
+            ModelMessage,
+            condition,
+            limit,
+        ),
     )
-    result = session.exec(query)
-    messages = result.all()
+    if isinstance(messages, Response):
+        return messages
     messages_out = [
         {
-            "chat_id": str(message.id),
-            "sender_id": str(message.sender),
+            "id": message.id,
+            "chat_id": message.chat_id,
+            "sender_id": message.sender,
+            "send_time": message.send_time,
             "text": message.text,
-            "send_time": message.send_time.isoformat(),
-            "recipient_id": str(message.user2),
         }
         for message in messages
     ]
 
-    return messages_out
+    return messages_response(messages_out, response)
 
 
-@router.post("/messages", response_model=MessageCreate)
+@router.post("/messages", response_model=MessageSent)
 async def send_message(
     message: MessageCreate,
+    response: Response,
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    db_message = ModelMessage(
-        user2=message.recipient_id, text=message.content, sender=current_user.id
+    _, saved = await deliver_message(
+        session, current_user.id, message.recipient_id, message.content
     )
-    session.add(db_message)
-    session.commit()
-    session.refresh(db_message)
-    message_data = {
-        "sender_id": current_user.id,
-        "recipient_id": message.recipient_id,
-        "content": message.content,
-    }
-    # Уведомляем получателя и отправителя через WebSocket
-    await notify_user(message.recipient_id, message_data)
-    await notify_user(current_user.id, message_data)
+    if saved == QUEUED:
+        response.status_code = status.HTTP_202_ACCEPTED
 
     return {
         "recipient_id": message.recipient_id,
         "content": message.content,
-        "status": "ok",
-        "msg": "Message saved!",
+        "status": sent_status(saved),
     }
 
 
@@ -186,18 +406,24 @@ async def get_create_chat_page(
 
 
 @router.post("/messages_late")
-def send_message_late(
+async def send_message_late(
     message: MessageCreate,
     time: int = Body(..., embed=True),
     current_user: User = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    eta_time = datetime.utcnow() + timedelta(minutes=time)
-
-    message_data = {
-        "sender_id": current_user.id,
-        "recipient_id": message.recipient_id,
-        "content": message.content,
-    }
-
-    send_message_later.apply_async(args=[message_data], eta=eta_time)
-    return {"status": "scheduled", "send_time": eta_time}
+    await require_recipient(session, message.recipient_id)
+    due_at = utcnow() + timedelta(minutes=time)
+    chat_id = await get_direct_chat_id(
+        current_user.id, message.recipient_id, session, create=True
+    )
+    scheduled = ScheduledMessage(
+        sender=current_user.id,
+        chat_id=chat_id,
+        recipient_id=message.recipient_id,
+        text=message.content,
+        due_at=due_at,
+    )
+    session.add(scheduled)
+    await session.commit()
+    return {"status": "scheduled", "send_time": due_at, "id": scheduled.id}
@@ -1,29 +1,64 @@
-import asyncio
-from datetime import datetime, timedelta
+from datetime import timedelta
+from functools import partial
 import logging
-from typing import Annotated, Dict, List
+from typing import Annotated, List
 from uuid import UUID
 from fastapi import (
     APIRouter,
     Depends,
     HTTPException,
+    Query,
     Request,
+    Response,
     WebSocket,
-    WebSocketDisconnect,
+    status,
 )
 from fastapi import Body
+from pydantic import ValidationError
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from sqlalchemy import and_, select
-from sqlmodel import Session
-
-from db import get_session
-from schemas.messages import GroupMessagesCreate, GroupMessageRead
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db import async_session_maker, get_async_session
+from schemas.messages import (
+    GroupMessageDelivered,
+    GroupMessagesCreate,
+    GroupMessageRead,
+    GroupMessageSent,
+)
 from schemas.users import UserOut
-from services.celery_service import send_message_later_group
-from services.users import get_current_user, get_user_by_id, get_user_by_name
-from schemas.chats import GroupChatCreate, GroupChatOut, GroupChat
-from models.allmodels import GroupChatMembers, GroupMessage, Role, User
+from services.history import get_history
+from services.ingest import QUEUED, STORED, save_message, sent_status
+from services.recent import recent_history, remember_messages
+from services.unread import drop_unread, read_until_query, reset_unread
+from services.groupchats import (
+    advance_delivered,
+    advance_watermark,
+    invalidate_membership,
+    require_member,
+)
+from config import settings
+from responses import MessagesResponse, messages_response
+from websocket import Connection, group_chat_manager as manager, serve
+from services.users import (
+    get_current_user,
+    get_user_by_id,
+    get_user_by_name,
+    get_websocket_user,
+)
+from schemas.chats import GroupChatCreate, GroupChatOut
+from models.allmodels import (
+    GroupChat,
+    GroupChatMembers,
+    GroupMessage,
+    Role,
+    ScheduledMessage,
+    User,
+    utcnow,
+)
 
 router = APIRouter(prefix="/group_chats")
 templates = Jinja2Templates(directory="frontend/templates")
@@ -31,74 +66,152 @@ logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def get_chat_members(
+async def get_chat_members(
     chat_id: str,
     current_user: UserOut,
-    session: Session,
+    session: AsyncSession,
 ):
-    chat = session.exec(select(GroupChat).where(GroupChat.id == chat_id)).scalar()
-    if chat is None:
-        raise HTTPException(status_code=404, detail="Чат не найден")
-    cur_user_in_chat = session.exec(
-        select(GroupChatMembers).where(
-            and_(GroupChatMembers.user_id == current_user.id),
-            (GroupChatMembers.group_id == chat_id),
-        )
-    ).scalar_one_or_none()
-    if cur_user_in_chat is None:
-        raise HTTPException(status_code=422, detail="Вы не состоите в данном чате")
-
-    members = session.exec(
-        select(GroupChatMembers).where(GroupChatMembers.group_id == chat_id)
-    ).scalars()
-
-    members = [
-        get_user_by_id(member.user_id, session=session).username for member in members
-    ]
-    return members
-
+    membership = await require_member(chat_id, current_user.id, session)
+    return [member.username for member in membership.members.values()]
 
-active_connections: Dict[int, WebSocket] = {}
 
-
-async def notify_user(user_id: UUID, message: dict):
-    user_id = str(user_id)
-    if user_id in active_connections:
-        websocket = active_connections[user_id]
-        await websocket.send_json(message)
+@router.websocket("/ws")
+async def websocket_endpoint(websocket: WebSocket):
+    user = await get_websocket_user(websocket)
+    if user is None:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    await serve(manager, websocket, user.id, partial(handle_frame, user))
+
+
+# Отправка сообщения прямо по сокету: {"type": "message", "client_id": ...,
+# "chat_id": ..., "text": ...}. В ответ приходит ack или error с тем же client_id.
+# Полученные сообщения клиент подтверждает кадром {"type": "delivered", ...}.
+async def handle_frame(user: User, connection: Connection, frame: dict):
+    if frame.get("type") == "delivered":
+        await mark_delivered(user, frame)
+        return
+    if frame.get("type") != "message":
+        return
+    client_id = frame.get("client_id")
+    try:
+        message = GroupMessagesCreate.model_validate(frame)
+        async with async_session_maker() as session:
+            db_message, saved = await deliver_message(
+                session, user, message.chat_id, message.text
+            )
+    except ValidationError:
+        connection.send_json(
+            {
+                "type": "error",
+                "client_id": client_id,
+                "detail": "Некорректное сообщение",
+            }
+        )
+        return
+    except HTTPException as e:
+        connection.send_json(
+            {"type": "error", "client_id": client_id, "detail": e.detail}
+        )
+        return
+    # ошибка записи не должна закрывать сокет: клиент получает error и может
+    # повторить отправку
+    except Exception:
+        logger.exception("Не удалось отправить сообщение из сокета")
+        connection.send_json(
+            {
+                "type": "error",
+                "client_id": client_id,
+                "detail": "Не удалось отправить сообщение",
+            }
+        )
+        return
+    connection.send_json(
+        {
+            "type": "ack",
+            "client_id": client_id,
+            "id": db_message.id,
+            "send_time": db_message.send_time,
+            "status": sent_status(saved),
+        }
+    )
 
 
-@router.websocket("/ws/{user_id}")
-async def websocket_endpoint(websocket: WebSocket, user_id: UUID):
-    await websocket.accept()
-    active_connections[user_id] = websocket
+# Подтверждение получения: {"type": "delivered", "chat_id": ...,
+# "message_id": ...}. Двигает водяной знак доставки участника до этого
+# сообщения; ответа нет, некорректные подтверждения пропускаются.
+async def mark_delivered(user: User, frame: dict):
     try:
-        while True:
-            await asyncio.sleep(1)
-    except WebSocketDisconnect:
-        active_connections.pop(user_id, None)
+        delivered = GroupMessageDelivered.model_validate(frame)
+        async with async_session_maker() as session:
+            membership = await require_member(delivered.chat_id, user.id, session)
+            condition = and_(
+                GroupMessage.group_id == delivered.chat_id,
+                GroupMessage.send_time >= membership.members[user.id].joined_at,
+            )
+            send_time = (
+                await session.exec(
+                    read_until_query(GroupMessage, condition, delivered.message_id)
+                )
+            ).first()
+            if send_time is not None:
+                await advance_delivered(delivered.chat_id, user.id, send_time, session)
+    except (ValidationError, HTTPException):
+        return
+    except Exception:
+        logger.exception("Не удалось отметить доставку сообщения")
+
+
+# Сохраняем сообщение в группе и рассылаем его участникам (если оно уже в
+# базе, а не отложено в файл очереди)
+async def deliver_message(
+    session: AsyncSession, sender: User, chat_id: UUID, text: str
+):
+    # получатели - текущие участники группы, в самом сообщении они не хранятся
+    recipients = list((await require_member(chat_id, sender.id, session)).members)
+    db_message = GroupMessage(
+        group_id=chat_id,
+        text=text,
+        sender=sender.id,
+    )
+    saved = await save_message(session, db_message)
+    if saved != STORED:
+        return db_message, saved
+    await remember_messages([db_message])
+    message_data = {
+        "id": db_message.id,
+        "sender_id": sender.id,
+        "chat_id": chat_id,
+        "text": text,
+        "send_time": db_message.send_time,
+    }
+    await manager.notify_users([*recipients, sender.id], message_data)
+    return db_message, saved
 
 
 @router.post("/create", response_model=GroupChatOut)
-def create_chat(
+async def create_chat(
     current_user: Annotated[UserOut, Depends(get_current_user)],
     chat: GroupChatCreate,
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    members_list = [
-        get_user_by_name(user, session=session) for user in list(set(chat.members))
-    ]
-    if None in members_list:
+    usernames = set(chat.members)
+    members_list = (
+        await session.exec(select(User.id).where(User.username.in_(usernames)))
+    ).all()
+    if len(members_list) != len(usernames):
         raise HTTPException(
             status_code=404, detail="Пользователь из списка участников группы не найден"
         )
-    members_list = sorted([member.id for member in members_list])
-    current_user = get_user_by_name(current_user.username, session=session).id
+    # создатель добавляется отдельно, с ролью owner
+    members_list = sorted(m for m in members_list if m != current_user.id)
+    current_user = current_user.id
     members_list.append(current_user)
     chat_db = GroupChat(title=chat.title, owner_id=current_user)
     session.add(chat_db)
-    session.commit()
-    session.refresh(chat_db)
+    await session.commit()
+    await session.refresh(chat_db)
     for member in members_list:
         if member != current_user:
             member_db = GroupChatMembers(group_id=chat_db.id, user_id=member)
@@ -107,42 +220,49 @@ def create_chat(
                 group_id=chat_db.id, user_id=member, role=Role.owner
             )
         session.add(member_db)
-        session.commit()
+    await session.commit()
+    await invalidate_membership(chat_db.id)
 
     return GroupChatOut(owner_id=current_user, title=chat.title, members=members_list)
 
 
 @router.post("/add_member")
-def add_member(
+async def add_member(
     current_user: Annotated[UserOut, Depends(get_current_user)],
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
     chat_id: str = Body(..., embed=True),
     new_user: str = Body(..., embed=True),
 ):
-    chat = session.exec(select(GroupChat).where(GroupChat.id == chat_id)).first()
+    chat = (
+        await session.exec(select(GroupChat).where(GroupChat.id == chat_id))
+    ).first()
     if chat is None:
         raise HTTPException(status_code=404, detail="Чат не найден")
     if current_user is None:
         raise HTTPException(status_code=401, detail="Вы не авторизованы")
-    cur_user_in_chat = session.exec(
-        select(GroupChatMembers).where(
-            and_(GroupChatMembers.user_id == current_user.id),
-            (GroupChatMembers.group_id == chat_id),
+    cur_user_in_chat = (
+        await session.exec(
+            select(GroupChatMembers).where(
+                and_(GroupChatMembers.user_id == current_user.id),
+                (GroupChatMembers.group_id == chat_id),
+            )
         )
     ).first()
     if cur_user_in_chat is None:
         raise HTTPException(status_code=422, detail="Вы не состоите в данном чате")
-    new_user = get_user_by_name(new_user, session=session)
+    new_user = await get_user_by_name(new_user, session=session)
     if new_user is None:
         raise HTTPException(
             status_code=404,
             detail="Пользователя, которого вы хотите добавить не существует",
         )
-    exists = session.exec(
-        select(GroupChatMembers).where(
-            and_(
-                GroupChatMembers.user_id == new_user.id,
-                GroupChatMembers.group_id == chat_id,
+    exists = (
+        await session.exec(
+            select(GroupChatMembers).where(
+                and_(
+                    GroupChatMembers.user_id == new_user.id,
+                    GroupChatMembers.group_id == chat_id,
+                )
             )
         )
     ).first()
@@ -150,175 +270,174 @@ def add_member(
         raise HTTPException(status_code=409, detail="Пользователь уже в чате")
     member = GroupChatMembers(group_id=chat_id, user_id=new_user.id, role=Role.member)
     session.add(member)
-    session.commit()
+    try:
+        await session.commit()
+    except IntegrityError:
+        # параллельный запрос успел добавить того же пользователя
+        await session.rollback()
+        raise HTTPException(status_code=409, detail="Пользователь уже в чате")
+    await invalidate_membership(chat_id)
 
     return {"status_code": "200 ok", "detail": "Пользователь добавлен"}
 
 
 @router.delete("/delete_member")
-def delete_member(
+async def delete_member(
     chat_id: str = Body(..., embed=True),
     current_user: UserOut = Depends(get_current_user),
     member_name: str = Body(..., embed=True),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    chat = session.exec(select(GroupChat).where(GroupChat.id == chat_id)).first()
+    chat = (
+        await session.exec(select(GroupChat).where(GroupChat.id == chat_id))
+    ).first()
 
     if chat is None:
         raise HTTPException(status_code=404, detail="Чат не найден")
     if current_user is None:
         raise HTTPException(status_code=401, detail="Вы не авторизованы")
-    cur_user_in_chat = session.exec(
-        select(GroupChatMembers).where(
-            and_(GroupChatMembers.user_id == current_user.id),
-            (GroupChatMembers.group_id == chat_id),
+    cur_user_in_chat = (
+        await session.exec(
+            select(GroupChatMembers).where(
+                and_(GroupChatMembers.user_id == current_user.id),
+                (GroupChatMembers.group_id == chat_id),
+            )
         )
-    ).scalar_one_or_none()
+    ).one_or_none()
     if cur_user_in_chat is None:
         raise HTTPException(status_code=422, detail="Вы не состоите в данном чате")
     if cur_user_in_chat.role not in (Role.admin, Role.owner):
         raise HTTPException(status_code=403, detail="Недостаточно првв")
-    del_user = get_user_by_name(member_name, session=session)
+    del_user = await get_user_by_name(member_name, session=session)
     if del_user is None:
         raise HTTPException(
             status_code=404,
             detail="Пользователя, которого вы хотите удалить не существует",
         )
-    exists = session.exec(
-        select(GroupChatMembers).where(
-            and_(
-                GroupChatMembers.user_id == del_user.id,
-                GroupChatMembers.group_id == chat_id,
+    exists = (
+        await session.exec(
+            select(GroupChatMembers).where(
+                and_(
+                    GroupChatMembers.user_id == del_user.id,
+                    GroupChatMembers.group_id == chat_id,
+                )
             )
         )
-    ).scalar_one_or_none()
+    ).one_or_none()
     if not exists:
         raise HTTPException(
             status_code=409,
             detail="Пользователя, которого вы хотите удалить, нет в чате",
         )
 
-    session.delete(exists)
-    session.commit()
+    await session.delete(exists)
+    await drop_unread(session, del_user.id, chat_id)
+    await session.commit()
+    await invalidate_membership(chat_id)
 
     return {"status_code": "200 ok", "detail": "Пользователь удален"}
 
 
 @router.delete("/exit")
-def exit(
+async def exit(
     chat_id: str = Body(..., embed=True),
     current_user: UserOut = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    chat = session.exec(select(GroupChat).where(GroupChat.id == chat_id)).first()
+    chat = (
+        await session.exec(select(GroupChat).where(GroupChat.id == chat_id))
+    ).first()
 
     if chat is None:
         raise HTTPException(status_code=404, detail="Чат не найден")
     if current_user is None:
         raise HTTPException(status_code=401, detail="Вы не авторизованы")
-    cur_user_in_chat = session.exec(
-        select(GroupChatMembers).where(
-            and_(GroupChatMembers.user_id == current_user.id),
-            (GroupChatMembers.group_id == chat_id),
+    cur_user_in_chat = (
+        await session.exec(
+            select(GroupChatMembers).where(
+                and_(GroupChatMembers.user_id == current_user.id),
+                (GroupChatMembers.group_id == chat_id),
+            )
         )
-    ).scalar_one_or_none()
+    ).one_or_none()
     if cur_user_in_chat is None:
         raise HTTPException(status_code=422, detail="Вы не состоите в данном чате")
 
-    session.delete(cur_user_in_chat)
-    session.commit()
+    await session.delete(cur_user_in_chat)
+    await drop_unread(session, current_user.id, chat_id)
+    await session.commit()
+    await invalidate_membership(chat_id)
 
     return {"status_code": "200 ok", "detail": "Вы вышли из чата"}
 
 
 @router.post("/group_members")
-def get_members(
+async def get_members(
     chat_id: str = Body(..., embed=True),
     current_user: UserOut = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    return get_chat_members(chat_id=chat_id, current_user=current_user, session=session)
+    return await get_chat_members(
+        chat_id=chat_id, current_user=current_user, session=session
+    )
 
 
-@router.post("/messages", response_model=GroupMessagesCreate)
+@router.post("/messages", response_model=GroupMessageSent)
 async def send_message(
     message: GroupMessagesCreate,
+    response: Response,
     current_user: UserOut = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    recipients = [
-        get_user_by_name(rec, session=session).id
-        for rec in get_chat_members(
-            chat_id=message.chat_id, current_user=current_user, session=session
-        )
-    ]
-    db_message = GroupMessage(
-        group_id=message.chat_id,
-        recipients=recipients,
-        text=message.text,
-        sender=current_user.id,
+    _, saved = await deliver_message(
+        session, current_user, message.chat_id, message.text
     )
-    session.add(db_message)
-    session.commit()
-    session.refresh(db_message)
-    message_data = {
-        "sender_id": current_user.id,
-        "chat_id": message.chat_id,
-        "text": message.text,
-    }
-    for user in recipients:
-        await notify_user(user, message_data)
-    await notify_user(current_user.id, message_data)
+    if saved == QUEUED:
+        response.status_code = status.HTTP_202_ACCEPTED
 
     return {
         "chat_id": message.chat_id,
         "text": message.text,
-        "status": "ok",
-        "msg": "Message saved!",
+        "status": sent_status(saved),
     }
 
 
 @router.post("/messages_late")
-def send_message_late(
+async def send_message_late(
     message: GroupMessagesCreate,
     time: int = Body(..., embed=True),
     current_user: UserOut = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    eta_time = datetime.utcnow() + timedelta(minutes=time)
-    recipients = [
-        str(get_user_by_name(rec, session=session).id)
-        for rec in get_chat_members(
-            chat_id=message.chat_id, current_user=current_user, session=session
-        )
-    ]
-    message_data = {
-        "sender": current_user.id,
-        "recipients": recipients,
-        "text": message.text,
-        "group_id": message.chat_id,
-    }
-
-    send_message_later_group.apply_async(args=[message_data], eta=eta_time)
-    return {"status": "scheduled", "send_time": eta_time}
+    due_at = utcnow() + timedelta(minutes=time)
+    await require_member(message.chat_id, current_user.id, session)
+    scheduled = ScheduledMessage(
+        sender=current_user.id,
+        group_id=message.chat_id,
+        text=message.text,
+        due_at=due_at,
+    )
+    session.add(scheduled)
+    await session.commit()
+    return {"status": "scheduled", "send_time": due_at, "id": scheduled.id}
 
 
 @router.get("/chat", response_class=HTMLResponse, summary="Chat Page")
 async def get_chat_page(
     request: Request,
     user_data: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     query = select(GroupChatMembers).where(GroupChatMembers.user_id == user_data.id)
-    result = session.exec(query)
-    memberships = result.scalars()
+    result = await session.exec(query)
+    memberships = result.all()
 
     group_ids = [m.group_id for m in memberships]
     chats = []
     if group_ids:
-        chats = session.exec(
-            select(GroupChat).where(GroupChat.id.in_(group_ids))
-        ).scalars()
+        chats = (
+            await session.exec(select(GroupChat).where(GroupChat.id.in_(group_ids)))
+        ).all()
     chats_dicts = [{"id": str(chat.id), "title": chat.title} for chat in chats]
     return templates.TemplateResponse(
         "group_chat.html",
@@ -332,37 +451,112 @@ async def get_chat_page(
     )
 
 
-@router.get("/messages/{group_id}", response_model=List[GroupMessageRead])
+@router.get(
+    "/messages/{group_id}",
+    response_model=List[GroupMessageRead],
+    response_class=MessagesResponse,
+)
 async def get_messages(
     group_id: UUID,
+    request: Request,
+    response: Response,
+    before: str | None = None,
+    after: str | None = None,
+    after_id: UUID | None = None,
+    limit: int = Query(
+        settings.MESSAGES_PAGE_SIZE, ge=1, le=settings.MESSAGES_PAGE_MAX_SIZE
+    ),
     current_user: User = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    query = select(GroupMessage).where(GroupMessage.group_id == group_id)
-    result = session.exec(query)
-    messages = result.scalars()
+    membership = await require_member(group_id, current_user.id, session)
+    # сообщения, отправленные до вступления в группу, участнику не видны
+    joined_at = membership.members[current_user.id].joined_at
+    messages = await get_history(
+        session,
+        GroupMessage,
+        and_(GroupMessage.group_id == group_id, GroupMessage.send_time >= joined_at),
+        request,
+        response,
+        before=before,
+        after=after,
+        after_id=after_id,
+        limit=limit,
+        # буфер общий для всех участников, поэтому в нем вся группа, а
+        # сообщения до вступления отсекаются при выдаче
+        recent=partial(
+            recent_history.page,
+            ("group", group_id),
+            session,
+            GroupMessage,
+            GroupMessage.group_id == group_id,
+            limit,
+            since=joined_at,
+        ),
+    )
+    if isinstance(messages, Response):
+        return messages
     messages_out = [
         {
-            "chat_id": str(message.group_id),
-            "sender_id": str(message.sender),
+            "id": message.id,
+            "chat_id": message.group_id,
             "text": message.text,
-            "send_time": message.send_time.isoformat(),
-            "recipients": message.recipients,
+            "sender_id": message.sender,
+            "send_time": message.send_time,
         }
         for message in messages
     ]
 
-    return messages_out
+    return messages_response(messages_out, response)
+
+
+# Отмечает сообщения группы прочитанными до message_id включительно (или все)
+@router.post("/read")
+async def mark_read(
+    chat_id: UUID = Body(..., embed=True),
+    message_id: UUID | None = Body(None, embed=True),
+    current_user: UserOut = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    membership = await require_member(chat_id, current_user.id, session)
+    condition = and_(
+        GroupMessage.group_id == chat_id,
+        GroupMessage.send_time >= membership.members[current_user.id].joined_at,
+    )
+    read_until = (
+        await session.exec(read_until_query(GroupMessage, condition, message_id))
+    ).first()
+    if read_until is None:
+        if message_id is not None:
+            raise HTTPException(status_code=404, detail="Сообщение не найдено")
+        return {"status_code": "200 ok", "read_until": None}
+    await advance_watermark(
+        chat_id, current_user.id, "last_read_at", read_until, session
+    )
+    # прочитанное сообщение заодно и доставлено
+    await advance_delivered(chat_id, current_user.id, read_until, session)
+    await reset_unread(
+        session,
+        current_user.id,
+        "group_id",
+        chat_id,
+        GroupMessage,
+        condition,
+        read_until,
+    )
+    return {"status_code": "200 ok", "read_until": read_until}
 
 
 @router.post("/group_owner")
-def get_members_with_owner(
+async def get_members_with_owner(
     chat_id: str = Body(..., embed=True),
     current_user: UserOut = Depends(get_current_user),
-    session: Session = Depends(get_session),
+    session: AsyncSession = Depends(get_async_session),
 ):
     owner_id = (
-        session.exec(select(GroupChat).where(GroupChat.id == chat_id)).scalar().owner_id
+        (await session.exec(select(GroupChat).where(GroupChat.id == chat_id)))
+        .first()
+        .owner_id
     )
 
     return str(owner_id)
@@ -378,8 +572,9 @@ async def get_create_chat_page(
 
 
 @router.post("/get_username")
-def get_username_by_id(
-    id: str = Body(..., embed=True), session: Session = Depends(get_session)
+async def get_username_by_id(
+    id: str = Body(..., embed=True),
+    session: AsyncSession = Depends(get_async_session),
 ):
-    user = get_user_by_id(userid=id, session=session)
+    user = await get_user_by_id(userid=id, session=session)
     return {"username": user.username}
@@ -0,0 +1,27 @@
+from fastapi import APIRouter
+
+from services import passwords
+from services.groupchats import delivered_cache, membership_cache
+from services.ingest import ingestor
+from services.recent import recent_history
+from services.users import principal_cache
+
+router = APIRouter()
+
+
+# счетчики кэшей текущего воркера, чтобы подбирать их размеры. Подключается
+# только при METRICS_ENABLED (main.py) и не должен быть доступен снаружи.
+@router.get("/metrics")
+async def get_metrics():
+    return {
+        "principal_cache": principal_cache.stats(),
+        "group_members_cache": membership_cache.stats(),
+        "delivered_cache": delivered_cache.stats(),
+        "recent_history": recent_history.stats(),
+        "password_pool": passwords.stats.as_dict(),
+        "ingest": (
+            ingestor.stats.as_dict(ingestor.queue.qsize())
+            if ingestor is not None
+            else {"mode": "direct"}
+        ),
+    }
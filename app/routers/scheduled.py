@@ -0,0 +1,59 @@
+from typing import List
+from uuid import UUID
+
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from db import get_async_session
+from models.allmodels import ScheduledMessage, ScheduledStatus
+from schemas.messages import ScheduledMessageRead
+from schemas.users import UserOut
+from services.users import get_current_user
+
+router = APIRouter(prefix="/scheduled")
+
+
+# отложенные сообщения текущего пользователя, которые еще не отправлены
+@router.get("", response_model=List[ScheduledMessageRead])
+async def get_scheduled(
+    current_user: UserOut = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    query = (
+        select(ScheduledMessage)
+        .where(
+            ScheduledMessage.sender == current_user.id,
+            ScheduledMessage.status == ScheduledStatus.pending,
+        )
+        .order_by(ScheduledMessage.due_at)
+    )
+    return (await session.exec(query)).all()
+
+
+# Отмена возможна, только пока сообщение ждет отправки. Условный UPDATE не
+# пересекается с планировщиком: строку, которую он уже захватил, отмена
+# дождется и увидит в статусе sent.
+@router.delete("/{scheduled_id}")
+async def cancel_scheduled(
+    scheduled_id: UUID,
+    current_user: UserOut = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    result = await session.exec(
+        update(ScheduledMessage)
+        .where(
+            ScheduledMessage.id == scheduled_id,
+            ScheduledMessage.sender == current_user.id,
+            ScheduledMessage.status == ScheduledStatus.pending,
+        )
+        .values(status=ScheduledStatus.cancelled)
+    )
+    await session.commit()
+    if result.rowcount == 0:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Отложенное сообщение не найдено",
+        )
+    return {"status": "cancelled", "id": scheduled_id}
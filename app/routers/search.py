@@ -0,0 +1,55 @@
+from typing import List
+
+from fastapi import APIRouter, Depends, Query, Response
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from db import get_async_session
+from responses import MessagesResponse, messages_response
+from schemas.messages import MessageSearchResult
+from schemas.users import UserOut
+from services.search import encode_search_cursor, search_query
+from services.users import get_current_user
+
+router = APIRouter()
+
+
+# Поиск по всем личным чатам и группам пользователя. Строка понимает
+# синтаксис websearch: "точная фраза", OR, -исключение. Курсор следующей
+# страницы приходит в X-Next-Cursor и передается в after.
+@router.get(
+    "/search",
+    response_model=List[MessageSearchResult],
+    response_class=MessagesResponse,
+)
+async def search_messages(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=settings.SEARCH_QUERY_MAX_LENGTH),
+    after: str | None = None,
+    limit: int = Query(
+        settings.SEARCH_PAGE_SIZE, ge=1, le=settings.MESSAGES_PAGE_MAX_SIZE
+    ),
+    current_user: UserOut = Depends(get_current_user),
+    session: AsyncSession = Depends(get_async_session),
+):
+    rows = (await session.exec(search_query(current_user.id, q, after, limit))).all()
+    if len(rows) == limit:
+        last = rows[-1]
+        response.headers["X-Next-Cursor"] = encode_search_cursor(
+            last.rank, last.send_time, last.id
+        )
+    results = [
+        {
+            "id": row.id,
+            "chat_id": row.chat_id,
+            "group_id": row.group_id,
+            "sender_id": row.sender,
+            "recipient_id": row.user2,
+            "text": row.text,
+            "snippet": row.snippet,
+            "send_time": row.send_time,
+            "rank": row.rank,
+        }
+        for row in rows
+    ]
+    return messages_response(results, response)
@@ -1,10 +1,10 @@
 from typing import Annotated
 from fastapi import APIRouter, Depends, HTTPException, Request, Response
 from schemas.users import UserCreate, UserOut, UserGet
-from passlib.context import CryptContext
 from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
-from sqlmodel import Session, select
-from db import get_session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from db import get_async_session
 from models.allmodels import User
 from services.users import (
     create_refresh_token,
@@ -14,44 +14,41 @@ from services.users import (
     create_access_token,
     get_user,
     get_current_user,
+    get_access_token,
+    invalidate_principal,
 )
+import jwt
+from config import settings
+from services.passwords import hash_password, verify_password
 from schemas.token import Token
 from fastapi import status
 from fastapi.templating import Jinja2Templates
 from fastapi.responses import HTMLResponse
 
-
 router = APIRouter(prefix="/users")
 
 templates = Jinja2Templates(directory="frontend/templates")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
-
-
-def get_password_hash(password):
-    return pwd_context.hash(password)
-
-
 @router.get("/", response_class=HTMLResponse, summary="Страница авторизации")
 async def get_categories(request: Request):
     return templates.TemplateResponse("auth.html", {"request": request})
 
 
 @router.post("/register", response_model=UserOut)
-async def register(user: UserCreate, session: Session = Depends(get_session)):
+async def register(
+    user: UserCreate, session: AsyncSession = Depends(get_async_session)
+):
     # проверки на то, что пользователь еще не зарегистрирован
-    user_excec = get_user(user=user, session=session)
+    user_excec = await get_user(user=user, session=session)
     if user_excec is not None:
         raise HTTPException(
             status_code=400, detail="Пользователь с данным username уже зарегистрирован"
         )
     statement = select(User).where(User.email == user.email)
-    result = session.exec(statement).first()
+    result = (await session.exec(statement)).first()
 
     if result is not None:
         raise HTTPException(
@@ -60,32 +57,37 @@ async def register(user: UserCreate, session: Session = Depends(get_session)):
 
     # сама регистрация пользователя
 
-    hashed = get_password_hash(user.password)
+    hashed = await hash_password(user.password)
 
     user_db = User(username=user.username, email=user.email, hashed_password=hashed)
 
-    return register_user(user_db, session)
+    return await register_user(user_db, session)
 
 
 @router.post("/login")
 async def login(
-    user: UserGet, response: Response, session: Session = Depends(get_session)
+    user: UserGet,
+    response: Response,
+    session: AsyncSession = Depends(get_async_session),
 ):
-    user_obj = get_user(user=user, session=session)
+    user_obj = await get_user(user=user, session=session)
     if user_obj is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный username или пароль",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not verify_password(
-        plain_password=user.password, hashed_password=user_obj.hashed_password
-    ):
+    verified, new_hash = await verify_password(user.password, user_obj.hashed_password)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Неверный username или пароль",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # хэш посчитан с устаревшей стоимостью bcrypt
+    if new_hash is not None:
+        user_obj.hashed_password = new_hash
+        await session.commit()
 
     access_token = create_access_token(data={"sub": str(user_obj.id)})
     refresh_token = create_refresh_token(
@@ -105,7 +107,21 @@ async def get_me(current_user: Annotated[UserOut, Depends(get_current_user)]):
 
 
 @router.post("/logout/")
-async def logout_user(response: Response):
+async def logout_user(request: Request, response: Response):
+    # токен больше не используется, убираем его из кэша пользователей
+    token = get_access_token(request)
+    if token:
+        try:
+            payload = jwt.decode(
+                token,
+                settings.SECRET_KEY,
+                algorithms=[settings.ALGORITHM],
+                options={"verify_exp": False},
+            )
+            if payload.get("sub"):
+                await invalidate_principal(payload["sub"], token)
+        except jwt.InvalidTokenError:
+            pass
     response.delete_cookie(key="users_access_token", path="/")
     return {"message": "Пользователь успешно вышел из системы"}
 
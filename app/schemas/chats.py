@@ -1,3 +1,5 @@
+from datetime import datetime
+from typing import Optional
 from uuid import UUID
 from pydantic import BaseModel
 
@@ -6,6 +8,11 @@ class Chat(BaseModel):
     users: list[str]
 
 
+class ChatContact(BaseModel):
+    id: UUID
+    username: str
+
+
 class GroupChat(BaseModel):
     owner_id: UUID
     title: str
@@ -21,3 +28,26 @@ class GroupChatOut(BaseModel):
     title: str
     owner_id: UUID
     members: list
+
+
+class GroupMember(BaseModel):
+    username: str
+    role: str
+    joined_at: datetime
+
+
+# Состав группы, который кэшируется в services/groupchats.py
+class GroupMembership(BaseModel):
+    group_id: UUID
+    owner_id: UUID
+    members: dict[UUID, GroupMember]
+
+
+# Непрочитанные в переписке: для личного чата заполнены chat_id и user_id
+# собеседника, для группы - group_id
+class UnreadCount(BaseModel):
+    chat_id: Optional[UUID] = None
+    user_id: Optional[UUID] = None
+    group_id: Optional[UUID] = None
+    unread: int
+    last_read_at: Optional[datetime] = None
@@ -1,9 +1,12 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, model_validator
 import datetime
 from uuid import UUID
 
+from config import settings
+
 
 class Message(BaseModel):
+    id: UUID
     chat_id: UUID
     sender_id: str
     send_time: datetime.datetime = datetime.datetime.now()
@@ -15,13 +18,87 @@ class MessageCreate(BaseModel):
     content: str = Field(..., description="Содержимое сообщения")
 
 
+# ответ на отправку: status "ok" или "queued" - база недоступна, сообщение
+# отложено в файл очереди и появится в истории позже
+class MessageSent(MessageCreate):
+    status: str
+
+
+# Пачка личных сообщений: отдельные сообщения в messages и/или один текст
+# content сразу всем из recipient_ids
+class MessageBulkCreate(BaseModel):
+    messages: list[MessageCreate] = Field(default_factory=list)
+    recipient_ids: list[UUID] = Field(default_factory=list)
+    content: str | None = None
+
+    @model_validator(mode="after")
+    def check_size(self):
+        if self.recipient_ids and self.content is None:
+            raise ValueError("Для recipient_ids нужен content")
+        total = len(self.messages) + len(self.recipient_ids)
+        if not 0 < total <= settings.MESSAGES_BULK_MAX_SIZE:
+            raise ValueError(
+                f"В пачке должно быть от 1 до {settings.MESSAGES_BULK_MAX_SIZE} сообщений"
+            )
+        return self
+
+    def items(self) -> list[MessageCreate]:
+        return self.messages + [
+            MessageCreate(recipient_id=recipient_id, content=self.content)
+            for recipient_id in self.recipient_ids
+        ]
+
+
+# результат для каждого сообщения пачки, в том же порядке
+class MessageBulkResult(BaseModel):
+    recipient_id: UUID
+    status: str
+    id: UUID | None = None
+    detail: str | None = None
+
+
 class GroupMessagesCreate(BaseModel):
     chat_id: UUID
     text: str
 
 
+class GroupMessageSent(GroupMessagesCreate):
+    status: str
+
+
+# подтверждение получения сообщения группы по сокету
+class GroupMessageDelivered(BaseModel):
+    chat_id: UUID
+    message_id: UUID
+
+
 class GroupMessageRead(BaseModel):
+    id: UUID
     chat_id: UUID
     text: str
     sender_id: UUID
     send_time: datetime.datetime
+
+
+class ScheduledMessageRead(BaseModel):
+    id: UUID
+    recipient_id: UUID | None
+    group_id: UUID | None
+    text: str
+    due_at: datetime.datetime
+    status: str
+
+
+# Найденное сообщение: для личного чата заполнены chat_id и recipient_id,
+# для группы - group_id. snippet - фрагменты текста с подсветкой совпадений:
+# HTML, где текст сообщения экранирован, а совпадения обрамлены <b></b>
+class MessageSearchResult(BaseModel):
+    id: UUID
+    chat_id: UUID | None
+    group_id: UUID | None
+    sender_id: UUID
+    recipient_id: UUID | None
+    text: str
+    snippet: str
+    send_time: datetime.datetime
+    rank: float
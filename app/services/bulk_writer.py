@@ -0,0 +1,84 @@
+# Запись сообщений пачками: один многострочный INSERT на таблицу вместо
+# отдельной транзакции на каждое сообщение. id и send_time генерируются
+# заранее, поэтому повторная запись той же пачки (после сбоя до
+# подтверждения) ничего не дублирует - ON CONFLICT DO NOTHING по первичному
+# ключу (id, send_time).
+
+from datetime import datetime
+from uuid import UUID
+
+from sqlalchemy.dialects.postgresql import insert
+
+from models.allmodels import GroupMessage, Message, as_stored
+from services.unread import count_unread
+
+
+# send_time из очереди: пачки, поставленные раньше, могли записать его с
+# часовым поясом
+def parse_time(value: str) -> datetime:
+    return as_stored(datetime.fromisoformat(value))
+
+
+def direct_row(item: dict):
+    return {
+        "id": UUID(item["id"]),
+        "chat_id": UUID(item["chat_id"]),
+        "sender": UUID(item["sender"]),
+        "user2": UUID(item["user2"]),
+        "text": item["text"],
+        "send_time": parse_time(item["send_time"]),
+    }
+
+
+def group_row(item: dict):
+    return {
+        "id": UUID(item["id"]),
+        "group_id": UUID(item["group_id"]),
+        "sender": UUID(item["sender"]),
+        "text": item["text"],
+        "send_time": parse_time(item["send_time"]),
+    }
+
+
+# обратное преобразование: сообщение (объект модели или строка истории) ->
+# словарь для очереди
+def to_item(message) -> dict:
+    if getattr(message, "group_id", None) is not None:
+        item = {"kind": "group", "group_id": str(message.group_id)}
+    else:
+        item = {
+            "kind": "direct",
+            "chat_id": str(message.chat_id),
+            "user2": str(message.user2),
+        }
+    item.update(
+        id=str(message.id),
+        sender=str(message.sender),
+        text=message.text,
+        send_time=message.send_time.isoformat(),
+    )
+    return item
+
+
+# items - сообщения в виде словарей из очереди (kind: direct или group).
+# Возвращает те из них, что реально вставлены: уже записанные раньше
+# пропускаются: уведомления о них повторно не рассылаются, а счетчики
+# непрочитанных не растут второй раз.
+def insert_messages(conn, items: list[dict]) -> list[dict]:
+    inserted = []
+    for model, kind, to_row in (
+        (Message, "direct", direct_row),
+        (GroupMessage, "group", group_row),
+    ):
+        batch = [item for item in items if item["kind"] == kind]
+        if batch:
+            stmt = (
+                insert(model)
+                .values([to_row(item) for item in batch])
+                .on_conflict_do_nothing(index_elements=["id", "send_time"])
+                .returning(model.id)
+            )
+            ids = {str(row_id) for row_id in conn.execute(stmt).scalars()}
+            inserted += [item for item in batch if item["id"] in ids]
+    count_unread(conn, inserted)
+    return inserted
@@ -0,0 +1,84 @@
+# Небольшие кэши в памяти процесса. Каждый воркер держит свой экземпляр,
+# поэтому все, что в них лежит, должно либо быстро протухать, либо
+# явно сбрасываться при изменении данных.
+
+import time
+from collections import OrderedDict
+
+import redis
+import redis.asyncio as aioredis
+
+from config import settings
+
+
+class TTLCache:
+    # LRU с ограниченным размером и временем жизни записей
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self.data[key]
+            self.misses += 1
+            return default
+        self.data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value, ttl: float | None = None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        self.data[key] = (value, time.monotonic() + ttl)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    # удаляет все записи, для ключа которых predicate вернул True
+    def delete_where(self, predicate):
+        for key in [key for key in self.data if predicate(key)]:
+            del self.data[key]
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self.data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+        }
+
+
+_redis = None
+_sync_redis = None
+
+
+# общий для кэшей клиент Redis, создается при первом обращении
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = aioredis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _redis
+
+
+# синхронный клиент с теми же настройками - для задач celery
+def get_sync_redis():
+    global _sync_redis
+    if _sync_redis is None:
+        _sync_redis = redis.Redis.from_url(settings.REDIS_URL, decode_responses=True)
+    return _sync_redis
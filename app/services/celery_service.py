@@ -1,46 +1,276 @@
-from uuid import UUID
-from sqlmodel import insert
-from models.allmodels import Message, GroupMessage
+import json
+import time
+from uuid import UUID, uuid4
+
+from sqlalchemy import text, update
+from sqlmodel import insert, select
+from models.allmodels import (
+    Chat,
+    GroupChatMembers,
+    ScheduledMessage,
+    ScheduledStatus,
+    utcnow,
+)
 from db import engine
 from celery_app import celery_app
+from config import settings
+from services.bulk_writer import insert_messages
+from services.cache import get_sync_redis
+from services.chats import direct_chat_query
+from services.partitions import ensure_partitions
+from services.recent import recent_envelopes, redis_appends
+from websocket import bus, chat_manager, group_chat_manager
+
+
+# Задачи, поставленные до появления Messages.chat_id, приходят без него:
+# находим чат пары (или создаем) так же, как services/chats.get_direct_chat_id
+def get_direct_chat_id(conn, sender_id, recipient_id):
+    users = sorted([UUID(str(sender_id)), UUID(str(recipient_id))])
+    conn.execute(
+        text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+        {"key": f"chat:{users[0]}:{users[1]}"},
+    )
+    chat_id = conn.execute(direct_chat_query(users)).scalar()
+    if chat_id is None:
+        chat_id = conn.execute(
+            insert(Chat).values(id=uuid4(), users=users).returning(Chat.id)
+        ).scalar()
+    return chat_id
+
+
+# Участники групп пачки одним запросом: {group_id: [user_id, ...]}
+def group_members(conn, group_ids) -> dict:
+    members = {}
+    if group_ids:
+        rows = conn.execute(
+            select(GroupChatMembers.group_id, GroupChatMembers.user_id).where(
+                GroupChatMembers.group_id.in_(group_ids)
+            )
+        )
+        for group_id, user_id in rows:
+            members.setdefault(str(group_id), []).append(user_id)
+    return members
+
+
+# Уведомления о доставленных сообщениях в том же виде, что и у живых
+# (routers/chats.deliver_message и routers/groupchats.deliver_message), поэтому
+# клиент показывает их сразу, а не при следующем опросе истории.
+def delivered_envelopes(items: list[dict], members: dict) -> list:
+    envelopes = []
+    for item in items:
+        if item["kind"] == "group":
+            message = {
+                "id": item["id"],
+                "sender_id": item["sender"],
+                "chat_id": item["group_id"],
+                "text": item["text"],
+                "send_time": item["send_time"],
+            }
+            recipients = [*members.get(item["group_id"], ()), item["sender"]]
+            envelopes += group_chat_manager.envelopes(recipients, message)
+        else:
+            message = {
+                "id": item["id"],
+                "chat_id": item["chat_id"],
+                "sender_id": item["sender"],
+                "recipient_id": item["user2"],
+                "content": item["text"],
+                "send_time": item["send_time"],
+            }
+            recipients = [item["user2"], item["sender"]]
+            envelopes += chat_manager.envelopes(recipients, message)
+    return envelopes
+
+
+# Публикуется только после коммита: получатель, запросивший историю по
+# уведомлению, должен увидеть сообщение в базе. Заодно сообщения попадают
+# в кэш последних сообщений (services/recent.py) воркеров и Redis
+def notify_delivered(items: list[dict], members: dict):
+    bus.publish_sync(recent_envelopes(items) + delivered_envelopes(items, members))
+    if items and settings.RECENT_HISTORY_REDIS:
+        with get_sync_redis().pipeline(transaction=False) as pipe:
+            redis_appends(pipe, items)
+            pipe.execute()
+
+
+# Задачи с eta, поставленные до появления таблицы ScheduledMessages: когда их
+# время приходит, сообщение складывается в список Redis, который разбирает
+# flush_scheduled_messages пачками по SCHEDULED_BATCH_SIZE.
+SCHEDULED_QUEUE = "scheduled:due"
+SCHEDULED_LOCK = "scheduled:flush-lock"
+
+
+def enqueue_due(item: dict):
+    item["id"] = str(uuid4())
+    item["send_time"] = utcnow().isoformat()
+    get_sync_redis().rpush(SCHEDULED_QUEUE, json.dumps(item, default=str))
 
 
 @celery_app.task
 def send_message_later(message_data: dict):
-    stmt = insert(Message).values(
-        sender=message_data["sender_id"],
-        user2=message_data["recipient_id"],
-        text=message_data["content"],
+    chat_id = message_data.get("chat_id")
+    if chat_id is None:
+        with engine.begin() as conn:
+            chat_id = get_direct_chat_id(
+                conn, message_data["sender_id"], message_data["recipient_id"]
+            )
+    enqueue_due(
+        {
+            "kind": "direct",
+            "chat_id": chat_id,
+            "sender": message_data["sender_id"],
+            "user2": message_data["recipient_id"],
+            "text": message_data["content"],
+        }
     )
 
-    with engine.begin() as conn:
-        conn.execute(stmt)
-
     return {
         "recipient_id": message_data["recipient_id"],
         "content": message_data["content"],
         "status": "ok",
-        "msg": "Message saved!",
+        "msg": "Message queued!",
     }
 
 
 @celery_app.task
 def send_message_later_group(message_data: dict):
-    recipients_uuid = [UUID(r) for r in message_data["recipients"]]
-    stmt = insert(GroupMessage).values(
-        group_id=message_data["group_id"],
-        sender=message_data["sender"],
-        recipients=recipients_uuid,
-        text=message_data["text"],
+    # получатели определяются составом группы при чтении; задачи, поставленные
+    # до этого изменения, еще могут содержать ключ recipients - он не нужен
+    enqueue_due(
+        {
+            "kind": "group",
+            "group_id": message_data["group_id"],
+            "sender": message_data["sender"],
+            "text": message_data["text"],
+        }
     )
 
-    with engine.begin() as conn:
-        conn.execute(stmt)
-
     return {
         "group_id": message_data["group_id"],
-        "recipients": message_data["recipients"],
         "text": message_data["text"],
         "status": "ok",
-        "msg": "Message saved!",
+        "msg": "Message queued!",
     }
+
+
+# Разбирает очередь пачками, каждая - одна транзакция. Пачка удаляется из
+# очереди только после коммита, а блокировка гарантирует, что разбирает ее
+# один воркер; если он упадет между коммитом и LTRIM, следующий запуск
+# запишет ту же пачку еще раз, и ON CONFLICT DO NOTHING ее пропустит.
+@celery_app.task
+def flush_scheduled_messages():
+    client = get_sync_redis()
+    lock = client.lock(SCHEDULED_LOCK, timeout=settings.SCHEDULED_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        return {"status": "skipped", "msg": "Flush already running"}
+    started = time.monotonic()
+    rows = batches = 0
+    try:
+        while True:
+            raw = client.lrange(SCHEDULED_QUEUE, 0, settings.SCHEDULED_BATCH_SIZE - 1)
+            if not raw:
+                break
+            with engine.begin() as conn:
+                inserted = insert_messages(conn, [json.loads(item) for item in raw])
+                members = group_members(
+                    conn, {item["group_id"] for item in inserted if "group_id" in item}
+                )
+            client.ltrim(SCHEDULED_QUEUE, len(raw), -1)
+            rows += len(inserted)
+            batches += 1
+            notify_delivered(inserted, members)
+            lock.extend(settings.SCHEDULED_FLUSH_LOCK_TIMEOUT, replace_ttl=True)
+    finally:
+        lock.release()
+    seconds = time.monotonic() - started
+    return {
+        "status": "ok",
+        "rows": rows,
+        "batches": batches,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if rows else 0,
+    }
+
+
+# Доставка сообщений из таблицы ScheduledMessages. Пачка строк, чье время
+# пришло, захватывается FOR UPDATE SKIP LOCKED: несколько воркеров разбирают
+# таблицу параллельно, не мешая друг другу, а отмена сообщения из захваченной
+# пачки дождется ее коммита и уже не найдет его в статусе pending.
+@celery_app.task
+def deliver_scheduled_messages():
+    started = time.monotonic()
+    rows = failed = batches = 0
+    while True:
+        with engine.begin() as conn:
+            due = conn.execute(
+                select(ScheduledMessage)
+                .where(
+                    ScheduledMessage.status == ScheduledStatus.pending,
+                    ScheduledMessage.due_at <= utcnow(),
+                )
+                .order_by(ScheduledMessage.due_at)
+                .limit(settings.SCHEDULED_BATCH_SIZE)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not due:
+                break
+            # получатели в группе определяются ее составом в момент доставки:
+            # если отправитель уже не участник, сообщение не отправляется
+            members = group_members(
+                conn, {row.group_id for row in due if row.group_id is not None}
+            )
+            items, rejected = [], []
+            send_time = utcnow().isoformat()
+            for row in due:
+                if row.group_id is not None and row.sender not in members.get(
+                    str(row.group_id), ()
+                ):
+                    rejected.append(row.id)
+                    continue
+                items.append(scheduled_item(row, send_time))
+            inserted = insert_messages(conn, items)
+            rows += len(inserted)
+            failed += len(rejected)
+            for status, ids in (
+                (ScheduledStatus.sent, [item["id"] for item in items]),
+                (ScheduledStatus.failed, rejected),
+            ):
+                if ids:
+                    conn.execute(
+                        update(ScheduledMessage)
+                        .where(ScheduledMessage.id.in_(ids))
+                        .values(status=status)
+                    )
+            batches += 1
+        notify_delivered(inserted, members)
+    seconds = time.monotonic() - started
+    return {
+        "status": "ok",
+        "rows": rows,
+        "failed": failed,
+        "batches": batches,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(rows / seconds, 1) if rows else 0,
+    }
+
+
+def scheduled_item(row, send_time: str):
+    if row.group_id is not None:
+        item = {"kind": "group", "group_id": str(row.group_id)}
+    else:
+        item = {
+            "kind": "direct",
+            "chat_id": str(row.chat_id),
+            "user2": str(row.recipient_id),
+        }
+    item.update(
+        id=str(row.id), sender=str(row.sender), text=row.text, send_time=send_time
+    )
+    return item
+
+
+@celery_app.task
+def create_message_partitions():
+    with engine.begin() as conn:
+        created = ensure_partitions(conn, settings.MESSAGE_PARTITIONS_AHEAD)
+    return {"status": "ok", "created": created}
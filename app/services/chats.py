@@ -0,0 +1,138 @@
+# Личные чаты. Chat.users хранит отсортированную пару id (для чата с собой -
+# [id, id]), каждое сообщение ссылается на свой чат через Message.chat_id.
+
+from uuid import UUID
+
+from sqlalchemy import any_, or_, text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from models.allmodels import Chat, User
+from services.cache import TTLCache
+
+# пара пользователей -> id чата; чаты не удаляются, поэтому сбрасывать нечего
+direct_chat_cache = TTLCache(
+    settings.DIRECT_CHAT_CACHE_SIZE, settings.DIRECT_CHAT_CACHE_TTL
+)
+
+
+def chat_users(user1: UUID, user2: UUID):
+    return sorted([user1, user2])
+
+
+# users = ... и @> обслуживаются GIN-индексом ix_Chats_users, а
+# id = ANY(users) - нет, поэтому фильтры по участникам пишутся через contains
+def direct_chat_query(users: list[UUID]):
+    return (
+        select(Chat.id)
+        .where(or_(Chat.users == users, Chat.users == users[::-1]))
+        .limit(1)
+    )
+
+
+# Собеседники пользователя: участники его чатов, кроме него самого (его
+# самого - только если есть чат с собой)
+def contacts_query(user_id: UUID):
+    return (
+        select(User.id, User.username)
+        .distinct()
+        .select_from(Chat)
+        .join(User, User.id == any_(Chat.users))
+        .where(
+            Chat.users.contains([user_id]),
+            or_(User.id != user_id, Chat.users == [user_id, user_id]),
+        )
+        .order_by(User.username)
+    )
+
+
+async def find_direct_chat(users: list[UUID], session: AsyncSession):
+    return (await session.exec(direct_chat_query(users))).first()
+
+
+# id чата двух пользователей; с create=True чат создается, если его еще нет
+async def get_direct_chat_id(
+    user1: UUID, user2: UUID, session: AsyncSession, create: bool = False
+):
+    users = chat_users(user1, user2)
+    key = tuple(users)
+    chat_id = direct_chat_cache.get(key)
+    if chat_id is not None:
+        return chat_id
+    chat_id = await find_direct_chat(users, session)
+    if chat_id is None and create:
+        # блокировка на пару, чтобы параллельные отправки не создали два чата
+        await session.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            {"key": f"chat:{users[0]}:{users[1]}"},
+        )
+        chat_id = await find_direct_chat(users, session)
+        if chat_id is None:
+            chat = Chat(users=users)
+            session.add(chat)
+            await session.flush()
+            chat_id = chat.id
+        await session.commit()
+    if chat_id is not None:
+        direct_chat_cache.set(key, chat_id)
+    return chat_id
+
+
+async def find_direct_chats(user_id: UUID, others: list[UUID], session: AsyncSession):
+    pairs = [chat_users(user_id, other) for other in others]
+    rows = await session.exec(
+        select(Chat.id, Chat.users).where(
+            or_(*[Chat.users == pair for pair in pairs + [p[::-1] for p in pairs]])
+        )
+    )
+    found = {}
+    for chat_id, users in rows:
+        found.setdefault(users[1] if users[0] == user_id else users[0], chat_id)
+    return found
+
+
+# То же, что get_direct_chat_id(create=True), для многих собеседников сразу:
+# один запрос на все пары, которых нет в кэше, и одна вставка недостающих
+# чатов. Возвращает {собеседник: id чата}.
+async def get_direct_chat_ids(
+    user_id: UUID, others: set[UUID], session: AsyncSession
+) -> dict:
+    chat_ids, missing = {}, []
+    for other in others:
+        chat_id = direct_chat_cache.get(tuple(chat_users(user_id, other)))
+        if chat_id is None:
+            missing.append(other)
+        else:
+            chat_ids[other] = chat_id
+    if not missing:
+        return chat_ids
+    found = await find_direct_chats(user_id, missing, session)
+    absent = [other for other in missing if other not in found]
+    if absent:
+        # блокировки берутся в одном порядке, чтобы параллельные рассылки с
+        # пересекающимися получателями не ждали друг друга по кругу
+        keys = sorted(
+            "chat:{}:{}".format(*chat_users(user_id, other)) for other in absent
+        )
+        for key in keys:
+            await session.execute(
+                text("SELECT pg_advisory_xact_lock(hashtext(:key))"), {"key": key}
+            )
+        found.update(await find_direct_chats(user_id, absent, session))
+        chats = [
+            Chat(users=chat_users(user_id, other))
+            for other in absent
+            if other not in found
+        ]
+        session.add_all(chats)
+        await session.flush()
+        for chat in chats:
+            found[chat.users[1] if chat.users[0] == user_id else chat.users[0]] = (
+                chat.id
+            )
+        await session.commit()
+    for other, chat_id in found.items():
+        direct_chat_cache.set(tuple(chat_users(user_id, other)), chat_id)
+        chat_ids[other] = chat_id
+    return chat_ids
@@ -0,0 +1,128 @@
+# Кэш состава групп. Состав меняется намного реже, чем в группы пишут, поэтому
+# отправка сообщения берет получателей и проверку членства отсюда, не обращаясь
+# к базе. create/add_member/delete_member/exit после коммита сбрасывают запись
+# у себя и через шину у остальных воркеров.
+
+from datetime import datetime
+from uuid import UUID
+
+from fastapi import HTTPException
+from sqlalchemy import or_, update
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from config import settings
+from models.allmodels import GroupChat, GroupChatMembers, User
+from schemas.chats import GroupMember, GroupMembership
+from services.cache import TTLCache
+from websocket import bus
+
+membership_cache = TTLCache(
+    settings.GROUP_MEMBERS_CACHE_SIZE, settings.GROUP_MEMBERS_CACHE_TTL
+)
+# водяные знаки доставки, уже записанные этим воркером: повторное
+# подтверждение того же или более старого сообщения в базу не пишет
+delivered_cache = TTLCache(settings.DELIVERED_CACHE_SIZE, settings.DELIVERED_CACHE_TTL)
+GROUP_MEMBERS_CHANNEL = "messenger:group_members"
+# растет при каждом сбросе: состав, прочитанный из базы до сброса, может быть
+# уже устаревшим, и в кэш его класть нельзя
+invalidations = 0
+
+
+# Группа, ее участники и их имена одним запросом, сколько бы участников ни было
+def membership_query(group_id):
+    return (
+        select(
+            GroupChat.id,
+            GroupChat.owner_id,
+            GroupChatMembers.user_id,
+            GroupChatMembers.role,
+            GroupChatMembers.joined_at,
+            User.username,
+        )
+        .select_from(GroupChat)
+        .outerjoin(GroupChatMembers, GroupChatMembers.group_id == GroupChat.id)
+        .outerjoin(User, User.id == GroupChatMembers.user_id)
+        .where(GroupChat.id == group_id)
+    )
+
+
+async def load_membership(group_id, session: AsyncSession):
+    rows = (await session.exec(membership_query(group_id))).all()
+    if not rows:
+        return None
+    return GroupMembership(
+        group_id=rows[0][0],
+        owner_id=rows[0][1],
+        members={
+            user_id: GroupMember(username=username, role=role, joined_at=joined_at)
+            for _, _, user_id, role, joined_at, username in rows
+            if user_id is not None
+        },
+    )
+
+
+# Состав группы или None, если группы нет
+async def get_membership(group_id, session: AsyncSession):
+    key = str(group_id)
+    membership = membership_cache.get(key)
+    if membership is None:
+        seen = invalidations
+        membership = await load_membership(group_id, session)
+        if membership is not None and seen == invalidations:
+            membership_cache.set(key, membership)
+    return membership
+
+
+# Состав группы, если user_id в ней состоит, иначе 404/422 как в роутере
+async def require_member(group_id, user_id: UUID, session: AsyncSession):
+    membership = await get_membership(group_id, session)
+    if membership is None:
+        raise HTTPException(status_code=404, detail="Чат не найден")
+    if user_id not in membership.members:
+        raise HTTPException(status_code=422, detail="Вы не состоите в данном чате")
+    return membership
+
+
+def drop_membership(group_id: str):
+    global invalidations
+    invalidations += 1
+    membership_cache.delete(group_id)
+
+
+async def invalidate_membership(group_id):
+    drop_membership(str(group_id))
+    await bus.publish(GROUP_MEMBERS_CHANNEL, str(group_id))
+
+
+async def on_membership_invalidated(data: str):
+    drop_membership(data)
+
+
+# Двигает водяной знак участника (last_delivered_at или last_read_at) только
+# вперед: параллельный запрос с более старым значением его не откатит
+async def advance_watermark(
+    group_id, user_id: UUID, field: str, value: datetime, session: AsyncSession
+):
+    column = getattr(GroupChatMembers, field)
+    await session.execute(
+        update(GroupChatMembers)
+        .where(
+            GroupChatMembers.group_id == group_id,
+            GroupChatMembers.user_id == user_id,
+            or_(column.is_(None), column < value),
+        )
+        .values({field: value})
+    )
+    await session.commit()
+
+
+async def advance_delivered(
+    group_id, user_id: UUID, value: datetime, session: AsyncSession
+):
+    key = (str(group_id), user_id)
+    known = delivered_cache.get(key)
+    if known is not None and known >= value:
+        return
+    await advance_watermark(group_id, user_id, "last_delivered_at", value, session)
+    delivered_cache.set(key, value)
@@ -0,0 +1,164 @@
+import base64
+import hashlib
+from datetime import datetime
+from uuid import UUID
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models.allmodels import as_stored
+
+
+# курсор - это (send_time, id) последнего сообщения страницы в base64.
+# send_time в нем такой же, как в базе; курсоры с часовым поясом выдавал
+# раньше кэш последних сообщений, они приводятся к тому же виду
+def encode_cursor(send_time: datetime, message_id: UUID) -> str:
+    raw = f"{send_time.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        send_time, message_id = raw.split("|")
+        return as_stored(datetime.fromisoformat(send_time)), UUID(message_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор"
+        )
+
+
+# Запрос страницы истории: проход по индексу (..., send_time, id) от курсора.
+# Таблицы сообщений секционированы по send_time, а по сравнению кортежей
+# Postgres секции не отсекает, поэтому граница по send_time дублируется
+# отдельным условием.
+# Выбираются только колонки модели, без ORM-объектов: строки результата
+# отдаются клиенту как есть.
+def history_query(model, condition, before: str | None, after: str | None):
+    key = tuple_(model.send_time, model.id)
+    query = select(*(getattr(model, name) for name in model.model_fields)).where(
+        condition
+    )
+    if after:
+        cursor = decode_cursor(after)
+        query = query.where(model.send_time >= cursor[0], key > cursor)
+        return query.order_by(model.send_time, model.id)
+    if before:
+        cursor = decode_cursor(before)
+        query = query.where(model.send_time <= cursor[0], key < cursor)
+    return query.order_by(model.send_time.desc(), model.id.desc())
+
+
+# Страница истории с пагинацией по ключу (send_time, id): без курсоров -
+# последние limit сообщений, с before - более старые, с after - более новые.
+# Сообщения всегда идут от старых к новым, вторым значением возвращается
+# курсор следующей страницы в том же направлении (None, если она последняя).
+async def get_history_page(
+    session: AsyncSession,
+    model,
+    condition,
+    before: str | None,
+    after: str | None,
+    limit: int,
+):
+    if before and after:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Нельзя передавать before и after одновременно",
+        )
+    query = history_query(model, condition, before, after).limit(limit)
+    messages = list((await session.exec(query)).all())
+    if not after:
+        messages.reverse()
+
+    next_cursor = None
+    if len(messages) == limit:
+        edge = messages[-1] if after else messages[0]
+        next_cursor = encode_cursor(edge.send_time, edge.id)
+    return messages, next_cursor
+
+
+async def get_cursor_by_id(session: AsyncSession, model, condition, message_id: UUID):
+    query = select(model.send_time, model.id).where(condition, model.id == message_id)
+    row = (await session.exec(query)).first()
+    if row is None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Сообщение не найдено"
+        )
+    return encode_cursor(*row)
+
+
+# ETag зависит только от последнего сообщения в переписке и параметров
+# запроса: сообщения не редактируются и не удаляются, поэтому пока не пришло
+# новое сообщение, ответ на тот же запрос не меняется
+async def get_history_etag(
+    session: AsyncSession, model, condition, after: str | None, limit: int
+) -> str:
+    query = (
+        select(model.send_time, model.id)
+        .where(condition)
+        .order_by(model.send_time.desc(), model.id.desc())
+        .limit(1)
+    )
+    latest = (await session.exec(query)).first()
+    return history_etag(encode_cursor(*latest) if latest else "", after, limit)
+
+
+def history_etag(latest: str, after: str | None, limit: int) -> str:
+    digest = hashlib.md5(f"{latest}|{after}|{limit}".encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+# История с поддержкой дельта-синхронизации: after_id отдает только сообщения
+# новее указанного, а для последней страницы и дельт проверяется
+# If-None-Match. Если ничего не изменилось, возвращается готовый ответ 304.
+# recent - функция (after_id) -> страница из кэша последних сообщений
+# (services/recent.py) или None; последняя страница и дельты сначала
+# ищутся в нем.
+async def get_history(
+    session: AsyncSession,
+    model,
+    condition,
+    request: Request,
+    response: Response,
+    before: str | None,
+    after: str | None,
+    after_id: UUID | None,
+    limit: int,
+    recent=None,
+):
+    if before is None and after is None and recent is not None:
+        page = await recent(after_id)
+        if page is not None:
+            messages, after, latest = page
+            etag = history_etag(latest, after, limit)
+            headers = {"ETag": etag, "Cache-Control": "no-cache"}
+            if request.headers.get("If-None-Match") == etag:
+                return Response(
+                    status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+                )
+            response.headers.update(headers)
+            if len(messages) == limit:
+                edge = messages[-1] if after else messages[0]
+                response.headers["X-Next-Cursor"] = encode_cursor(
+                    edge.send_time, edge.id
+                )
+            return messages
+
+    if after_id:
+        after = await get_cursor_by_id(session, model, condition, after_id)
+
+    if before is None:
+        etag = await get_history_etag(session, model, condition, after, limit)
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("If-None-Match") == etag:
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        response.headers.update(headers)
+
+    messages, next_cursor = await get_history_page(
+        session, model, condition, before=before, after=after, limit=limit
+    )
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return messages
@@ -0,0 +1,248 @@
+# Групповая запись живых сообщений (INGEST_MODE=batched). Обработчик кладет
+# сообщение в очередь процесса и ждет, пока отдельная задача запишет его
+# вместе с соседями одним INSERT (services/bulk_writer.py): один коммит на
+# пачку вместо коммита на каждое сообщение. id и send_time назначаются еще
+# при создании объекта, поэтому вызывающий получает тот же id, что окажется в
+# базе.
+# Если база недоступна, пачка дописывается в локальный файл
+# (INGEST_SPILL_DIR/ingest-<pid>.jsonl), и обработчик получает статус QUEUED:
+# сообщения еще нет в базе, поэтому его не рассылают и не кладут в кэш
+# последних сообщений. Файлы переигрываются отдельной задачей, как только
+# запись снова проходит; переигранные сообщения попадают в кэш, но
+# уведомлений по сокету не вызывают. Повторная запись безопасна: ON CONFLICT
+# DO NOTHING по id.
+
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+
+from config import settings
+from db import async_engine
+from services.bulk_writer import insert_messages, to_item
+from services.recent import from_item, remember_messages
+from services.unread import count_unread
+
+logger = logging.getLogger(__name__)
+
+# Чем закончилась запись сообщения: записано сейчас, уже было в базе (запись
+# пропущена по конфликту id) или отложено в файл очереди
+STORED = "stored"
+DUPLICATE = "duplicate"
+QUEUED = "queued"
+
+
+class IngestStats:
+    def __init__(self):
+        self.messages = 0
+        self.batches = 0
+        self.max_batch = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.write_total = 0.0
+
+    def as_dict(self, queued: int) -> dict:
+        return {
+            "mode": settings.INGEST_MODE,
+            "queued": queued,
+            "messages": self.messages,
+            "batches": self.batches,
+            "avg_batch": (
+                round(self.messages / self.batches, 1) if self.batches else None
+            ),
+            "max_batch": self.max_batch,
+            "write_avg_ms": (
+                round(self.write_total / self.batches * 1000, 2)
+                if self.batches
+                else None
+            ),
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+        }
+
+
+class Ingestor:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=settings.INGEST_QUEUE_SIZE)
+        self.stats = IngestStats()
+        self.spill_path = os.path.join(
+            settings.INGEST_SPILL_DIR, f"ingest-{os.getpid()}.jsonl"
+        )
+        self.writer = None
+        self.replayer = None
+        self.last_replay = 0.0
+
+    async def start(self):
+        os.makedirs(settings.INGEST_SPILL_DIR, exist_ok=True)
+        self.writer = asyncio.create_task(self.run())
+
+    # Дописывает то, что уже в очереди, и останавливает запись
+    async def stop(self):
+        if self.writer is None:
+            return
+        await self.queue.join()
+        self.writer.cancel()
+        self.writer = None
+        # прерванное переигрывание оставило бы забранный файл без хозяина
+        if self.replayer is not None:
+            await self.replayer
+            self.replayer = None
+
+    # Возвращает статус, когда сообщение записано в базу или в файл. Полная
+    # очередь притормаживает обработчики, а не растет без предела.
+    async def submit(self, message) -> str:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((to_item(message), future))
+        return await future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            # пока пишется предыдущая пачка, очередь сама набирает следующую;
+            # при малой нагрузке ждем соседей не дольше INGEST_FLUSH_INTERVAL
+            deadline = time.monotonic() + settings.INGEST_FLUSH_INTERVAL
+            while len(batch) < settings.INGEST_BATCH_SIZE:
+                if self.queue.empty():
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.queue.get_nowait())
+            try:
+                await self.flush(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def flush(self, batch: list):
+        items = [item for item, _ in batch]
+        inserted = None
+        error = None
+        started = time.monotonic()
+        try:
+            async with async_engine.begin() as conn:
+                rows = await conn.run_sync(insert_messages, items)
+            # коммит прошел: только теперь строки считаются записанными
+            inserted = rows
+            self.stats.batches += 1
+            self.stats.messages += len(items)
+            self.stats.max_batch = max(self.stats.max_batch, len(items))
+            self.stats.write_total += time.monotonic() - started
+        except Exception:
+            logger.exception("Не удалось записать пачку сообщений, пишем в файл")
+            try:
+                await asyncio.to_thread(self.spill, items)
+                self.stats.spilled += len(items)
+            except Exception as exc:
+                error = exc
+        ids = {item["id"] for item in inserted or ()}
+        for item, future in batch:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            elif inserted is None:
+                future.set_result(QUEUED)
+            else:
+                future.set_result(STORED if item["id"] in ids else DUPLICATE)
+        # база снова доступна - пора дописать то, что копилось в файлах.
+        # Переигрывание идет своей задачей и не задерживает следующие пачки
+        if inserted is not None and (self.replayer is None or self.replayer.done()):
+            self.replayer = asyncio.create_task(self.replay())
+
+    def spill(self, items: list[dict]):
+        with open(self.spill_path, "a", encoding="utf-8") as file:
+            for item in items:
+                file.write(json.dumps(item) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    # Файлы этого процесса и процессов, которых больше нет. Запускается после
+    # успешной записи, но не чаще раза в INGEST_REPLAY_INTERVAL секунд.
+    async def replay(self):
+        try:
+            await self.replay_files()
+        except Exception:
+            logger.exception("Ошибка при переигрывании файлов очереди")
+
+    async def replay_files(self):
+        if time.monotonic() - self.last_replay < settings.INGEST_REPLAY_INTERVAL:
+            return
+        self.last_replay = time.monotonic()
+        for path in glob.glob(
+            os.path.join(settings.INGEST_SPILL_DIR, "ingest-*.jsonl")
+        ):
+            if path != self.spill_path and process_alive(path):
+                continue
+            claimed = f"{path}.replay-{os.getpid()}"
+            try:
+                # переименование атомарно: файл забирает только один воркер
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+            items = await asyncio.to_thread(read_spill, claimed)
+            inserted = []
+            try:
+                for start in range(0, len(items), settings.INGEST_BATCH_SIZE):
+                    async with async_engine.begin() as conn:
+                        inserted += await conn.run_sync(
+                            insert_messages,
+                            items[start : start + settings.INGEST_BATCH_SIZE],
+                        )
+            except Exception:
+                # база снова недоступна: все вернется в свой файл, уже
+                # записанная часть при следующей попытке будет пропущена
+                logger.exception("Не удалось переиграть %s", path)
+                await asyncio.to_thread(self.spill, items)
+                os.remove(claimed)
+                return
+            os.remove(claimed)
+            self.stats.replayed += len(inserted)
+            logger.info("Из %s записано %d сообщений", path, len(inserted))
+            await remember_messages([from_item(item) for item in inserted])
+
+
+def read_spill(path: str) -> list[dict]:
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def process_alive(path: str) -> bool:
+    try:
+        pid = int(os.path.basename(path)[len("ingest-") : -len(".jsonl")])
+        os.kill(pid, 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+ingestor = Ingestor() if settings.INGEST_MODE == "batched" else None
+
+
+# Запись одного сообщения из обработчика: сразу своей транзакцией или через
+# общую очередь, в зависимости от INGEST_MODE. Счетчики непрочитанных
+# увеличиваются в той же транзакции, что и запись сообщения. Рассылать
+# сообщение и класть его в кэш можно, только если вернулся STORED.
+async def save_message(session, message) -> str:
+    if ingestor is None:
+        session.add(message)
+        await session.flush()
+        connection = await session.connection()
+        await connection.run_sync(count_unread, [to_item(message)])
+        await session.commit()
+        await session.refresh(message)
+        return STORED
+    return await ingestor.submit(message)
+
+
+# статус отправки для ответа клиенту
+def sent_status(saved: str) -> str:
+    return "queued" if saved == QUEUED else "ok"
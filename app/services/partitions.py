@@ -0,0 +1,80 @@
+# Помесячные секции Messages и GroupMessages. Секции создаются заранее, на
+# MESSAGE_PARTITIONS_AHEAD месяцев вперед, задачей create_message_partitions
+# (celery beat): секции по умолчанию нет, и вставка с send_time за последней
+# секцией завершится ошибкой. Все, что было до секционирования, лежит в
+# "<таблица>_legacy".
+
+import re
+from datetime import datetime
+
+from sqlalchemy import text
+
+from models.allmodels import utcnow
+
+PARTITIONED_TABLES = ("Messages", "GroupMessages")
+UPPER_BOUND = re.compile(r"TO \('([^']+)'\)")
+# "<таблица>_<год>_<месяц>" или "<таблица>_legacy"
+PARTITION_NAME = re.compile(
+    rf"({'|'.join(PARTITIONED_TABLES)})_(legacy|\d{{4}}_\d{{2}})"
+)
+
+
+# Секции в моделях не описаны: автогенерация alembic их пропускает
+def is_partition(name: str) -> bool:
+    return PARTITION_NAME.fullmatch(name) is not None
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    month = value.month - 1 + months
+    return value.replace(year=value.year + month // 12, month=month % 12 + 1, day=1)
+
+
+def month_start(value: datetime) -> datetime:
+    return value.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+# верхняя граница последней секции таблицы или None, если секций нет
+def last_upper_bound(conn, table: str) -> datetime | None:
+    bounds = conn.execute(
+        text(
+            "SELECT pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "WHERE i.inhparent = CAST(:table AS regclass)"
+        ),
+        {"table": f'"{table}"'},
+    ).scalars()
+    uppers = [
+        datetime.fromisoformat(match.group(1))
+        for bound in bounds
+        if (match := UPPER_BOUND.search(bound))
+    ]
+    return max(uppers, default=None)
+
+
+# Создает недостающие секции до начала месяца, наступающего через
+# months_ahead месяцев. Возвращает имена созданных секций.
+def ensure_partitions(conn, months_ahead: int) -> list[str]:
+    now = utcnow()
+    horizon = add_months(month_start(now), months_ahead + 1)
+    # CREATE TABLE ... PARTITION OF ненадолго блокирует всю таблицу: не
+    # ждем в очереди за долгими запросами, задача повторится на следующий день
+    conn.execute(text("SET LOCAL lock_timeout = '5s'"))
+    created = []
+    for table in PARTITIONED_TABLES:
+        conn.execute(
+            text("SELECT pg_advisory_xact_lock(hashtext(:key))"),
+            {"key": f"partitions:{table}"},
+        )
+        start = last_upper_bound(conn, table) or month_start(now)
+        while start < horizon:
+            end = add_months(start, 1)
+            name = f"{table}_{start:%Y_%m}"
+            conn.execute(
+                text(
+                    f'CREATE TABLE "{name}" PARTITION OF "{table}" '
+                    f"FOR VALUES FROM ('{start}') TO ('{end}')"
+                )
+            )
+            created.append(name)
+            start = end
+    return created
@@ -0,0 +1,101 @@
+# Хэширование и проверка паролей. bcrypt специально медленный, поэтому он
+# выполняется в отдельном пуле потоков (bcrypt отпускает GIL) и не блокирует
+# event loop с WebSocket-подключениями. Если очередь длиннее
+# PASSWORD_HASH_QUEUE_SIZE, запрос сразу получает 503.
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+from config import settings
+from exceptions import PasswordQueueFullException
+
+# min_rounds = max_rounds: хэши с другой стоимостью считаются устаревшими и
+# пересчитываются при следующем успешном входе
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+    bcrypt__max_rounds=settings.BCRYPT_ROUNDS,
+)
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.PASSWORD_HASH_WORKERS, thread_name_prefix="passwords"
+)
+
+
+class PoolStats:
+    def __init__(self):
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.run_total = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "workers": settings.PASSWORD_HASH_WORKERS,
+            "queue_size": settings.PASSWORD_HASH_QUEUE_SIZE,
+            "queued": self.queued,
+            "in_flight": self.in_flight,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "wait_avg_ms": (
+                round(self.wait_total / self.completed * 1000, 2)
+                if self.completed
+                else None
+            ),
+            "wait_max_ms": round(self.wait_max * 1000, 2),
+            "run_avg_ms": (
+                round(self.run_total / self.completed * 1000, 2)
+                if self.completed
+                else None
+            ),
+        }
+
+
+stats = PoolStats()
+
+
+# Вся статистика меняется только в event loop. Потоки пула заняты не больше
+# чем PASSWORD_HASH_WORKERS задачами: остальные ждут на семафоре, это и есть
+# очередь.
+slots = asyncio.Semaphore(settings.PASSWORD_HASH_WORKERS)
+
+
+async def run_in_pool(func, *args):
+    if stats.queued >= settings.PASSWORD_HASH_QUEUE_SIZE:
+        stats.rejected += 1
+        raise PasswordQueueFullException()
+    submitted = time.monotonic()
+    stats.queued += 1
+    try:
+        await slots.acquire()
+    finally:
+        stats.queued -= 1
+    started = time.monotonic()
+    stats.in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        slots.release()
+        stats.in_flight -= 1
+        stats.completed += 1
+        stats.wait_total += started - submitted
+        stats.wait_max = max(stats.wait_max, started - submitted)
+        stats.run_total += time.monotonic() - started
+
+
+async def hash_password(password: str) -> str:
+    return await run_in_pool(pwd_context.hash, password)
+
+
+# Возвращает (пароль верный, новый хэш или None). Новый хэш приходит, если
+# сохраненный посчитан с другой стоимостью, и его нужно записать в базу.
+async def verify_password(password: str, hashed_password: str):
+    return await run_in_pool(pwd_context.verify_and_update, password, hashed_password)
@@ -0,0 +1,371 @@
+# Кэш последних сообщений переписок: первая страница истории и дельты по
+# after_id отдаются без обращения к Postgres. У каждой переписки (личный чат
+# или группа) в памяти воркера хранятся последние RECENT_HISTORY_SIZE
+# сообщений по (send_time, id); переписки вытесняются по LRU, когда общий
+# объем превышает RECENT_HISTORY_MAX_BYTES.
+# Каждый путь записи сообщений вызывает remember_messages (или, в celery,
+# recent_envelopes): сообщение добавляется в свой буфер и рассылается через
+# шину остальным воркерам. С RECENT_HISTORY_REDIS=true есть общий уровень -
+# список в Redis на переписку, из которого воркер заполняет буфер вместо
+# запроса к базе. Список считается полным, только пока есть его ключ
+# "<список>:ready": его ставит воркер, заполнивший список из базы. Redis -
+# только ускорение: при его ошибках история читается из базы, а отправка
+# сообщения не падает. Pub/sub доставляет не больше одного раза, поэтому
+# буфер перечитывается через RECENT_HISTORY_TTL секунд после заполнения:
+# воркер, пропустивший уведомление, отдает устаревшую страницу не дольше
+# этого.
+
+import asyncio
+import bisect
+import json
+import logging
+import time
+from collections import OrderedDict
+
+from redis.exceptions import RedisError, WatchError
+
+from config import settings
+from models.allmodels import GroupMessage, Message
+from services.bulk_writer import direct_row, group_row, to_item
+from services.cache import get_redis
+from services.history import encode_cursor, history_query
+from websocket import bus
+
+logger = logging.getLogger(__name__)
+
+RECENT_CHANNEL = "messenger:recent"
+# первый элемент списка в Redis, пока кто-то заполняет его из базы: список
+# уже существует, поэтому RPUSHX дописывает в него новые сообщения, а
+# заполняющий потом сливает их со своими. LTRIM при дописывании может
+# срезать эту метку, поэтому полноту списка показывает не она, а ready_key
+LOADING = "loading"
+LOADING_TTL = 60
+# оценка размера сообщения в памяти без текста
+MESSAGE_OVERHEAD = 500
+# Списки Redis, в которые не удалось дописать сообщения. Список с пропуском
+# нельзя считать полным: воркер не читает такие списки, а их ready_key
+# снимается при следующей удачной записи в Redis
+stale_lists = set()
+
+
+def conversation_key(message) -> tuple:
+    if isinstance(message, GroupMessage):
+        return ("group", message.group_id)
+    return ("direct", message.chat_id)
+
+
+def redis_key(key: tuple) -> str:
+    return f"recent:{key[0]}:{key[1]}"
+
+
+def ready_key(name: str) -> str:
+    return f"{name}:ready"
+
+
+# Сообщение из словаря очереди. send_time в нем такой же, как в строках из
+# базы (без часового пояса, в UTC), поэтому страницы из буфера дают те же
+# ETag, курсоры и тело ответа, что и страницы из базы
+def from_item(item: dict):
+    if item["kind"] == "group":
+        return GroupMessage(**group_row(item))
+    return Message(**direct_row(item))
+
+
+def sort_key(message):
+    return (message.send_time, message.id)
+
+
+class Entry:
+    # последние сообщения одной переписки по возрастанию (send_time, id)
+
+    def __init__(self, ttl: float):
+        self.messages = []
+        self.keys = []
+        self.ids = set()
+        self.size = 0
+        self.expires = time.monotonic() + ttl
+
+    # Возвращает, на сколько байт изменился размер
+    def add(self, message, capacity: int) -> int:
+        if message.id in self.ids:
+            return 0
+        key = sort_key(message)
+        if len(self.messages) >= capacity and key < self.keys[0]:
+            return 0
+        position = bisect.bisect(self.keys, key)
+        self.keys.insert(position, key)
+        self.messages.insert(position, message)
+        self.ids.add(message.id)
+        delta = MESSAGE_OVERHEAD + len(message.text.encode())
+        while len(self.messages) > capacity:
+            self.keys.pop(0)
+            dropped = self.messages.pop(0)
+            self.ids.discard(dropped.id)
+            delta -= MESSAGE_OVERHEAD + len(dropped.text.encode())
+        self.size += delta
+        return delta
+
+    # Страница из буфера: (сообщения, курсор after_id, курсор последнего
+    # сообщения) или None, если для ответа нужна база. since скрывает
+    # сообщения раньше вступления в группу.
+    def page(self, capacity: int, limit: int, after_id=None, since=None):
+        visible = self.messages
+        if since is not None:
+            visible = [m for m in visible if m.send_time >= since]
+        # старше буфера сообщений либо нет, либо они все скрыты since
+        complete = len(self.messages) < capacity or len(visible) < len(self.messages)
+        latest = encode_cursor(visible[-1].send_time, visible[-1].id) if visible else ""
+        if after_id is not None:
+            for index, message in enumerate(visible):
+                if message.id == after_id:
+                    after = encode_cursor(message.send_time, message.id)
+                    return visible[index + 1 : index + 1 + limit], after, latest
+            return None
+        if len(visible) < limit and not complete:
+            return None
+        return visible[-limit:], None, latest
+
+
+class RecentHistory:
+    def __init__(self, capacity: int, max_bytes: int, ttl: float):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # переписки, которые сейчас читаются из базы: future для остальных
+        # запросов и сообщения, пришедшие за время чтения
+        self.loading = {}
+        self.pending = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.redis_hits = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    async def page(
+        self, key, session, model, condition, limit, after_id=None, since=None
+    ):
+        if self.capacity <= 0:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None and entry.expires < time.monotonic():
+            self.drop(key)
+            self.expirations += 1
+            entry = None
+        if entry is not None:
+            self.entries.move_to_end(key)
+        else:
+            entry = await self.fill(key, session, model, condition)
+            if entry is None:
+                self.misses += 1
+                return None
+        result = entry.page(self.capacity, limit, after_id, since)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    async def fill(self, key, session, model, condition):
+        waiter = self.loading.get(key)
+        if waiter is not None:
+            return await waiter
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        self.pending[key] = []
+        entry = None
+        try:
+            messages = await self.load(key, session, model, condition)
+            entry = Entry(self.ttl)
+            for message in messages + self.pending[key]:
+                entry.add(message, self.capacity)
+            self.entries[key] = entry
+            self.size += entry.size
+            self.evict()
+        finally:
+            del self.loading[key], self.pending[key]
+            # ожидающие при ошибке просто идут в базу сами
+            future.set_result(entry)
+        return entry
+
+    async def load(self, key, session, model, condition):
+        use_redis = settings.RECENT_HISTORY_REDIS and redis_key(key) not in stale_lists
+        if use_redis:
+            try:
+                messages = await self.load_redis(key)
+            except RedisError:
+                logger.warning("Redis недоступен, история читается из базы")
+                messages = None
+                use_redis = False
+            if messages is not None:
+                self.redis_hits += 1
+                return messages
+        query = history_query(model, condition, None, None).limit(self.capacity)
+        messages = list((await session.exec(query)).all())
+        messages.reverse()
+        if use_redis:
+            try:
+                await self.seed_redis(key, messages)
+            except RedisError:
+                logger.warning("Не удалось заполнить список в Redis")
+        return messages
+
+    # Сообщения из Redis или None, если список не заполнен. Пустой список
+    # помечается LOADING, чтобы сообщения, записанные пока идет чтение из
+    # базы, не потерялись. Неполный список без метки (заполнявший воркер
+    # упал) просто заполняется заново: seed_redis сливает его с базой
+    async def load_redis(self, key):
+        name = redis_key(key)
+        async with get_redis().pipeline(transaction=False) as pipe:
+            pipe.lrange(name, 0, -1)
+            pipe.exists(ready_key(name))
+            raw, ready = await pipe.execute()
+        if not raw:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                pipe.delete(ready_key(name))
+                pipe.rpush(name, LOADING)
+                pipe.expire(name, LOADING_TTL)
+                await pipe.execute()
+            return None
+        if not ready:
+            return None
+        messages = sorted(
+            (from_item(json.loads(item)) for item in raw if item != LOADING),
+            key=sort_key,
+        )
+        return messages[-self.capacity :]
+
+    # Сливает прочитанное из базы с тем, что успело прийти в список
+    async def seed_redis(self, key, messages):
+        name = redis_key(key)
+        async with get_redis().pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    await pipe.watch(name, ready_key(name))
+                    raw = await pipe.lrange(name, 0, -1)
+                    # метка истекла: дописанное за это время могло пропасть;
+                    # или список уже заполнил другой воркер
+                    if not raw or await pipe.exists(ready_key(name)):
+                        return
+                    entry = Entry(self.ttl)
+                    for message in messages + [
+                        from_item(json.loads(item)) for item in raw if item != LOADING
+                    ]:
+                        entry.add(message, self.capacity)
+                    pipe.multi()
+                    pipe.delete(name)
+                    if entry.messages:
+                        pipe.rpush(
+                            name, *(json.dumps(to_item(m)) for m in entry.messages)
+                        )
+                        pipe.expire(name, settings.RECENT_HISTORY_REDIS_TTL)
+                        pipe.set(
+                            ready_key(name), 1, ex=settings.RECENT_HISTORY_REDIS_TTL
+                        )
+                    await pipe.execute()
+                    return
+                except WatchError:
+                    continue
+
+    def append(self, message):
+        key = conversation_key(message)
+        if key in self.pending:
+            self.pending[key].append(message)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.size += entry.add(message, self.capacity)
+            self.evict()
+
+    def drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.size
+
+    def evict(self):
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "conversations": len(self.entries),
+            "messages": sum(len(entry.messages) for entry in self.entries.values()),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else None,
+            "redis_hits": self.redis_hits,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+recent_history = RecentHistory(
+    settings.RECENT_HISTORY_SIZE,
+    settings.RECENT_HISTORY_MAX_BYTES,
+    settings.RECENT_HISTORY_TTL,
+)
+
+
+# Уведомление о новых сообщениях для буферов всех воркеров: пары для
+# bus.publish_sync (celery); сообщения - словари в формате services/bulk_writer
+def recent_envelopes(items: list[dict]) -> list[tuple[str, str]]:
+    return [(RECENT_CHANNEL, json.dumps(items))] if items else []
+
+
+# Дописывает сообщения в списки Redis, которые уже заполнены (RPUSHX), и
+# возвращает имена списков; pipe - конвейер синхронного или асинхронного
+# клиента
+def redis_appends(pipe, items: list[dict]) -> set[str]:
+    names = set()
+    for item in items:
+        message = from_item(item)
+        name = redis_key(conversation_key(message))
+        pipe.rpushx(name, json.dumps(to_item(message)))
+        pipe.ltrim(name, -settings.RECENT_HISTORY_SIZE, -1)
+        pipe.expire(name, settings.RECENT_HISTORY_REDIS_TTL)
+        pipe.expire(ready_key(name), settings.RECENT_HISTORY_REDIS_TTL)
+        names.add(name)
+    return names
+
+
+# Вызывается после записи сообщений: свой буфер обновляется сразу (чтобы
+# отправитель увидел сообщение в следующем же запросе), остальные воркеры -
+# через шину
+async def remember_messages(messages: list):
+    if not messages or settings.RECENT_HISTORY_SIZE <= 0:
+        return
+    # в буфер кладутся копии с send_time в виде, как из базы
+    items = [to_item(message) for message in messages]
+    for item in items:
+        recent_history.append(from_item(item))
+    await bus.publish(RECENT_CHANNEL, json.dumps(items))
+    if settings.RECENT_HISTORY_REDIS:
+        await append_redis(items)
+
+
+# Сообщение уже в базе: ошибка Redis не должна превращаться в ошибку
+# отправки. Список, в который не дописали, помечается в stale_lists
+async def append_redis(items: list[dict]):
+    dropped = set(stale_lists)
+    names = set()
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            for name in dropped:
+                pipe.delete(ready_key(name))
+            names = redis_appends(pipe, items)
+            await pipe.execute()
+    except RedisError:
+        logger.warning("Не удалось дописать сообщения в Redis")
+        stale_lists.update(names)
+        return
+    stale_lists.difference_update(dropped)
+
+
+async def on_recent_appended(data: str):
+    for item in json.loads(data):
+        recent_history.append(from_item(item))
@@ -0,0 +1,109 @@
+# Полнотекстовый поиск по сообщениям переписок пользователя. Совпадения
+# ищутся по GIN-индексу колонки search (models/allmodels.py), результаты
+# упорядочены по релевантности, затем от новых к старым. Пагинация по
+# ключу (rank, send_time, id), как у истории; фрагменты с подсветкой
+# строятся только для сообщений страницы.
+
+import base64
+from datetime import datetime
+from uuid import UUID
+
+from fastapi import HTTPException, status
+from sqlalchemy import and_, func, null, tuple_, union_all
+from sqlmodel import select
+
+from models.allmodels import Chat, GroupChatMembers, GroupMessage, Message
+
+# до двух фрагментов по 5-20 слов, совпадения обрамляются <b></b>
+HEADLINE_OPTIONS = "MaxFragments=2, MaxWords=20, MinWords=5"
+
+
+# ts_headline возвращает текст как есть, а фрагмент отдается клиенту как
+# HTML: текст экранируется заранее, и единственной разметкой в нем остаются
+# <b></b> самого ts_headline
+def html_escape(text):
+    for char, entity in (("&", "&amp;"), ("<", "&lt;"), (">", "&gt;")):
+        text = func.replace(text, char, entity)
+    return text
+
+
+def encode_search_cursor(rank: float, send_time: datetime, message_id: UUID) -> str:
+    raw = f"{rank!r}|{send_time.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> tuple[float, datetime, UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        rank, send_time, message_id = raw.split("|")
+        return float(rank), datetime.fromisoformat(send_time), UUID(message_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Некорректный курсор"
+        )
+
+
+def search_query(user_id: UUID, text: str, after: str | None, limit: int):
+    # строка разбирается обеими конфигурациями, подходит совпадение в любой
+    # из них (|| для tsquery - это ИЛИ)
+    query = func.websearch_to_tsquery("russian", text).op("||")(
+        func.websearch_to_tsquery("english", text)
+    )
+    direct_search = Message.__table__.c.search
+    group_search = GroupMessage.__table__.c.search
+    direct = (
+        select(
+            Message.id,
+            Message.chat_id,
+            null().label("group_id"),
+            Message.sender,
+            Message.user2,
+            Message.text,
+            Message.send_time,
+            func.ts_rank(direct_search, query).label("rank"),
+        )
+        .join(Chat, Chat.id == Message.chat_id)
+        .where(Chat.users.contains([user_id]), direct_search.op("@@")(query))
+    )
+    # в группах видны только сообщения после вступления
+    group = (
+        select(
+            GroupMessage.id,
+            null(),
+            GroupMessage.group_id,
+            GroupMessage.sender,
+            null(),
+            GroupMessage.text,
+            GroupMessage.send_time,
+            func.ts_rank(group_search, query),
+        )
+        .join(
+            GroupChatMembers,
+            and_(
+                GroupChatMembers.group_id == GroupMessage.group_id,
+                GroupChatMembers.user_id == user_id,
+            ),
+        )
+        .where(
+            group_search.op("@@")(query),
+            GroupMessage.send_time >= GroupChatMembers.joined_at,
+        )
+    )
+    hits = union_all(direct, group).subquery("hits")
+    page = select(hits)
+    if after:
+        page = page.where(
+            tuple_(hits.c.rank, hits.c.send_time, hits.c.id)
+            < decode_search_cursor(after)
+        )
+    page = (
+        page.order_by(hits.c.rank.desc(), hits.c.send_time.desc(), hits.c.id.desc())
+        .limit(limit)
+        .subquery("page")
+    )
+    return select(
+        page,
+        func.ts_headline(
+            "russian", html_escape(page.c.text), query, HEADLINE_OPTIONS
+        ).label("snippet"),
+    ).order_by(page.c.rank.desc(), page.c.send_time.desc(), page.c.id.desc())
@@ -0,0 +1,159 @@
+# Счетчики непрочитанных сообщений (UnreadCounters). Каждый путь записи
+# сообщений увеличивает их в той же транзакции через count_unread, поэтому
+# GET /unread - один запрос по индексу, без подсчета сообщений.
+# Прочитанное отмечается водяным знаком (временем последнего прочитанного
+# сообщения), а счетчик при этом пересчитывается по сообщениям новее знака.
+
+from collections import Counter
+from datetime import datetime
+from uuid import UUID, uuid4
+
+from sqlalchemy import Integer, and_, column, delete, func, or_, values
+from sqlalchemy.dialects.postgresql import UUID as saUUID
+from sqlalchemy.dialects.postgresql import insert
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models.allmodels import Chat, GroupChatMembers, UnreadCounter
+
+
+def increment(stmt, key: str):
+    return stmt.on_conflict_do_update(
+        index_elements=["user_id", key],
+        set_={"unread": UnreadCounter.unread + stmt.excluded.unread},
+    )
+
+
+# Вызывается на синхронном соединении (conn.run_sync) сразу после вставки
+# items - сообщений в формате services/bulk_writer. Сообщения считаются
+# пачкой: на каждого получателя одна строка, сколько бы сообщений ему ни
+# пришло. Строки обновляются в одном порядке, чтобы параллельные пачки не
+# ждали друг друга по кругу.
+def count_unread(conn, items: list[dict]):
+    direct, groups = Counter(), Counter()
+    for item in items:
+        if item["kind"] == "group":
+            groups[(item["group_id"], item["sender"])] += 1
+        elif item["user2"] != item["sender"]:
+            direct[(item["user2"], item["chat_id"])] += 1
+
+    if direct:
+        stmt = insert(UnreadCounter).values(
+            [
+                {
+                    "id": uuid4(),
+                    "user_id": UUID(user_id),
+                    "chat_id": UUID(chat_id),
+                    "unread": count,
+                }
+                for (user_id, chat_id), count in sorted(direct.items())
+            ]
+        )
+        conn.execute(increment(stmt, "chat_id"))
+
+    if groups:
+        # в группе сообщение непрочитано у всех участников, кроме отправителя
+        sent = values(
+            column("group_id", saUUID(as_uuid=True)),
+            column("sender", saUUID(as_uuid=True)),
+            column("messages", Integer),
+            name="sent",
+        ).data(
+            [
+                (UUID(group_id), UUID(sender), count)
+                for (group_id, sender), count in groups.items()
+            ]
+        )
+        query = (
+            select(
+                func.gen_random_uuid(),
+                GroupChatMembers.user_id,
+                GroupChatMembers.group_id,
+                func.sum(sent.c.messages),
+            )
+            .join(
+                sent,
+                and_(
+                    GroupChatMembers.group_id == sent.c.group_id,
+                    GroupChatMembers.user_id != sent.c.sender,
+                ),
+            )
+            .group_by(GroupChatMembers.user_id, GroupChatMembers.group_id)
+            .order_by(GroupChatMembers.user_id, GroupChatMembers.group_id)
+        )
+        stmt = insert(UnreadCounter).from_select(
+            ["id", "user_id", "group_id", "unread"], query
+        )
+        conn.execute(increment(stmt, "group_id"))
+
+
+# Время сообщения message_id в переписке или, без него, последнего сообщения
+def read_until_query(model, condition, message_id: UUID | None):
+    if message_id is not None:
+        return select(model.send_time).where(condition, model.id == message_id)
+    return select(func.max(model.send_time)).where(condition)
+
+
+# Переписка прочитана до read_until: счетчик становится числом чужих
+# сообщений новее этого времени. Водяной знак двигается только вперед, так
+# что запоздавший запрос с более старым временем ничего не откатит; при том
+# же времени счетчик пересчитывается (сообщение могло записаться с
+# опозданием, но со временем раньше знака).
+async def reset_unread(
+    session: AsyncSession,
+    user_id: UUID,
+    key: str,
+    conversation_id: UUID,
+    model,
+    condition,
+    read_until: datetime,
+):
+    unread = (
+        select(func.count())
+        .select_from(model)
+        .where(condition, model.sender != user_id, model.send_time > read_until)
+        .scalar_subquery()
+    )
+    stmt = insert(UnreadCounter).values(
+        id=uuid4(),
+        user_id=user_id,
+        unread=unread,
+        last_read_at=read_until,
+        **{key: conversation_id},
+    )
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=["user_id", key],
+            set_={"unread": stmt.excluded.unread, "last_read_at": read_until},
+            where=or_(
+                UnreadCounter.last_read_at.is_(None),
+                UnreadCounter.last_read_at <= read_until,
+            ),
+        )
+    )
+    await session.commit()
+
+
+# Вызывается при выходе из группы; коммит остается за вызывающим
+async def drop_unread(session: AsyncSession, user_id: UUID, group_id):
+    await session.execute(
+        delete(UnreadCounter).where(
+            UnreadCounter.user_id == user_id, UnreadCounter.group_id == group_id
+        )
+    )
+
+
+# Ненулевые счетчики пользователя; для личных чатов заодно пара участников,
+# чтобы отдать id собеседника
+def unread_query(user_id: UUID):
+    return (
+        select(
+            UnreadCounter.chat_id,
+            UnreadCounter.group_id,
+            UnreadCounter.unread,
+            UnreadCounter.last_read_at,
+            Chat.users,
+        )
+        .outerjoin(Chat, Chat.id == UnreadCounter.chat_id)
+        .where(UnreadCounter.user_id == user_id, UnreadCounter.unread > 0)
+    )
@@ -1,58 +1,51 @@
 from typing import Annotated
 from fastapi import Depends, HTTPException
 from fastapi.security import APIKeyHeader, OAuth2PasswordBearer
-from sqlmodel import Session
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from datetime import datetime, timedelta, timezone
 import jwt
-from db import get_session
+from db import async_session_maker, get_async_session
 from schemas.users import UserCreate, UserGet
 from models.allmodels import User
 from config import settings
-from passlib.context import CryptContext
 from schemas.token import TokenData
 from fastapi import status
-from sqlalchemy import select
-from fastapi import Request
+from fastapi import Request, WebSocket
+from starlette.requests import HTTPConnection
+from fastapi.encoders import jsonable_encoder
+import hashlib
+import json
+import time
+from services.cache import TTLCache, get_redis
+from websocket import bus
 
 
-def get_user(user: UserGet, session: Session = Depends(get_session)):
-    stmt = select(User).where(User.username == user.username)
-    row = session.exec(stmt).first()
-    if row is None:
-        return None
-    if isinstance(row, tuple) or hasattr(row, "_mapping"):
-        return row[0]
-    return row
+async def get_user(user: UserGet, session: AsyncSession):
+    return await get_user_by_name(username=user.username, session=session)
 
 
-def get_user_by_name(username: str, session: Session):
+async def get_user_by_name(username: str, session: AsyncSession):
     stmt = select(User).where(User.username == username)
-    result = session.exec(stmt).first()
-    if result is None:
-        return None
-    if isinstance(result, tuple) or hasattr(result, "_mapping"):
-        return result[0]
-    return result
+    result = await session.exec(stmt)
+    return result.first()
 
 
-def get_user_by_id(userid: str, session: Session):
+async def get_user_by_id(userid: str, session: AsyncSession):
     stmt = select(User).where(User.id == userid)
-    user = session.exec(stmt).first()
-    if isinstance(user, tuple) or hasattr(user, "_mapping"):
-        return user[0]
-    return user
+    result = await session.exec(stmt)
+    return result.first()
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 api_key_header = APIKeyHeader(name="Authorization", auto_error=False)
 
 
-def register_user(user_data: UserCreate, session: Session):
+async def register_user(user_data: UserCreate, session: AsyncSession):
     user = User(**user_data.model_dump())
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    await session.commit()
+    await session.refresh(user)
     return user
 
 
@@ -70,23 +63,42 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
+# access-токен из cookie или заголовка Authorization (для запросов и WebSocket)
+def get_access_token(connection: HTTPConnection):
+    token = connection.cookies.get("users_access_token")
+
+    if not token:
+        auth_header = connection.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            token = auth_header.split(" ")[1]
+
+    return token
+
+
 async def get_current_user(
     request: Request,
-    session: Annotated[Session, Depends(get_session)],
+    session: Annotated[AsyncSession, Depends(get_async_session)],
 ):
+    return await get_user_by_token(get_access_token(request), session)
+
+
+# Пользователь WebSocket-подключения: проверяется один раз при подключении,
+# сессия с базой нужна только на время проверки. None, если токен не подошел.
+async def get_websocket_user(websocket: WebSocket):
+    async with async_session_maker() as session:
+        try:
+            return await get_user_by_token(get_access_token(websocket), session)
+        except HTTPException:
+            return None
+
+
+async def get_user_by_token(token: str | None, session: AsyncSession):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    token = request.cookies.get("users_access_token")
-
-    if not token:
-        auth_header = request.headers.get("Authorization")
-        if auth_header and auth_header.startswith("Bearer "):
-            token = auth_header.split(" ")[1]
-
     if not token:
         raise credentials_exception
 
@@ -101,13 +113,107 @@ async def get_current_user(
     except jwt.InvalidTokenError:
         raise credentials_exception
 
-    user = get_user_by_id(userid=token_data.user_id, session=session)
+    # токен уже проверен, поэтому пользователя можно взять из кэша; запись
+    # живет не дольше самого токена
+    key = principal_key(token_data.user_id, token)
+    ttl = payload.get("exp", 0) - time.time()
+    user = await get_cached_principal(key)
+    if user is not None:
+        return user
+
+    user = await get_user_by_id(userid=token_data.user_id, session=session)
     if user is None:
         raise credentials_exception
 
+    await cache_principal(key, user, ttl)
     return user
 
 
+# Кэш пользователей по (user_id, токен): get_current_user вызывается на каждый
+# запрос, включая ежесекундный опрос сообщений. Первый уровень - в памяти
+# воркера, второй (PRINCIPAL_CACHE_REDIS) - общий для всех воркеров в Redis.
+# Хэш пароля в кэш не попадает: тем, кто получает пользователя по токену, он
+# не нужен.
+principal_cache = TTLCache(settings.PRINCIPAL_CACHE_SIZE, settings.PRINCIPAL_CACHE_TTL)
+# по этому каналу воркеры сообщают друг другу, чьи записи надо сбросить
+PRINCIPAL_CHANNEL = "messenger:principal"
+
+
+def principal_key(user_id, token: str):
+    return (str(user_id), hashlib.sha256(token.encode()).hexdigest())
+
+
+def redis_principal_key(key):
+    return f"principal:{key[0]}:{key[1]}"
+
+
+def load_principal(data: dict):
+    return User.model_validate({**data, "hashed_password": ""})
+
+
+async def get_cached_principal(key):
+    data = principal_cache.get(key)
+    if data is None and settings.PRINCIPAL_CACHE_REDIS:
+        raw = await get_redis().get(redis_principal_key(key))
+        if raw is not None:
+            data = json.loads(raw)
+            principal_cache.set(key, data)
+    # каждый запрос получает свой объект, чтобы изменения в обработчике не
+    # попадали в кэш
+    return load_principal(data) if data is not None else None
+
+
+async def cache_principal(key, user: User, ttl: float):
+    if ttl <= 0:
+        return
+    data = jsonable_encoder(user.model_dump(exclude={"hashed_password"}))
+    principal_cache.set(key, data, ttl)
+    if settings.PRINCIPAL_CACHE_REDIS:
+        await get_redis().set(
+            redis_principal_key(key),
+            json.dumps(data),
+            ex=max(1, int(min(ttl, settings.PRINCIPAL_CACHE_TTL))),
+        )
+
+
+def drop_local_principal(user_id: str, token_hash: str | None = None):
+    if token_hash is None:
+        principal_cache.delete_where(lambda key: key[0] == user_id)
+    else:
+        principal_cache.delete((user_id, token_hash))
+
+
+async def on_principal_invalidated(data: str):
+    message = json.loads(data)
+    drop_local_principal(message["user_id"], message.get("token"))
+
+
+# Сбрасывает закэшированного пользователя на всех воркерах: все его токены
+# или только один. Нужно вызывать при изменении или удалении пользователя.
+# Сейчас его вызывает только выход (routers/users.py): смены пароля и
+# отзыва refresh-токенов в приложении нет, а access-токен - JWT, который
+# и без кэша действует до своего exp. Запись кэша живет не дольше токена и
+# PRINCIPAL_CACHE_TTL, поэтому кэш не продлевает доступ сверх того, что
+# дает сам токен. Пересчет хэша при входе кэш не трогает: хэша в нем нет.
+# Когда появятся смена пароля или отзыв токенов, они должны вызывать эту
+# функцию без token, чтобы сбросить все токены пользователя.
+async def invalidate_principal(user_id, token: str | None = None):
+    user_id = str(user_id)
+    token_hash = principal_key(user_id, token)[1] if token else None
+    drop_local_principal(user_id, token_hash)
+    if settings.PRINCIPAL_CACHE_REDIS:
+        client = get_redis()
+        if token_hash is None:
+            keys = [k async for k in client.scan_iter(f"principal:{user_id}:*")]
+        else:
+            keys = [redis_principal_key((user_id, token_hash))]
+        if keys:
+            await client.delete(*keys)
+    await bus.publish(
+        PRINCIPAL_CHANNEL, json.dumps({"user_id": user_id, "token": token_hash})
+    )
+
+
 def create_refresh_token(data: dict):
     to_encode = data.copy()
 
@@ -120,9 +226,9 @@ def create_refresh_token(data: dict):
     return encoded_jwt
 
 
-def get_current_user_refresh(
+async def get_current_user_refresh(
     request: Request,
-    session: Annotated[Session, Depends(get_session)],
+    session: Annotated[AsyncSession, Depends(get_async_session)],
 ):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -151,7 +257,7 @@ def get_current_user_refresh(
     except jwt.InvalidTokenError:
         raise credentials_exception
 
-    user = get_user_by_id(userid=token_data.user_id, session=session)
+    user = await get_user_by_id(userid=token_data.user_id, session=session)
     if user is None:
         raise credentials_exception
 
@@ -0,0 +1,86 @@
+# Тесты с базой идут против настоящего Postgres: адрес пустой базы берется из
+# TEST_POSTGRES_URL (все таблицы в ней пересоздаются), без него такие тесты
+# пропускаются. Запуск из каталога app: TEST_POSTGRES_URL=... pytest tests
+# Приложение работает с шиной в памяти процесса, Redis не нужен.
+
+import os
+import sys
+from uuid import uuid4
+
+import pytest
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEST_POSTGRES_URL = os.getenv("TEST_POSTGRES_URL")
+
+os.environ["POSTGRES_URL"] = TEST_POSTGRES_URL or "postgresql+psycopg2://localhost/test"
+os.environ.pop("ASYNC_POSTGRES_URL", None)
+os.environ["BUS_BACKEND"] = "memory"
+os.environ["RECENT_HISTORY_REDIS"] = "false"
+os.environ["PRINCIPAL_CACHE_REDIS"] = "false"
+os.environ.setdefault("SECRET_KEY", "test-secret")
+sys.path.insert(0, APP_DIR)
+# статика и шаблоны подключаются по путям относительно app
+os.chdir(APP_DIR)
+
+
+@pytest.fixture
+def database():
+    if TEST_POSTGRES_URL is None:
+        pytest.skip("TEST_POSTGRES_URL не задан")
+    from sqlalchemy import text
+    from sqlmodel import SQLModel
+
+    import models.allmodels  # noqa: F401
+    from db import engine
+    from services.partitions import ensure_partitions
+
+    with engine.begin() as conn:
+        conn.execute(text("DROP SCHEMA public CASCADE"))
+        conn.execute(text("CREATE SCHEMA public"))
+        SQLModel.metadata.create_all(conn)
+        ensure_partitions(conn, 1)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def client(database):
+    from fastapi.testclient import TestClient
+
+    from db import async_engine
+    from main import app
+    from services.groupchats import delivered_cache, membership_cache
+    from services.recent import recent_history
+
+    with TestClient(app) as test_client:
+        yield test_client
+        # соединения пула привязаны к event loop клиента, который сейчас
+        # закроется
+        test_client.portal.call(async_engine.dispose)
+    for cache in (membership_cache, delivered_cache):
+        cache.clear()
+    recent_history.entries.clear()
+    recent_history.size = 0
+
+
+# Пользователь в базе и заголовки с его access-токеном
+@pytest.fixture
+def make_user(database):
+    from sqlmodel import Session
+
+    from models.allmodels import User
+    from services.users import create_access_token
+
+    def make(username: str | None = None):
+        username = username or f"user-{uuid4().hex[:8]}"
+        user = User(
+            username=username, email=f"{username}@example.com", hashed_password="-"
+        )
+        with Session(database) as session:
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+        token = create_access_token({"sub": str(user.id)})
+        return user, {"Authorization": f"Bearer {token}"}
+
+    return make
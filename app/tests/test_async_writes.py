@@ -0,0 +1,97 @@
+# Записи через асинхронную сессию (asyncpg): asyncpg не принимает время с
+# часовым поясом для колонок timestamp, поэтому каждая вставка проходит
+# через настоящую базу.
+
+from sqlmodel import Session, select
+
+from models.allmodels import (
+    GroupChat,
+    GroupChatMembers,
+    GroupMessage,
+    Message,
+    ScheduledMessage,
+)
+
+
+def test_direct_message_is_stored(client, make_user, database):
+    sender, headers = make_user()
+    recipient, _ = make_user()
+
+    response = client.post(
+        "/messages",
+        json={"recipient_id": str(recipient.id), "content": "привет"},
+        headers=headers,
+    )
+
+    assert response.status_code == 200
+    with Session(database) as session:
+        message = session.exec(select(Message)).one()
+    assert message.text == "привет"
+    assert message.send_time.tzinfo is None
+
+
+def test_group_create_join_and_send(client, make_user, database):
+    owner, headers = make_user()
+    member, _ = make_user()
+    late, _ = make_user()
+
+    response = client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [member.username]},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    with Session(database) as session:
+        group = session.exec(select(GroupChat)).one()
+    response = client.post(
+        "/group_chats/add_member",
+        json={"chat_id": str(group.id), "new_user": late.username},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    response = client.post(
+        "/group_chats/messages",
+        json={"chat_id": str(group.id), "text": "всем привет"},
+        headers=headers,
+    )
+
+    assert response.status_code == 200
+    with Session(database) as session:
+        members = session.exec(select(GroupChatMembers)).all()
+        message = session.exec(select(GroupMessage)).one()
+    assert group.created_at.tzinfo is None
+    assert len(members) == 3
+    assert message.send_time >= max(m.joined_at for m in members)
+
+
+def test_scheduled_messages_are_stored(client, make_user, database):
+    sender, headers = make_user()
+    recipient, _ = make_user()
+    client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [recipient.username]},
+        headers=headers,
+    )
+    with Session(database) as session:
+        group = session.exec(select(GroupChat)).one()
+
+    direct = client.post(
+        "/messages_late",
+        json={
+            "message": {"recipient_id": str(recipient.id), "content": "позже"},
+            "time": 5,
+        },
+        headers=headers,
+    )
+    grouped = client.post(
+        "/group_chats/messages_late",
+        json={"message": {"chat_id": str(group.id), "text": "позже"}, "time": 5},
+        headers=headers,
+    )
+
+    assert direct.status_code == 200
+    assert grouped.status_code == 200
+    with Session(database) as session:
+        scheduled = session.exec(select(ScheduledMessage)).all()
+    assert len(scheduled) == 2
+    assert all(row.due_at > row.created_at for row in scheduled)
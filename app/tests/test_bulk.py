@@ -0,0 +1,75 @@
+# Рассылка пачкой (POST /messages/bulk): результат для каждого сообщения в
+# порядке запроса, недостающие чаты создаются, ошибка одного получателя не
+# мешает остальным.
+
+from uuid import uuid4
+
+from sqlmodel import Session, select
+
+from config import settings
+from models.allmodels import Chat, Message, UnreadCounter
+
+
+def test_bulk_send(client, make_user, database):
+    sender, headers = make_user()
+    first, _ = make_user()
+    second, second_headers = make_user()
+    missing = uuid4()
+    # с first чат уже есть, с second создается рассылкой
+    client.post(
+        "/messages",
+        json={"recipient_id": str(first.id), "content": "раньше"},
+        headers=headers,
+    )
+
+    with client.websocket_connect("/ws", headers=second_headers) as socket:
+        response = client.post(
+            "/messages/bulk",
+            json={
+                "messages": [{"recipient_id": str(first.id), "content": "лично"}],
+                "recipient_ids": [str(missing), str(second.id)],
+                "content": "всем",
+            },
+            headers=headers,
+        )
+        pushed = socket.receive_json()
+
+    assert response.status_code == 200, response.text
+    results = response.json()
+    assert [(r["recipient_id"], r["status"]) for r in results] == [
+        (str(first.id), "ok"),
+        (str(missing), "error"),
+        (str(second.id), "ok"),
+    ]
+    assert results[1]["detail"] == "Пользователь не найден"
+    assert pushed["id"] == results[2]["id"]
+    assert pushed["content"] == "всем"
+    with Session(database) as session:
+        messages = {str(m.id): (m.user2, m.text) for m in session.exec(select(Message))}
+        chats = session.exec(select(Chat.users)).all()
+        unread = dict(
+            session.exec(select(UnreadCounter.user_id, UnreadCounter.unread)).all()
+        )
+    assert messages[results[0]["id"]] == (first.id, "лично")
+    assert messages[results[2]["id"]] == (second.id, "всем")
+    assert len(messages) == 3
+    assert sorted(map(sorted, chats)) == sorted(
+        [sorted([sender.id, first.id]), sorted([sender.id, second.id])]
+    )
+    assert unread == {first.id: 2, second.id: 1}
+
+
+def test_bulk_rejects_bad_batches(client, make_user, monkeypatch):
+    _, headers = make_user()
+    recipient, _ = make_user()
+    monkeypatch.setattr(settings, "MESSAGES_BULK_MAX_SIZE", 2)
+
+    def bulk(body):
+        return client.post("/messages/bulk", json=body, headers=headers)
+
+    empty = bulk({})
+    without_content = bulk({"recipient_ids": [str(recipient.id)]})
+    too_many = bulk({"recipient_ids": [str(recipient.id)] * 3, "content": "много"})
+
+    assert empty.status_code == without_content.status_code == 422
+    assert too_many.status_code == 422
@@ -0,0 +1,61 @@
+# Водяной знак доставки в группе (GroupChatMembers.last_delivered_at):
+# чтение истории его не двигает, двигают подтверждение по сокету и /read.
+
+from sqlmodel import Session, select
+
+from models.allmodels import GroupChat, GroupChatMembers, GroupMessage
+
+
+def delivered_at(database, user):
+    with Session(database) as session:
+        return session.exec(
+            select(GroupChatMembers.last_delivered_at).where(
+                GroupChatMembers.user_id == user.id
+            )
+        ).one()
+
+
+def send_time(database, text):
+    with Session(database) as session:
+        return session.exec(
+            select(GroupMessage.send_time).where(GroupMessage.text == text)
+        ).one()
+
+
+def test_delivered_watermark(client, make_user, database):
+    owner, owner_headers = make_user()
+    member, headers = make_user()
+    client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [member.username]},
+        headers=owner_headers,
+    )
+    with Session(database) as session:
+        group_id = str(session.exec(select(GroupChat.id)).one())
+    initial = delivered_at(database, member)
+
+    with client.websocket_connect("/group_chats/ws", headers=headers) as socket:
+        for text in ("1", "2"):
+            client.post(
+                "/group_chats/messages",
+                json={"chat_id": group_id, "text": text},
+                headers=owner_headers,
+            )
+        first = socket.receive_json()
+        socket.receive_json()
+        history = client.get(f"/group_chats/messages/{group_id}", headers=headers)
+        after_history = delivered_at(database, member)
+        socket.send_json(
+            {"type": "delivered", "chat_id": group_id, "message_id": first["id"]}
+        )
+        # ответа на подтверждение нет: ping после него обработан позже
+        socket.send_json({"type": "ping"})
+        assert socket.receive_json() == {"type": "pong"}
+    after_ack = delivered_at(database, member)
+
+    client.post("/group_chats/read", json={"chat_id": group_id}, headers=headers)
+
+    assert [m["text"] for m in history.json()] == ["1", "2"]
+    assert after_history == initial
+    assert after_ack == send_time(database, "1")
+    assert delivered_at(database, member) == send_time(database, "2")
@@ -0,0 +1,99 @@
+# Групповая запись сообщений (services/ingest.py, INGEST_MODE=batched):
+# сообщения из обработчиков пишутся пачками, при недоступной базе
+# откладываются в файл и переигрываются, когда запись снова проходит.
+
+import os
+
+import pytest
+from sqlmodel import Session, select
+
+from config import settings
+from models.allmodels import Message
+from services import ingest
+
+
+class DatabaseDown(Exception):
+    pass
+
+
+@pytest.fixture
+def ingestor(client, monkeypatch, tmp_path):
+    monkeypatch.setattr(settings, "INGEST_SPILL_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "INGEST_REPLAY_INTERVAL", 0)
+    batched = ingest.Ingestor()
+    monkeypatch.setattr(ingest, "ingestor", batched)
+    client.portal.call(batched.start)
+    yield batched
+    client.portal.call(batched.stop)
+
+
+def stored(database):
+    with Session(database) as session:
+        return sorted(session.exec(select(Message.text)).all())
+
+
+def test_messages_are_written_in_batches(client, make_user, database, ingestor):
+    _, headers = make_user()
+    recipient, recipient_headers = make_user()
+
+    with client.websocket_connect("/ws", headers=recipient_headers) as socket:
+        response = client.post(
+            "/messages",
+            json={"recipient_id": str(recipient.id), "content": "пачкой"},
+            headers=headers,
+        )
+        pushed = socket.receive_json()
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "ok"
+    assert pushed["content"] == "пачкой"
+    assert stored(database) == ["пачкой"]
+    assert ingestor.stats.batches == 1
+
+
+def test_failed_batch_is_queued_and_replayed(
+    client, make_user, database, ingestor, monkeypatch
+):
+    _, headers = make_user()
+    recipient, _ = make_user()
+    url = f"/messages/{recipient.id}"
+
+    def send(text):
+        return client.post(
+            "/messages",
+            json={"recipient_id": str(recipient.id), "content": text},
+            headers=headers,
+        )
+
+    # буфер последних сообщений заполнен до отказа базы
+    assert client.get(url, headers=headers).json() == []
+    insert_messages = ingest.insert_messages
+
+    def fail(conn, items):
+        raise DatabaseDown()
+
+    monkeypatch.setattr(ingest, "insert_messages", fail)
+    queued = send("отложенное")
+    spilled = os.path.exists(ingestor.spill_path)
+    # отложенного сообщения нет ни в базе, ни в кэше
+    before_replay = client.get(url, headers=headers).json()
+
+    monkeypatch.setattr(ingest, "insert_messages", insert_messages)
+    sent = send("после восстановления")
+
+    async def replayed():
+        await ingestor.replayer
+
+    client.portal.call(replayed)
+
+    assert queued.status_code == 202
+    assert queued.json()["status"] == "queued"
+    assert spilled
+    assert before_replay == []
+    assert sent.json()["status"] == "ok"
+    assert stored(database) == ["отложенное", "после восстановления"]
+    assert not os.path.exists(ingestor.spill_path)
+    assert ingestor.stats.spilled == ingestor.stats.replayed == 1
+    # переигранное сообщение попало и в кэш последних сообщений
+    history = client.get(url, headers=headers).json()
+    assert [m["text"] for m in history] == ["отложенное", "после восстановления"]
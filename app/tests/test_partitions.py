@@ -0,0 +1,62 @@
+# Помесячные секции (services/partitions.py): новые создаются от верхней
+# границы последней, повторный запуск ничего не создает, а сообщение попадает
+# в секцию своего месяца.
+
+from sqlalchemy import text
+from sqlmodel import Session
+
+from models.allmodels import Chat, Message, utcnow
+from services import partitions
+from services.partitions import (
+    PARTITIONED_TABLES,
+    add_months,
+    ensure_partitions,
+    is_partition,
+    month_start,
+)
+
+
+def test_partitions_continue_from_last_bound(database, make_user, monkeypatch):
+    start = month_start(utcnow())
+    # фикстура уже создала секции текущего и следующего месяца
+    later = add_months(start, 2).replace(day=15)
+    monkeypatch.setattr(partitions, "utcnow", lambda: later)
+    months = [add_months(start, 2), add_months(start, 3)]
+
+    with database.begin() as conn:
+        created = ensure_partitions(conn, 1)
+        again = ensure_partitions(conn, 1)
+
+    assert created == [
+        f"{table}_{month:%Y_%m}" for table in PARTITIONED_TABLES for month in months
+    ]
+    assert again == []
+    assert all(is_partition(name) for name in created)
+
+    sender, _ = make_user()
+    recipient, _ = make_user()
+    with Session(database) as session:
+        chat = Chat(users=sorted([sender.id, recipient.id]))
+        session.add(chat)
+        session.flush()
+        session.add(
+            Message(
+                chat_id=chat.id,
+                sender=sender.id,
+                user2=recipient.id,
+                text="из будущего",
+                send_time=months[-1].replace(day=20),
+            )
+        )
+        session.commit()
+        partition = session.exec(
+            text('SELECT tableoid::regclass::text FROM "Messages"')
+        ).one()[0]
+    assert partition == f'"Messages_{months[-1]:%Y_%m}"'
+
+
+def test_partition_names():
+    assert is_partition("Messages_2026_10")
+    assert is_partition("GroupMessages_legacy")
+    assert not is_partition("Messages")
+    assert not is_partition("UnreadCounters")
@@ -0,0 +1,51 @@
+# Пул потоков для bcrypt (services/passwords.py): запросы сверх
+# PASSWORD_HASH_QUEUE_SIZE ожидающих сразу получают 503, а не копятся.
+
+import asyncio
+
+import pytest
+
+from config import settings
+from exceptions import PasswordQueueFullException
+from services import passwords
+
+
+def test_full_queue_is_rejected(monkeypatch):
+    monkeypatch.setattr(settings, "PASSWORD_HASH_QUEUE_SIZE", 1)
+    # семафор привязывается к event loop, в котором его ждали
+    monkeypatch.setattr(
+        passwords, "slots", asyncio.Semaphore(settings.PASSWORD_HASH_WORKERS)
+    )
+
+    async def scenario():
+        # все потоки пула заняты
+        for _ in range(settings.PASSWORD_HASH_WORKERS):
+            await passwords.slots.acquire()
+        waiting = asyncio.create_task(passwords.hash_password("пароль"))
+        await asyncio.sleep(0)
+        rejected = passwords.stats.rejected
+        with pytest.raises(PasswordQueueFullException) as error:
+            await passwords.hash_password("пароль")
+        for _ in range(settings.PASSWORD_HASH_WORKERS):
+            passwords.slots.release()
+        hashed = await waiting
+        verified, _ = await passwords.verify_password("пароль", hashed)
+        return error.value, passwords.stats.rejected - rejected, verified
+
+    error, rejected, verified = asyncio.run(scenario())
+    assert error.status_code == 503
+    assert error.headers == {"Retry-After": "1"}
+    assert rejected == 1
+    assert verified
+
+
+def test_login_answers_503_when_queue_is_full(client, make_user, monkeypatch):
+    user, _ = make_user()
+    monkeypatch.setattr(settings, "PASSWORD_HASH_QUEUE_SIZE", 0)
+
+    response = client.post(
+        "/users/login", json={"username": user.username, "password": "пароль"}
+    )
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
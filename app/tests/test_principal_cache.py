@@ -0,0 +1,17 @@
+# Кэш пользователей по access-токену (services/users.py): выход сбрасывает
+# запись, и следующий запрос с тем же токеном снова читает пользователя из
+# базы.
+
+from services.users import principal_cache, principal_key
+
+
+def test_logout_drops_cached_principal(client, make_user):
+    user, headers = make_user()
+    token = headers["Authorization"].split(" ")[1]
+    key = principal_key(user.id, token)
+
+    assert client.get("/users/user/me", headers=headers).status_code == 200
+    assert principal_cache.get(key) is not None
+    client.post("/users/logout/", headers=headers)
+
+    assert principal_cache.get(key) is None
@@ -0,0 +1,99 @@
+# Число запросов к базе на запрос к API не должно зависеть от размера группы:
+# состав группы и имена участников читаются одним запросом
+# (services/groupchats.membership_query), участники при создании группы -
+# одним IN. Считаются операторы, выполненные асинхронным движком при
+# холодном кэше состава групп и прогретом кэше авторизации.
+
+from contextlib import contextmanager
+
+import pytest
+from sqlalchemy import event
+from sqlmodel import Session, select
+
+from db import async_engine
+from models.allmodels import GroupChat
+from services.groupchats import delivered_cache, membership_cache
+from services.recent import recent_history
+
+# create: участники по именам, вставка группы, ее перечитывание и одна
+# вставка всех участников; history: состав, ETag и страница
+EXPECTED = {
+    "create": 4,
+    "send": 4,
+    "send_late": 2,
+    "members": 1,
+    "history": 3,
+}
+
+
+@contextmanager
+def count_statements():
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", record)
+
+
+def measure(client, method, url, headers, **kwargs):
+    membership_cache.clear()
+    delivered_cache.clear()
+    with count_statements() as statements:
+        response = client.request(method, url, headers=headers, **kwargs)
+    assert response.status_code == 200, response.text
+    return len(statements)
+
+
+@pytest.mark.parametrize("size", [1, 5, 40])
+def test_group_requests_use_constant_statements(
+    client, make_user, database, monkeypatch, size
+):
+    # история читается из базы, а не из кэша последних сообщений
+    monkeypatch.setattr(recent_history, "capacity", 0)
+    owner, headers = make_user()
+    members = [make_user()[0] for _ in range(size)]
+    # первый запрос с токеном кладет пользователя в кэш авторизации
+    client.get("/unread", headers=headers)
+
+    counts = {
+        "create": measure(
+            client,
+            "POST",
+            "/group_chats/create",
+            headers,
+            json={"title": "группа", "members": [m.username for m in members]},
+        )
+    }
+    with Session(database) as session:
+        group_id = str(session.exec(select(GroupChat.id)).one())
+    counts["send"] = measure(
+        client,
+        "POST",
+        "/group_chats/messages",
+        headers,
+        json={"chat_id": group_id, "text": "привет"},
+    )
+    counts["send_late"] = measure(
+        client,
+        "POST",
+        "/group_chats/messages_late",
+        headers,
+        json={"message": {"chat_id": group_id, "text": "позже"}, "time": 5},
+    )
+    counts["members"] = measure(
+        client,
+        "POST",
+        "/group_chats/group_members",
+        headers,
+        json={"chat_id": group_id},
+    )
+    counts["history"] = measure(
+        client, "GET", f"/group_chats/messages/{group_id}", headers
+    )
+
+    assert counts == EXPECTED
@@ -0,0 +1,114 @@
+# Страница из кэша последних сообщений (services/recent.py) должна совпадать
+# со страницей из базы: тот же ETag, тот же курсор и то же тело ответа. При
+# ошибках Redis история читается из базы.
+
+import redis.asyncio as redis
+from sqlmodel import Session, select
+
+from config import settings
+from models.allmodels import GroupChat
+from services import recent
+from services.recent import recent_history
+
+
+def pages(client, url, headers, monkeypatch):
+    cached = client.get(url, params={"limit": 2}, headers=headers)
+    hits = recent_history.hits
+    monkeypatch.setattr(recent_history, "capacity", 0)
+    stored = client.get(url, params={"limit": 2}, headers=headers)
+    revalidated = client.get(
+        url,
+        params={"limit": 2},
+        headers={**headers, "If-None-Match": cached.headers["ETag"]},
+    )
+    older = client.get(
+        url,
+        params={"limit": 2, "before": cached.headers["X-Next-Cursor"]},
+        headers=headers,
+    )
+    assert hits > 0
+    return cached, stored, revalidated, older
+
+
+def assert_same_page(cached, stored, revalidated, older):
+    assert cached.status_code == stored.status_code == 200
+    assert cached.headers["ETag"] == stored.headers["ETag"]
+    assert cached.headers["X-Next-Cursor"] == stored.headers["X-Next-Cursor"]
+    assert cached.content == stored.content
+    assert revalidated.status_code == 304
+    assert older.status_code == 200
+    assert [m["text"] for m in older.json()] == ["1"]
+
+
+def test_direct_page_from_cache_matches_database(client, make_user, monkeypatch):
+    sender, headers = make_user()
+    recipient, _ = make_user()
+    url = f"/messages/{recipient.id}"
+
+    def send(text):
+        client.post(
+            "/messages",
+            json={"recipient_id": str(recipient.id), "content": text},
+            headers=headers,
+        )
+
+    send("1")
+    # буфер заполняется из базы, дальше сообщения дописываются в него
+    client.get(url, headers=headers)
+    send("2")
+    send("3")
+
+    assert_same_page(*pages(client, url, headers, monkeypatch))
+
+
+def test_group_page_from_cache_matches_database(
+    client, make_user, database, monkeypatch
+):
+    owner, headers = make_user()
+    member, _ = make_user()
+    client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [member.username]},
+        headers=headers,
+    )
+    with Session(database) as session:
+        group = session.exec(select(GroupChat)).one()
+    url = f"/group_chats/messages/{group.id}"
+
+    def send(text):
+        client.post(
+            "/group_chats/messages",
+            json={"chat_id": str(group.id), "text": text},
+            headers=headers,
+        )
+
+    send("1")
+    client.get(url, headers=headers)
+    send("2")
+    send("3")
+
+    assert_same_page(*pages(client, url, headers, monkeypatch))
+
+
+def test_redis_errors_fall_back_to_database(client, make_user, monkeypatch):
+    sender, headers = make_user()
+    recipient, _ = make_user()
+    url = f"/messages/{recipient.id}"
+    # порт, на котором никто не слушает
+    broken = redis.Redis.from_url("redis://127.0.0.1:1", decode_responses=True)
+    monkeypatch.setattr(settings, "RECENT_HISTORY_REDIS", True)
+    monkeypatch.setattr(recent, "get_redis", lambda: broken)
+    monkeypatch.setattr(recent, "stale_lists", set())
+
+    sent = client.post(
+        "/messages",
+        json={"recipient_id": str(recipient.id), "content": "без Redis"},
+        headers=headers,
+    )
+    history = client.get(url, headers=headers)
+
+    assert sent.status_code == 200
+    assert history.status_code == 200
+    assert [m["text"] for m in history.json()] == ["без Redis"]
+    # список, в который не дописали, больше не считается полным
+    assert len(recent.stale_lists) == 1
@@ -0,0 +1,97 @@
+# Отложенные сообщения из таблицы ScheduledMessages: доставка
+# (services/celery_service.deliver_scheduled_messages) пропускает строки,
+# захваченные другим воркером, отмена действует только на ожидающие.
+
+from datetime import timedelta
+
+from sqlalchemy import update
+from sqlmodel import Session, select
+
+from models.allmodels import Message, ScheduledMessage, ScheduledStatus, utcnow
+from services.celery_service import deliver_scheduled_messages
+
+
+def schedule(client, headers, recipient, text):
+    response = client.post(
+        "/messages_late",
+        json={
+            "message": {"recipient_id": str(recipient.id), "content": text},
+            "time": 5,
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200, response.text
+    return response.json()["id"]
+
+
+def make_due(database):
+    with Session(database) as session:
+        session.exec(
+            update(ScheduledMessage).values(due_at=utcnow() - timedelta(seconds=1))
+        )
+        session.commit()
+
+
+def statuses(database):
+    with Session(database) as session:
+        rows = session.exec(select(ScheduledMessage.text, ScheduledMessage.status))
+        return dict(rows.all())
+
+
+def delivered(database):
+    with Session(database) as session:
+        return sorted(session.exec(select(Message.text)).all())
+
+
+def test_locked_rows_are_skipped(client, make_user, database):
+    _, headers = make_user()
+    recipient, _ = make_user()
+    schedule(client, headers, recipient, "свободное")
+    taken = schedule(client, headers, recipient, "захваченное")
+    make_due(database)
+
+    # строку держит другой воркер
+    with database.connect() as other:
+        other.execute(
+            select(ScheduledMessage.id)
+            .where(ScheduledMessage.id == taken)
+            .with_for_update()
+        )
+        first = deliver_scheduled_messages()
+        skipped = statuses(database)
+    second = deliver_scheduled_messages()
+
+    assert first["rows"] == 1
+    assert skipped == {
+        "свободное": ScheduledStatus.sent,
+        "захваченное": ScheduledStatus.pending,
+    }
+    assert second["rows"] == 1
+    assert statuses(database)["захваченное"] == ScheduledStatus.sent
+    assert delivered(database) == ["захваченное", "свободное"]
+
+
+def test_cancel_only_pending(client, make_user, database):
+    _, headers = make_user()
+    recipient, recipient_headers = make_user()
+    cancelled = schedule(client, headers, recipient, "отмененное")
+    sent = schedule(client, headers, recipient, "отправленное")
+
+    # отменить чужое сообщение нельзя
+    foreign = client.delete(f"/scheduled/{cancelled}", headers=recipient_headers)
+    response = client.delete(f"/scheduled/{cancelled}", headers=headers)
+    again = client.delete(f"/scheduled/{cancelled}", headers=headers)
+    make_due(database)
+    deliver_scheduled_messages()
+    late = client.delete(f"/scheduled/{sent}", headers=headers)
+
+    assert foreign.status_code == 404
+    assert response.json() == {"status": "cancelled", "id": cancelled}
+    assert again.status_code == 404
+    assert late.status_code == 404
+    assert statuses(database) == {
+        "отмененное": ScheduledStatus.cancelled,
+        "отправленное": ScheduledStatus.sent,
+    }
+    assert delivered(database) == ["отправленное"]
+    assert client.get("/scheduled", headers=headers).json() == []
@@ -0,0 +1,90 @@
+# Поиск по сообщениям (GET /search): курсор X-Next-Cursor проходит все
+# совпадения без пропусков и повторов, а фрагмент с подсветкой экранирован -
+# единственная разметка в нем <b></b>.
+
+from sqlmodel import Session, select
+
+from models.allmodels import GroupChat
+
+
+def test_cursor_walks_all_hits(client, make_user, database):
+    owner, headers = make_user()
+    friend, _ = make_user()
+    stranger, stranger_headers = make_user()
+    # разная частота слова дает разный rank, одинаковая - равный
+    texts = ["кошка", "кошка кошка", "кошка и собака", "кошка", "кошка кошка кошка"]
+    for text in texts:
+        client.post(
+            "/messages",
+            json={"recipient_id": str(friend.id), "content": text},
+            headers=headers,
+        )
+    client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [friend.username]},
+        headers=headers,
+    )
+    with Session(database) as session:
+        group_id = str(session.exec(select(GroupChat.id)).one())
+    client.post(
+        "/group_chats/messages",
+        json={"chat_id": group_id, "text": "кошки в группе"},
+        headers=headers,
+    )
+    # чужая переписка в поиск не попадает
+    client.post(
+        "/messages",
+        json={"recipient_id": str(friend.id), "content": "чужая кошка"},
+        headers=stranger_headers,
+    )
+
+    everything = client.get("/search", params={"q": "кошка"}, headers=headers)
+    pages, cursor = [], None
+    while True:
+        params = {"q": "кошка", "limit": 2}
+        if cursor:
+            params["after"] = cursor
+        response = client.get("/search", params=params, headers=headers)
+        assert response.status_code == 200, response.text
+        pages.append(response.json())
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+
+    walked = [hit["id"] for page in pages for hit in page]
+    assert walked == [hit["id"] for hit in everything.json()]
+    assert len(walked) == len(set(walked)) == len(texts) + 1
+    assert "чужая кошка" not in [hit["text"] for hit in everything.json()]
+    ranks = [hit["rank"] for hit in everything.json()]
+    assert ranks == sorted(ranks, reverse=True)
+
+
+def test_snippet_is_escaped(client, make_user):
+    sender, headers = make_user()
+    recipient, _ = make_user()
+    client.post(
+        "/messages",
+        json={
+            "recipient_id": str(recipient.id),
+            "content": "<script>alert(1)</script> кошка & <i>собака</i>",
+        },
+        headers=headers,
+    )
+
+    hits = client.get("/search", params={"q": "кошка"}, headers=headers).json()
+
+    snippet = hits[0]["snippet"]
+    assert "<b>кошка</b>" in snippet
+    # фрагмент начинается с границы слова и может срезать начало сущности
+    assert "&lt;/script&gt;" in snippet
+    assert "&amp;" in snippet
+    assert "&lt;i&gt;собака" in snippet
+    assert snippet.replace("<b>", "").replace("</b>", "").count("<") == 0
+
+
+def test_bad_cursor(client, make_user):
+    _, headers = make_user()
+    response = client.get(
+        "/search", params={"q": "кошка", "after": "не курсор"}, headers=headers
+    )
+    assert response.status_code == 400
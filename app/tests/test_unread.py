@@ -0,0 +1,81 @@
+# Счетчики непрочитанных (services/unread.py): растут при отправке, кроме
+# своих сообщений, сбрасываются до числа сообщений новее прочитанного и не
+# откатываются запоздавшей отметкой о прочтении. /unread показывает только
+# переписки, где что-то не прочитано.
+
+from sqlmodel import Session, select
+
+from models.allmodels import GroupChat
+
+
+def unread(client, headers):
+    return {
+        row["user_id"] or row["group_id"]: row["unread"]
+        for row in client.get("/unread", headers=headers).json()
+    }
+
+
+def test_direct_counters(client, make_user):
+    sender, headers = make_user()
+    recipient, recipient_headers = make_user()
+    for text in ("1", "2", "3"):
+        client.post(
+            "/messages",
+            json={"recipient_id": str(recipient.id), "content": text},
+            headers=headers,
+        )
+    ids = [
+        m["id"]
+        for m in client.get(f"/messages/{sender.id}", headers=recipient_headers).json()
+    ]
+
+    def read(message_id=None):
+        return client.post(
+            "/messages/read",
+            json={"user_id": str(sender.id), "message_id": message_id},
+            headers=recipient_headers,
+        )
+
+    sent = unread(client, recipient_headers)
+    read(ids[1])
+    partly = unread(client, recipient_headers)
+    # отметка о более старом сообщении ничего не откатывает
+    read(ids[0])
+    stale = unread(client, recipient_headers)
+    read()
+
+    assert sent == {str(sender.id): 3}
+    assert unread(client, headers) == {}
+    assert partly == stale == {str(sender.id): 1}
+    assert unread(client, recipient_headers) == {}
+    assert read("00000000-0000-0000-0000-000000000000").status_code == 404
+
+
+def test_group_counters(client, make_user, database):
+    owner, headers = make_user()
+    member, member_headers = make_user()
+    client.post(
+        "/group_chats/create",
+        json={"title": "группа", "members": [member.username]},
+        headers=headers,
+    )
+    with Session(database) as session:
+        group_id = str(session.exec(select(GroupChat.id)).one())
+
+    def send(text, sender_headers):
+        client.post(
+            "/group_chats/messages",
+            json={"chat_id": group_id, "text": text},
+            headers=sender_headers,
+        )
+
+    send("1", headers)
+    send("2", headers)
+    # свое сообщение не увеличивает свой счетчик
+    send("3", member_headers)
+    sent = (unread(client, headers), unread(client, member_headers))
+    client.post("/group_chats/read", json={"chat_id": group_id}, headers=headers)
+
+    assert sent == ({group_id: 1}, {group_id: 2})
+    assert unread(client, headers) == {}
+    assert unread(client, member_headers) == {group_id: 2}
@@ -0,0 +1,143 @@
+# Очередь отправки WebSocket-подключения и рассылка через шину (websocket.py)
+# без сети и без базы: сокет подменен объектом, который запоминает кадры.
+# Последние тесты проходят через настоящий эндпоинт /ws.
+
+import asyncio
+
+import pytest
+from fastapi import WebSocketDisconnect, status
+
+from config import settings
+from websocket import Connection, ConnectionManager, InMemoryBus
+
+
+class FakeSocket:
+    # send_text ждет, пока тест не откроет release: так имитируется
+    # медленный клиент
+    def __init__(self, blocked: bool = False):
+        self.sent = []
+        self.release = asyncio.Event()
+        if not blocked:
+            self.release.set()
+        self.close_code = None
+
+    async def send_text(self, data: str):
+        await self.release.wait()
+        self.sent.append(data)
+
+    async def close(self, code: int):
+        self.close_code = code
+
+
+async def until(predicate):
+    for _ in range(100):
+        if predicate():
+            return
+        await asyncio.sleep(0)
+    raise AssertionError("условие не выполнилось")
+
+
+def test_overflow_drops_oldest(monkeypatch):
+    monkeypatch.setattr(settings, "WS_SEND_QUEUE_SIZE", 2)
+    monkeypatch.setattr(settings, "WS_OVERFLOW_POLICY", "drop_oldest")
+
+    async def scenario():
+        socket = FakeSocket(blocked=True)
+        connection = Connection(socket)
+        assert connection.send("1")
+        # писатель забрал первый кадр и ждет клиента
+        await until(connection.queue.empty)
+        assert all(connection.send(data) for data in ("2", "3", "4"))
+        socket.release.set()
+        await until(lambda: len(socket.sent) == 3)
+        await connection.close()
+        return socket.sent, connection.dropped
+
+    assert asyncio.run(scenario()) == (["1", "3", "4"], 1)
+
+
+def test_overflow_disconnects_slow_client(monkeypatch):
+    monkeypatch.setattr(settings, "WS_SEND_QUEUE_SIZE", 1)
+    monkeypatch.setattr(settings, "WS_OVERFLOW_POLICY", "disconnect")
+
+    async def scenario():
+        bus = InMemoryBus()
+        await bus.start()
+        manager = ConnectionManager(bus, "test")
+        socket = FakeSocket(blocked=True)
+        await manager.connect("user", socket)
+        for text in ("1", "2", "3"):
+            await manager.notify_user("user", {"text": text})
+            await asyncio.sleep(0)
+        return socket.close_code, manager.active_connections, bus.handlers
+
+    close_code, connections, handlers = asyncio.run(scenario())
+    assert close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert connections == {}
+    assert "test:user:user" not in handlers
+
+
+def test_fanout_reaches_every_connection(monkeypatch):
+    monkeypatch.setattr(settings, "WS_FANOUT_THRESHOLD", 3)
+
+    async def scenario():
+        bus = InMemoryBus()
+        await bus.start()
+        manager = ConnectionManager(bus, "test")
+        await manager.start()
+        sockets = {user: FakeSocket() for user in ("a", "b", "c")}
+        # у пользователя может быть несколько подключений
+        extra = FakeSocket()
+        for user, socket in sockets.items():
+            await manager.connect(user, socket)
+        await manager.connect("a", extra)
+
+        few = manager.envelopes(["a", "b"], {"text": "двоим"})
+        many = manager.envelopes(["a", "b", "c", "offline"], {"text": "всем"})
+        await manager.notify_users(["a", "b"], {"text": "двоим"})
+        await manager.notify_users(["a", "b", "c", "offline"], {"text": "всем"})
+        await until(lambda: len(sockets["c"].sent) == 1)
+        await until(lambda: len(extra.sent) == 2)
+        return few, many, {user: s.sent for user, s in sockets.items()}, extra.sent
+
+    few, many, sent, extra = asyncio.run(scenario())
+    # ниже порога - канал каждого получателя, с порога - одна публикация
+    assert sorted(channel for channel, _ in few) == ["test:user:a", "test:user:b"]
+    assert [channel for channel, _ in many] == ["test:fanout"]
+    assert sent["a"] == sent["b"] == extra
+    assert len(sent["a"]) == 2
+    assert sent["c"] == [sent["a"][1]]
+
+
+def test_ping_and_push_over_endpoint(client, make_user):
+    sender, sender_headers = make_user()
+    recipient, headers = make_user()
+
+    with client.websocket_connect("/ws", headers=headers) as socket:
+        socket.send_json({"type": "ping"})
+        assert socket.receive_json() == {"type": "pong"}
+        client.post(
+            "/messages",
+            json={"recipient_id": str(recipient.id), "content": "привет"},
+            headers=sender_headers,
+        )
+        message = socket.receive_json()
+
+    assert message["content"] == "привет"
+    assert message["sender_id"] == str(sender.id)
+
+
+def test_idle_connection_is_closed(client, make_user, monkeypatch):
+    monkeypatch.setattr(settings, "WS_IDLE_TIMEOUT", 0.1)
+    _, headers = make_user()
+
+    with client.websocket_connect("/ws", headers=headers) as socket:
+        with pytest.raises(WebSocketDisconnect):
+            socket.receive_json()
+
+
+def test_endpoint_rejects_missing_token(client):
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with client.websocket_connect("/ws") as socket:
+            socket.receive_json()
+    assert closed.value.code == status.WS_1008_POLICY_VIOLATION
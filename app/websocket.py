@@ -0,0 +1,307 @@
+# Доставка сообщений по WebSocket между несколькими воркерами.
+# Каждый воркер держит только свои подключения и подписывается в шине на
+# каналы подключенных к нему пользователей, а отправка сообщения - это
+# публикация в канал получателя, поэтому она дойдет до сокета на любом воркере.
+
+import asyncio
+import json
+import logging
+from functools import partial
+from uuid import UUID
+
+import orjson
+import redis
+import redis.asyncio as aioredis
+from fastapi import WebSocket, WebSocketDisconnect, status
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# служебный канал, на который Redis-шина подписана всегда
+CONTROL_CHANNEL = "messenger:control"
+
+
+# Кадр для сокета: orjson сам понимает UUID и datetime, поэтому словарь не
+# надо сначала прогонять через jsonable_encoder. UUID, прочитанные asyncpg,
+# - не uuid.UUID, их orjson отдает в default
+def encode(message: dict) -> str:
+    return orjson.dumps(message, default=str).decode()
+
+
+class InMemoryBus:
+    # шина внутри одного процесса: для тестов и запуска в один воркер
+
+    def __init__(self):
+        self.handlers = {}
+        self.loop = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        self.handlers.clear()
+
+    async def subscribe(self, channel: str, handler):
+        self.handlers[channel] = handler
+
+    async def unsubscribe(self, channel: str):
+        self.handlers.pop(channel, None)
+
+    async def publish(self, channel: str, data: str):
+        handler = self.handlers.get(channel)
+        if handler is not None:
+            await handler(data)
+
+    async def publish_all(self, envelopes: list[tuple[str, str]]):
+        for channel, data in envelopes:
+            await self.publish(channel, data)
+
+    # Публикация из потока без event loop (задача celery, запущенная в том же
+    # процессе, что и приложение). Без запущенного приложения доставлять некому.
+    def publish_sync(self, envelopes: list[tuple[str, str]]):
+        if self.loop is None or self.loop.is_closed() or not envelopes:
+            return
+        asyncio.run_coroutine_threadsafe(self.publish_all(envelopes), self.loop)
+
+
+class RedisBus:
+    def __init__(self, url: str):
+        self.url = url
+        self.redis = aioredis.Redis.from_url(url, decode_responses=True)
+        self.pubsub = self.redis.pubsub()
+        self.handlers = {}
+        self.reader = None
+        self.sync_redis = None
+
+    async def start(self):
+        # без подписок listen() сразу завершается, поэтому держим служебный канал
+        await self.pubsub.subscribe(CONTROL_CHANNEL)
+        self.reader = asyncio.create_task(self.read())
+
+    async def stop(self):
+        if self.reader is not None:
+            self.reader.cancel()
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+
+    async def subscribe(self, channel: str, handler):
+        self.handlers[channel] = handler
+        await self.pubsub.subscribe(channel)
+
+    async def unsubscribe(self, channel: str):
+        self.handlers.pop(channel, None)
+        await self.pubsub.unsubscribe(channel)
+
+    async def publish(self, channel: str, data: str):
+        await self.redis.publish(channel, data)
+
+    async def publish_all(self, envelopes: list[tuple[str, str]]):
+        # одна пачка команд вместо отдельного запроса на каждого получателя
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, data in envelopes:
+                pipe.publish(channel, data)
+            await pipe.execute()
+
+    # Публикация из синхронного кода (воркер celery): отдельный синхронный
+    # клиент, все сообщения пачки - одним конвейером
+    def publish_sync(self, envelopes: list[tuple[str, str]]):
+        if not envelopes:
+            return
+        if self.sync_redis is None:
+            self.sync_redis = redis.Redis.from_url(self.url)
+        with self.sync_redis.pipeline(transaction=False) as pipe:
+            for channel, data in envelopes:
+                pipe.publish(channel, data)
+            pipe.execute()
+
+    async def read(self):
+        while True:
+            try:
+                async for message in self.pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+                    handler = self.handlers.get(message["channel"])
+                    if handler is not None:
+                        await handler(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Ошибка чтения из Redis pub/sub")
+                await asyncio.sleep(1)
+
+
+def create_bus():
+    if settings.BUS_BACKEND == "redis":
+        return RedisBus(settings.REDIS_URL)
+    return InMemoryBus()
+
+
+class Connection:
+    # Одно WebSocket-подключение с собственной очередью исходящих сообщений.
+    # Сообщения отправляет отдельная задача, поэтому медленный клиент не
+    # задерживает ни отправителя, ни остальных получателей.
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=settings.WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.dropped = 0
+        self.writer = asyncio.create_task(self.write())
+
+    # Не ждет клиента. Возвращает False, если подключение нужно закрыть.
+    def send(self, data: str) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(data)
+        except asyncio.QueueFull:
+            if settings.WS_OVERFLOW_POLICY == "disconnect":
+                logger.info("Очередь отправки переполнена, отключаем клиента")
+                return False
+            # drop_oldest: выбрасываем самое старое неотправленное сообщение
+            self.queue.get_nowait()
+            self.queue.put_nowait(data)
+            self.dropped += 1
+        return True
+
+    def send_json(self, message: dict) -> bool:
+        return self.send(encode(message))
+
+    async def write(self):
+        try:
+            while True:
+                data = await self.queue.get()
+                await self.websocket.send_text(data)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.closed = True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE):
+        self.writer.cancel()
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # зависший клиент не должен задерживать того, кто закрывает сокет
+            await asyncio.wait_for(self.websocket.close(code=code), timeout=1)
+        except Exception:
+            pass
+
+
+class ConnectionManager:
+    def __init__(self, bus, prefix: str):
+        self.bus = bus
+        self.prefix = prefix
+        # Активные подключения этого воркера: {user_id: {connection, ...}},
+        # у одного пользователя может быть несколько устройств и вкладок
+        self.active_connections: dict[str, set[Connection]] = {}
+        self.fanout_channel = f"{prefix}:fanout"
+
+    def channel(self, user_id: str) -> str:
+        return f"{self.prefix}:user:{user_id}"
+
+    # подписка на общий канал рассылок, вызывается при старте приложения
+    async def start(self):
+        await self.bus.subscribe(self.fanout_channel, self.deliver_many)
+
+    async def connect(self, user_id: UUID, websocket: WebSocket) -> Connection:
+        user_id = str(user_id)
+        connection = Connection(websocket)
+        connections = self.active_connections.setdefault(user_id, set())
+        connections.add(connection)
+        if len(connections) == 1:
+            await self.bus.subscribe(
+                self.channel(user_id), partial(self.deliver, user_id)
+            )
+        return connection
+
+    async def disconnect(
+        self,
+        user_id: UUID,
+        connection: Connection,
+        code: int = status.WS_1000_NORMAL_CLOSURE,
+    ):
+        user_id = str(user_id)
+        await connection.close(code)
+        connections = self.active_connections.get(user_id)
+        if connections is None or connection not in connections:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self.active_connections[user_id]
+            await self.bus.unsubscribe(self.channel(user_id))
+
+    # Отправка сообщения пользователю, к какому бы воркеру он ни был подключен
+    async def notify_user(self, user_id: UUID, message: dict):
+        await self.notify_users([user_id], message)
+
+    async def notify_users(self, user_ids: list[UUID], message: dict):
+        await self.bus.publish_all(self.envelopes(user_ids, message))
+
+    # Пары (канал, данные) для публикации; через bus.publish_sync так же
+    # рассылает целые пачки синхронный код (воркер celery). Сообщение
+    # кодируется один раз на всех получателей. Начиная с WS_FANOUT_THRESHOLD
+    # получателей (большие группы) вместо публикации в канал каждого уходит
+    # одна публикация в общий канал: "id1,id2,...|кадр", и каждый воркер сам
+    # раздает кадр своим подключениям из списка.
+    def envelopes(self, user_ids: list[UUID], message: dict) -> list[tuple[str, str]]:
+        data = encode(message)
+        user_ids = {str(user_id) for user_id in user_ids}
+        if len(user_ids) >= settings.WS_FANOUT_THRESHOLD:
+            return [(self.fanout_channel, ",".join(user_ids) + "|" + data)]
+        return [(self.channel(user_id), data) for user_id in user_ids]
+
+    async def deliver_many(self, data: str):
+        user_ids, data = data.split("|", 1)
+        for user_id in user_ids.split(","):
+            if user_id in self.active_connections:
+                await self.deliver(user_id, data)
+
+    # Доставка сообщения из шины во все сокеты пользователя на этом воркере
+    async def deliver(self, user_id: str, data: str):
+        for connection in list(self.active_connections.get(user_id, ())):
+            if not connection.send(data):
+                await self.disconnect(
+                    user_id, connection, code=status.WS_1013_TRY_AGAIN_LATER
+                )
+
+
+# Обслуживание подключения: ждем входящие кадры, а не просыпаемся по таймеру.
+# Клиент периодически присылает {"type": "ping"}; если за WS_IDLE_TIMEOUT
+# секунд от него ничего не пришло, соединение считается мертвым.
+# Мертвые TCP-соединения дополнительно отсекают ping/pong на уровне протокола
+# (--ws-ping-interval/--ws-ping-timeout у uvicorn). Остальные кадры передаются
+# в handle_frame(connection, frame).
+async def serve(
+    manager: ConnectionManager, websocket: WebSocket, user_id: UUID, handle_frame=None
+):
+    connection = await manager.connect(user_id, websocket)
+    try:
+        while not connection.closed:
+            try:
+                data = await asyncio.wait_for(
+                    websocket.receive_text(), timeout=settings.WS_IDLE_TIMEOUT
+                )
+            except asyncio.TimeoutError:
+                break
+            try:
+                frame = json.loads(data)
+            except ValueError:
+                continue
+            if not isinstance(frame, dict):
+                continue
+            if frame.get("type") == "ping":
+                connection.send_json({"type": "pong"})
+            elif handle_frame is not None:
+                await handle_frame(connection, frame)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await manager.disconnect(user_id, connection)
+
+
+bus = create_bus()
+chat_manager = ConnectionManager(bus, "chats")
+group_chat_manager = ConnectionManager(bus, "group_chats")